@@ -11,7 +11,7 @@
 # =======================================================================================================================
 import pathlib as pl
 import datetime
-import sys 
+import argparse
 import os
 
 # =======================================================================================================================
@@ -19,105 +19,129 @@ import os
 # =======================================================================================================================
 
 dict_paths = {
-    'root_path':         pl.Path(__file__).parent.absolute(),  # Gets the directory of the script
+    'root_path':         str(pl.Path(__file__).parent.parent.absolute()),  # Gets the project root (parent of the script's directory)
     'folder_pgm':        "/01_program",
     'folder_pgmmodu':    "/modules",
     'folder_intray':     "/02_in_tray",
     'folder_outtray':    "/03_out_tray",
     'folder_template':   "/template", 
     'folder_pickle':     "/pickles",
+    'folder_reference':  "/04_reference",
     'output_climatePD':  "/deliverable_climate_pds",
     'output_transrisk':  "/deliverable_transition_risk_drivers",
     'output_reports':    "/deliverable_predefined_reports",
     'output_esg':    "/deliverable_esg",
 }
 
-print('Absolute path : {}'.format(pl.Path().absolute()))
-print(f"Current path : {pl.Path.cwd()}")
-print(f"Home path : {pl.Path.home()}")
-os.chdir(dict_paths['root_path']+dict_paths['folder_pgm']) 
-print(f"New current directory : {pl.Path.cwd()}")
-sys.path.append(os.path.abspath(dict_paths['root_path']+dict_paths['folder_pgm']+dict_paths['folder_pgmmodu']))
-
 # =======================================================================================================================
 # Main procedures
 # =======================================================================================================================
-import file_handlers as fh
-import ownfirm_data_formatters as adf
-import ownfirm_models as amodel
-import ownfirm_to_moodys_connectors as amc
+# modules is a package next to this script; nothing is changed in the working directory or sys.path at import time,
+# config.json is only read by the first API call and each module is only imported when the run first uses it
+from modules import lazyModule
+fh = lazyModule("modules.file_handlers")
+adf = lazyModule("modules.ownfirm_data_formatters")
+ppl = lazyModule("modules.pipeline")
+rj = lazyModule("modules.run_journal")
+pprof = lazyModule("modules.pipeline_profiler")
+rr = lazyModule("modules.run_replay")
+rplan = lazyModule("modules.run_planner")
 
 
 if __name__ == '__main__':
+    print('Absolute path : {}'.format(pl.Path().absolute()))
+    print(f"Current path : {pl.Path.cwd()}")
+    print(f"Home path : {pl.Path.home()}")
+
+    parser = argparse.ArgumentParser(description="Retrieve Moody's climate analytics for the workbook in the in-tray")
+    parser.add_argument('command', nargs='?', choices=['run', 'replay', 'plan'], default='run', help="run: process the workbook in the in-tray (default); replay: flatten and export the journaled responses of RUN_FOLDER again, offline; plan: count the requests of the workbook and project the duration of its run, without sending any")
+    parser.add_argument('run_folder', nargs='?', metavar='RUN_FOLDER', default=None, help="out-tray run folder to replay, or workbook to plan (default: the workbook in the in-tray)")
+    parser.add_argument('--stream', action='store_true', help="read the Input Table in chunks and write each chunk's outputs as soon as it completes")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="rows of the Input Table per chunk in --stream mode")
+    parser.add_argument('--workers', type=int, default=5, help="number of deliverables run at the same time (1 runs them one after another)")
+    parser.add_argument('--resume', metavar='RUN_FOLDER', default=None, help="continue an interrupted run in this out-tray folder; completed requests are not sent again")
+    parser.add_argument('--watch', action='store_true', help="service mode: keep watching the in-tray and run every workbook dropped into it as a job of its own")
+    parser.add_argument('--jobs', type=int, default=2, help="number of workbooks run at the same time in --watch mode")
+    parser.add_argument('--poll-seconds', type=float, default=10, help="how often the in-tray is checked in --watch mode")
+    parser.add_argument('--profile', action='store_true', help="profile each stage (CPU and memory) into <run folder>/profile; deliverables and jobs run one at a time")
+    parser.add_argument('--delta', action='store_true', help="export only what changed since the previous run of the same workbook, plus a change summary (batch and --watch modes)")
+    parser.add_argument('--delta-tolerance', type=float, default=1e-6, help="relative tolerance below which a number is taken as unchanged in --delta mode")
+    parser.add_argument('--output-format', choices=['xlsx', 'parquet', 'csv'], default='xlsx', help="xlsx: one workbook of climate PDs per entity plus a combined one (default); parquet / csv: a dataset partitioned by scenarioCategory / RiskType / Scenario")
+    parser.add_argument('--loss-workers', type=int, default=1, help="processes simulating the portfolio losses (1 simulates them in the run's own process)")
+    parser.add_argument('--repeat', type=int, default=1, help="number of times each stage is run in replay mode, for benchmarking")
+    parser.add_argument('--history', type=int, default=10, help="number of previous runs whose request latencies are used in plan mode")
+    parser.add_argument('--profile-top', type=int, default=25, help="number of functions / allocations listed in the --profile reports")
+    args = parser.parse_args()
+    if args.command == 'replay' and args.run_folder is None:
+        parser.error("replay needs the RUN_FOLDER to replay")
+
+    if args.profile:
+        # one profiler at a time: stages that would run concurrently are run one after another instead
+        pprof.enableProfiling(args.profile_top)
+        args.workers, args.jobs = 1, 1
+        print("Profiling is enabled: deliverables and jobs are run one at a time")
+
     dtts_begin = datetime.datetime.now()
     path_intray = dict_paths['root_path']+dict_paths['folder_intray']
     path_outray = dict_paths['root_path']+dict_paths['folder_outtray']
     
-    dict_xlsxmeta, dict_xlsx = fh.readXLSX(path_intray) #read excel files
-    path_target, name_target = fh.createFolder(path_outray, dict_xlsxmeta['name'], dtts_begin)
-    path_pickle = fh.createFolder(path_target+dict_paths['folder_pickle'])
+    # a resumed run keeps its folder; its workbook is still in the in-tray, or in the run folder if it was moved already
+    path_source = path_intray
+    if args.command == 'replay':
+        args.resume = args.run_folder
+    elif args.command == 'plan':
+        path_source = os.path.abspath(args.run_folder) if args.run_folder is not None else path_intray+"/"+fh.findInputFiles(path_intray)[-1]
+    if args.resume is not None:
+        path_target = os.path.abspath(args.resume if os.path.isabs(args.resume) or os.path.exists(args.resume) else path_outray+"/"+args.resume)
+        name_target = os.path.basename(path_target)
+        if len(fh.findInputFiles(path_intray)) == 0:
+            path_source = path_target
+    
+if __name__ == '__main__' and args.command == 'replay':
+    # offline: no credentials are read and no request is sent
+    path_replay, df_timings = rr.replayRun(path_target, dict_paths, args.repeat)
+    print(f"Replay of {name_target} is saved into {path_replay}")
+    print(df_timings.to_string(index=False))
+
+elif __name__ == '__main__' and args.command == 'plan':
+    # offline: the workbook stays in the in-tray, nothing is sent
+    path_plan, df_requests, df_deliverables, df_summary = rplan.planRun(path_source, dict_paths, args.workers, args.history)
+    print(df_requests.to_string(index=False))
+    print(df_deliverables.to_string(index=False))
+    print(df_summary.to_string(index=False))
+    print(f"Plan of {os.path.basename(path_source)} is saved into {path_plan}")
 
-    # create log file    
-    logger = fh.createLog(path_target, name_target)
+elif __name__ == '__main__' and args.watch:
+    # service mode: runs until interrupted (Ctrl+C), logging the service itself into the out-tray
+    logger = fh.createLog(path_outray, "_watch_"+dtts_begin.strftime("%Y%m%d_%H%M%S"), bool_queued=True)
+    ppl.watchInTray(path_intray, path_outray, dict_paths, args.jobs, args.workers, args.poll_seconds, logger, args.delta, args.delta_tolerance, args.output_format, args.loss_workers)
+    fh.closeLog(logger, dtts_begin, datetime.datetime.now())
+
+elif __name__ == '__main__' and args.stream:
+    # streaming mode: only the parameter sheets are read upfront, the Input Table is read chunk by chunk
+    name_file = fh.findInputFiles(path_source)[-1]
+    dict_xlsxmeta = {"name": os.path.splitext(name_file)[0], "file": name_file}
+    dict_xlsx = fh.readXLSXSheets(path_source+"/"+name_file, ['Climate Adjusted PD properties', 'Deliverables Control'])
+    if args.resume is None:
+        path_target, name_target = fh.createFolder(path_outray, dict_xlsxmeta['name'], dtts_begin)
+    logger = fh.createLog(path_target, name_target, bool_queued=True)
+    dict_journal = rj.openJournal(path_target)
 
-    # obtain Input Table and Parameters in dataframe format
-    df_inputtable = adf.getInputTable(dict_xlsx)
     df_cpdproperties = adf.getCPDProperties(dict_xlsx)
     dict_dcontrol = adf.getDeliverableControl(dict_xlsx)
+    ppl.runStreamingPipeline(path_source+"/"+name_file, path_target, dict_paths, dict_dcontrol, df_cpdproperties, args.chunk_size, logger, dict_journal, args.output_format)
 
-    if dict_dcontrol['Retrieve Climate Adjusted PDs'] == 'ENABLE':
-        path_climatePD = fh.createFolder(path_target+dict_paths['output_climatePD'])
-        bool_isasync, list_apiinputs_climatepds = adf.genListOfAPIInput_ClimatePDs(df_cpdproperties, df_inputtable, logger)    
-        list_responses_climatepds = amc.obtainClimatePDs(bool_isasync, list_apiinputs_climatepds, logger)
-        fh.writeBinary(path_pickle, list_responses_climatepds, "list_responses_climatepds")
-        list_ownfirmoutputs_climatepds = adf.extractAPIOutput_ClimatePDs(list_responses_climatepds, logger)
-        adf.exportAPIOutput_ClimatePDs(path_climatePD, list_ownfirmoutputs_climatepds, logger)
-
-        df_portfolio_edf = amodel.calculatePortfolioPD (list_ownfirmoutputs_climatepds)
-        adf.exportPortfolioPDs(path_climatePD, df_portfolio_edf, logger)
-    
-    
-    if dict_dcontrol['Retrieve Transition Risk Drivers for Industry (Sector)'] == 'ENABLE':
-        path_transrisk = fh.createFolder(path_target+dict_paths['output_transrisk'])
-        dict_apiinputs_industry = adf.genAPIInput_TransRiskIndustry(df_cpdproperties, df_inputtable, logger)
-        obj_responses_industry = amc.obtainTransRiskIndustry(dict_apiinputs_industry, logger)
-        fh.writeBinary(path_pickle, obj_responses_industry, "obj_responses_industry")
-        df_ownfirmoutputs_industry = adf.extractAPIOutput_TransRiskIndustry(obj_responses_industry, logger)
-        adf.exportAPIOutput_TransRiskIndustry(path_transrisk, df_ownfirmoutputs_industry, logger)
- 
-        
-    if dict_dcontrol['Retrieve Transition Risk Drivers for Country (Region)'] == 'ENABLE':
-        path_transrisk = fh.createFolder(path_target+dict_paths['output_transrisk'])
-        dict_apiinputs_region = adf.genAPIInput_TransRiskRegion(df_cpdproperties, df_inputtable, logger)
-        obj_responses_region = amc.obtainTransRiskRegion(dict_apiinputs_region, logger)
-        fh.writeBinary(path_pickle, obj_responses_region, "obj_responses_region")
-        df_ownfirmoutputs_region = adf.extractAPIOutput_TransRiskRegion(obj_responses_region, logger)
-        adf.exportAPIOutput_TransRiskRegion(path_transrisk, df_ownfirmoutputs_region, logger)
-    
-    
-    if dict_dcontrol['Access Pre-defined reports'] == 'ENABLE':
-        # only available when entity Id is valid BVD id
-        path_reports = fh.createFolder(path_target+dict_paths['output_reports'])
-        list_apiinputs_reports = adf.genListOfAPIInput_Reports(df_cpdproperties, df_inputtable, logger)    
-        # as response has expiring time limit, it must be handled one by one, not in batch mode
-        amc.downloadReports(path_reports, list_apiinputs_reports, logger)
-    
-    
-    if dict_dcontrol['Request ESG Score Predictor'] == 'ENABLE':
-        path_esg = fh.createFolder(path_target+dict_paths['output_esg'])
-        
-        list_apiinputs_esg = adf.genAPIInput_ESG(df_cpdproperties, df_inputtable, logger)    
-        response_esg = amc.obtainESG(list_apiinputs_esg , logger)
-        fh.writeBinary(path_pickle, response_esg, "response_esg")
-        df_ownfirmoutputs_esg = adf.extractAPIOutput_ESG(response_esg, logger)
-        adf.exportAPIOutput_ESG(path_esg, df_ownfirmoutputs_esg, logger)    
-        
-    """
-    # debug
-    list_loadback = fh.readBinary(path_pickle, "list_responses_climatepds")
-    """
     dtts_finish = datetime.datetime.now()
     fh.closeLog(logger, dtts_begin, dtts_finish) 
-    
-    fh.moveFiles(dict_xlsxmeta['file'],path_intray,path_target)
+    if path_source == path_intray:
+        fh.moveFiles(dict_xlsxmeta['file'],path_intray,path_target)
 
+elif __name__ == '__main__':
+    name_file = fh.findInputFiles(path_source)[-1]
+    path_target, dict_status = ppl.runWorkbook(path_source+"/"+name_file, path_outray, dict_paths, args.workers, 
+                                               path_target=path_target if args.resume is not None else None,
+                                               bool_delta=args.delta, float_tolerance=args.delta_tolerance, str_outputformat=args.output_format,
+                                               int_lossworkers=args.loss_workers)
+    # to debug the flatten / export stages on the responses of this run, without any request: python main.py replay <run folder>
+    if path_source == path_intray:
+        fh.moveFiles(name_file,path_intray,path_target)
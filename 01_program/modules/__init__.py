@@ -0,0 +1,60 @@
+# The modules are a package whose submodules are imported on first access (e.g. modules.pipeline), so that
+# importing the package is cheap and a run only loads the dependencies of what it actually uses. The submodules
+# refer to each other through lazyModule, so that importing one of them (e.g. pipeline) does not load the others.
+import importlib
+import threading
+
+__all__ = [
+    'dataset_writer',
+    'file_handlers',
+    'identifier_index',
+    'input_validation',
+    'moodys_climate_api',
+    'ownfirm_data_formatters',
+    'ownfirm_models',
+    'ownfirm_to_moodys_connectors',
+    'pipeline',
+    'pipeline_metrics',
+    'pipeline_profiler',
+    'reference_store',
+    'run_catalogue',
+    'run_delta',
+    'run_journal',
+    'run_planner',
+    'run_replay',
+    'term_structure_store',
+    'wire_format',
+]
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("."+name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class lazyModule:
+    # stands for a module that is imported on the first access to one of its attributes; the import itself goes
+    # through importlib (and its module locks), so threads touching the module at once all get the same one
+    def __init__(self, name, package=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_package'] = package
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__['_module'] = importlib.import_module(self._name, self._package)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
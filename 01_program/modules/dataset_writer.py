@@ -0,0 +1,86 @@
+import os
+import threading
+import pandas as pd
+from urllib.parse import quote
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Partitioned dataset of the climate PDs (main.py --output-format parquet | csv), written instead of one workbook per
+# entity plus _combined_all.xlsx, under <deliverable folder>/dataset:
+#   scenarioCategory=<..>/RiskType=<..>/Scenario=<..>/part-<NNNNN>.parquet (or .csv)
+# The partition folders are Hive-style (values URL-quoted), so pyarrow, pandas, Spark or DuckDB read only the
+# partitions they filter on; the partition columns are taken from the folder names and are not repeated in the
+# files. The rows of a part are sorted by entityId and year, and parquet row groups hold int_rowgroup rows each, so
+# the entityId statistics of the row groups let readers skip most of a part. A batch run writes part 0 of every
+# partition, a streaming run one part per chunk. The parts are written by a pool of writer threads while the run
+# goes on (e.g. the next chunk is requested and flattened); each part is written to a .tmp file and renamed into place.
+
+list_partitioncols = ['scenarioCategory', 'RiskType', 'Scenario']
+list_sortcols = ['entityId', 'year']
+
+int_defaultwriters = 4
+
+# %%
+def getDatasetFormat(str_format, logger=None):
+    # parquet needs pyarrow (pip install pyarrow); without it the dataset is written as CSV. pyarrow is only looked up
+    # here and imported by the parquet writes, so the other output formats never load it
+    if str_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        logger.warning("-> pyarrow is not installed, the dataset is written as CSV instead of parquet") if logger is not None else None
+        return "csv"
+    return str_format
+
+def openDataset(path_dataset, str_format, int_writers=int_defaultwriters, int_rowgroup=100000, logger=None):
+    # a dataset being written: its folder, format and writer pool; close it with closeDataset
+    return {
+        'path': path_dataset,
+        'format': getDatasetFormat(str_format, logger),
+        'rowgroup': int_rowgroup,
+        'executor': ThreadPoolExecutor(max_workers=max(1, int_writers), thread_name_prefix="dataset"),
+        'futures': [],
+        'lock': threading.Lock(),
+        'files': 0,
+    }
+
+def getPartitionPath(path_dataset, tuple_values):
+    return path_dataset+"/"+"/".join(f"{col}={quote(str(value), safe=' ')}" for col, value in zip(list_partitioncols, tuple_values))
+
+# %%
+def writePartition(dict_dataset, tuple_values, int_part, df_partition):
+    path_partition = getPartitionPath(dict_dataset['path'], tuple_values)
+    os.makedirs(path_partition, exist_ok=True)
+    full_path = f"{path_partition}/part-{int_part:05d}.{dict_dataset['format']}"
+    df = df_partition.drop(columns=list_partitioncols).sort_values(list_sortcols, kind='stable')
+    if dict_dataset['format'] == "parquet":
+        df.to_parquet(full_path+".tmp", engine='pyarrow', index=False, row_group_size=dict_dataset['rowgroup'])
+    else:
+        df.to_csv(full_path+".tmp", index=False)
+    os.replace(full_path+".tmp", full_path)
+    with dict_dataset['lock']:
+        dict_dataset['files'] += 1
+    return full_path
+
+def submitOutputs(dict_dataset, int_part, list_ownfirmoutputs_climatepds):
+    # queue the flattened outputs (extractAPIOutput_ClimatePDs) as part int_part of their partitions; returns the
+    # futures of the writes, so the caller can tell when these rows are on disk
+    list_valid = [df for df in list_ownfirmoutputs_climatepds if df is not None and len(df) > 0]
+    if len(list_valid) == 0:
+        return []
+    df_all = pd.concat(list_valid, ignore_index=True)
+    df_all['entityId'] = df_all['entityId'].astype(str)
+    df_all['year'] = pd.to_numeric(df_all['year']).astype(int)
+    # an entity repeated in the outputs (e.g. one row per facility) is written once
+    df_all = df_all.drop_duplicates(subset=list_partitioncols+list_sortcols)
+
+    list_futures = [dict_dataset['executor'].submit(writePartition, dict_dataset, tuple_values, int_part, df_partition)
+                    for tuple_values, df_partition in df_all.groupby(list_partitioncols, sort=True)]
+    dict_dataset['futures'] += list_futures
+    return list_futures
+
+def closeDataset(dict_dataset):
+    # wait for every write; the first failed write is raised. Returns the number of files written
+    wait(dict_dataset['futures'])
+    dict_dataset['executor'].shutdown()
+    for future in dict_dataset['futures']:
+        if future.exception() is not None:
+            raise future.exception()
+    return dict_dataset['files']
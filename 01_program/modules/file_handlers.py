@@ -3,6 +3,10 @@ import pandas as pd
 import warnings
 import pickle
 import logging
+import logging.handlers
+import queue
+import threading
+import time
 # pip install openpyxl
 
 
@@ -45,19 +49,77 @@ def readXLSX(folder_path):
     
     return dict_meta, dict_sheet
 
+# %%
+def readXLSXFile(file_path):
+    # read every sheet of one workbook
+    filename = os.path.basename(file_path)
+    dict_sheet = readXLSXSheets(file_path, None)
+    dict_meta  = {"name": os.path.splitext(filename)[0], "file": filename}
+    
+    return dict_meta, dict_sheet
+
+def findInputFiles(folder_path):
+    # list the workbooks waiting in the folder, skipping Excel's "~" lock files
+    return sorted(filename for filename in os.listdir(folder_path) 
+                  if filename.endswith('.xlsx') and filename[:1] != "~" and os.path.isfile(os.path.join(folder_path, filename)))
+
+def readXLSXSheets(file_path, list_sheets):
+    # read only the given (small) sheets of a workbook, or all sheets if list_sheets is None
+    dict_sheet = {}
+    warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+    with pd.ExcelFile(file_path) as excel_file:
+        for sheet_name in (list_sheets if list_sheets is not None else excel_file.sheet_names):
+            if sheet_name in excel_file.sheet_names:
+                dict_sheet[sheet_name] = excel_file.parse(sheet_name).apply(nan_to_none).replace(float('nan'), None)
+    
+    return dict_sheet
+
+def iterXLSXChunks(file_path, sheet_name, int_chunksize):
+    # stream a sheet in dataframes of int_chunksize rows, without loading the whole workbook into memory
+    from openpyxl import load_workbook
+    warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        # like pandas, drop trailing unnamed columns and blank (formatted only) rows
+        int_ncols = max([i+1 for i, col in enumerate(header) if col is not None], default=0)
+        list_cols = [col if col is not None else f"Unnamed: {i}" for i, col in enumerate(header[:int_ncols])]
+        
+        list_rows = []
+        for row in rows:
+            row = row[:int_ncols]
+            if all(value is None for value in row):
+                continue
+            list_rows.append(row)
+            if len(list_rows) == int_chunksize:
+                yield pd.DataFrame(list_rows, columns=list_cols).apply(nan_to_none).replace(float('nan'), None)
+                list_rows = []
+        if list_rows:
+            yield pd.DataFrame(list_rows, columns=list_cols).apply(nan_to_none).replace(float('nan'), None)
+    finally:
+        workbook.close()
+
 # %%
 def createFolder(root_path=None, target_folder=None, ts=None):
     if target_folder is not None and ts is not None:
-        full_path = root_path+"/"+target_folder+"_"+ts.strftime("%Y%m%d_%H%M%S")
-        # Use the os.makedirs() function to create the folder and its parent directories if they don't exist
-        os.makedirs(full_path)
-        return full_path, target_folder+"_"+ts.strftime("%Y%m%d_%H%M%S")
+        # runs started within the same second (e.g. two jobs of the same workbook) get a suffix: <name>_2, <name>_3 ...
+        str_folder = target_folder+"_"+ts.strftime("%Y%m%d_%H%M%S")
+        str_name, int_suffix = str_folder, 1
+        while True:
+            try:
+                # Use the os.makedirs() function to create the folder and its parent directories if they don't exist
+                os.makedirs(root_path+"/"+str_name)
+                return root_path+"/"+str_name, str_name
+            except FileExistsError:
+                int_suffix += 1
+                str_name = f"{str_folder}_{int_suffix}"
     
     elif root_path is not None and target_folder is None and ts is None:
-        if os.path.exists(root_path):
-            None
-        else: 
-            os.makedirs(root_path)
+        # exist_ok as concurrent deliverables may create the same folder
+        os.makedirs(root_path, exist_ok=True)
             
         return root_path
     else:
@@ -75,6 +137,32 @@ def readBinary(path, name):
     with open(f"{path}/{name}.pkl", 'rb') as file:
         return pickle.load(file)    
 
+def writePart(path, name, int_part, df):
+    # write one chunk of a dataset as <path>/<name>/part-NNNNN.csv; the file is renamed into place and synced,
+    # so a part either exists completely or not at all
+    path_parts = createFolder(f"{path}/{name}")
+    full_path = f"{path_parts}/part-{int_part:05d}.csv"
+    with open(full_path+".tmp", 'w', newline='', encoding='utf-8') as file:
+        df.to_csv(file, index=False)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(full_path+".tmp", full_path)
+    return full_path
+
+def iterParts(path, name, usecols=None):
+    # the parts of a dataset one at a time, in the order of the chunks
+    path_parts = f"{path}/{name}"
+    if not os.path.exists(path_parts):
+        return
+    for filename in sorted(filename for filename in os.listdir(path_parts) if filename.endswith('.csv')):
+        yield pd.read_csv(f"{path_parts}/{filename}", usecols=usecols)
+
+def readParts(path, name, usecols=None):
+    list_parts = list(iterParts(path, name, usecols))
+    if len(list_parts) == 0:
+        return None
+    return pd.concat(list_parts, ignore_index=True)
+
 # %%
 def moveFiles(filename, src_path, dest_path):
     rs = False
@@ -88,26 +176,88 @@ def moveFiles(filename, src_path, dest_path):
 
     return rs
 
+def moveFile(filename, src_path, dest_path):
+    # move a single file, leaving anything else in src_path untouched
+    os.rename(os.path.join(src_path, filename), os.path.join(dest_path, filename))
+    return True
+
 # %%
-def createLog(log_path, log_name):
+def createLog(log_path, log_name, bool_isolated=False, bool_queued=False):
     # create a log file
     st_log = log_path+"/"+log_name+'.log'
-    logging.basicConfig(
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        level=logging.INFO, 
-        force=True, 
-        filename=st_log
-    )
+    str_format = '%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'
+    str_datefmt = '%Y-%m-%d %H:%M:%S'
+    
+    handler = logging.FileHandler(st_log)
+    handler.setFormatter(logging.Formatter(str_format, datefmt=str_datefmt))
+    if bool_queued:
+        # the calling threads only put the records on a queue; a background listener thread formats them
+        # and writes the file, so the file lock and the disk I/O are out of the request / flatten loops
+        queue_log = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(queue_log, handler, respect_handler_level=True)
+        listener.start()
+        handler = logging.handlers.QueueHandler(queue_log)
+        # the time, level and thread name are kept on the record, only the message is merged here
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.listener = listener
+    
+    if bool_isolated:
+        # a logger of its own instead of the root logger, so that concurrent runs each log to their own file
+        logger = logging.getLogger(log_name)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+    else:
+        logging.basicConfig(
+            level=logging.INFO, 
+            force=True, 
+            handlers=[handler]
+        )
+        logger = logging.getLogger() 
         
-    logger = logging.getLogger() 
     logger.info(f"Process is Started; log file of {log_name} is created")
 
     return logger
 
+# Rate-limited progress messages for hot loops: per logger and task, at most one message every
+# float_interval seconds plus the final one, instead of one message per iteration.
+lock_progress = threading.Lock()
+dict_progress = {}
+
+def logProgress(logger, str_task, int_done, int_total, float_interval=5.0):
+    if logger is None:
+        return None
+    key = (logger.name, str_task)
+    float_now = time.monotonic()
+    with lock_progress:
+        if int_done < int_total:
+            if float_now - dict_progress.get(key, float('-inf')) < float_interval:
+                return None
+            dict_progress[key] = float_now
+        else:
+            dict_progress.pop(key, None)
+    logger.info(f"-> {str_task}: {int_done} of Total {int_total}")
+
 #%%
 def closeLog(logger, dtts_begin, dtts_finish):
     dtts_diff = (dtts_finish-dtts_begin).total_seconds()/60
     logger.info(f"Process is Completed, total processing time (in min.): {dtts_diff}")
     
+    # queued mode: let the listener write out the remaining records before the file is closed
+    list_filehandlers = []
+    for handler in logger.handlers:
+        if getattr(handler, 'listener', None) is not None:
+            handler.listener.stop()
+            list_filehandlers += handler.listener.handlers
+            handler.listener = None
+    
+    if logger is not logging.getLogger():
+        # isolated logger: close its own file only, other runs may still be logging; the logger is then dropped
+        # from the logging registry, which would otherwise keep one logger per run of a long-running service
+        for handler in list(logger.handlers)+list_filehandlers:
+            handler.close()
+            logger.removeHandler(handler)
+        logging.Logger.manager.loggerDict.pop(logger.name, None)
+        return None
+    
     return logging.shutdown()
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import datetime
+import threading
+import pandas as pd
+
+# Local index of entity identifiers (pid, ISIN, LEI, BvD, Orbis ...) -> EDF-X entityId, shared by all runs (SQLite):
+#   identifiers - identifier, entityId (NULL when the mapping endpoint did not resolve it), internationalName, checked
+# Every identifier returned by the mapping endpoint is indexed, not only the one that was queried. Unresolved
+# identifiers are cached as well and only queried again once they are older than int_negativedays, so that e.g.
+# newly listed firms get picked up.
+
+lock_index = threading.Lock()
+
+str_schema = """
+CREATE TABLE IF NOT EXISTS identifiers (
+    identifier        TEXT NOT NULL PRIMARY KEY,
+    entityId          TEXT,
+    internationalName TEXT,
+    checked           TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_identifiers_entityid ON identifiers (entityId);
+"""
+
+# %%
+def openIndex(path_index):
+    os.makedirs(os.path.dirname(path_index), exist_ok=True)
+    conn = sqlite3.connect(path_index, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(str_schema)
+    return conn
+
+def queryIdentifiers(conn, list_identifiers):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS queried (identifier TEXT NOT NULL PRIMARY KEY)")
+    conn.execute("DELETE FROM queried")
+    conn.executemany("INSERT OR IGNORE INTO queried VALUES (?)", [(identifier,) for identifier in list_identifiers])
+    return conn.execute("SELECT i.identifier, i.entityId, i.checked FROM queried q JOIN identifiers i ON i.identifier = q.identifier").fetchall()
+
+# %%
+def findUnknownIdentifiers(path_index, list_identifiers, int_negativedays=7):
+    # identifiers to send to the mapping endpoint: never checked, or unresolved and checked too long ago
+    str_expiry = (datetime.datetime.now()-datetime.timedelta(days=int_negativedays)).strftime("%Y-%m-%d %H:%M:%S")
+    conn = openIndex(path_index)
+    try:
+        set_known = {identifier for identifier, entityid, checked in queryIdentifiers(conn, list_identifiers)
+                     if entityid is not None or checked >= str_expiry}
+    finally:
+        conn.close()
+
+    return [identifier for identifier in dict.fromkeys(list_identifiers) if identifier not in set_known]
+
+def storeMappings(path_index, list_queried, df_entities):
+    # df_entities: the entities of the mapping responses (extractAPIOutput_Entity); a queried identifier found
+    # in none of their identifier columns is stored as unresolved
+    str_checked = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    dict_rows = {identifier: (identifier, None, None, str_checked) for identifier in list_queried}
+    if df_entities is not None and len(df_entities) > 0:
+        list_idcols = [col for col in df_entities.columns if col in ('entityId', 'pid') or col.startswith('identifier')]
+        for record in df_entities.to_dict('records'):
+            for col in list_idcols:
+                if record.get(col) is not None and not pd.isna(record[col]) and str(record[col]) != "":
+                    dict_rows[str(record[col])] = (str(record[col]), str(record['entityId']), record.get('internationalName'), str_checked)
+
+    with lock_index:
+        conn = openIndex(path_index)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO identifiers VALUES (?,?,?,?)", dict_rows.values())
+        finally:
+            conn.close()
+
+    return len(dict_rows)
+
+def lookupIdentifiers(path_index, list_identifiers):
+    # identifier -> entityId (None when known to be unresolvable); identifiers that were never checked are left out
+    conn = openIndex(path_index)
+    try:
+        return {identifier: entityid for identifier, entityid, checked in queryIdentifiers(conn, list_identifiers)}
+    finally:
+        conn.close()
@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+# Pre-flight validation of the workbook, run before any request is sent. Every rule is checked on whole columns
+# at once (no per-row Python), so that a large Input Table is validated in a moment.
+# The rules follow the Input Guideline sheet of the template. A field is only checked for the enabled deliverables
+# that send it, and a row breaking a rule is only taken out of those deliverables: e.g. a bad ESG field leaves the
+# climate PDs of the row alone. Public firms only send their entityId to the EDF-X endpoints (every deliverable but
+# esg), so their other fields are only checked for esg. Rows taken out of any deliverable are listed, with the
+# reasons and the deliverables they are left out of, in the reject report.
+
+# deliverable (as in the task graph of pipeline.py) -> Deliverables Control flag
+dict_deliverables = {
+    'climatePDs':        'Retrieve Climate Adjusted PDs',
+    'transRiskIndustry': 'Retrieve Transition Risk Drivers for Industry (Sector)',
+    'transRiskRegion':   'Retrieve Transition Risk Drivers for Country (Region)',
+    'reports':           'Access Pre-defined reports',
+    'esg':               'Request ESG Score Predictor',
+}
+# the entity inputs of the climate PD and report requests (see adf.prepareCoreAPIInputs)
+tuple_core = ('climatePDs', 'reports')
+
+list_ratings = ['Aaa', 'Aa1', 'Aa2', 'Aa3', 'A1', 'A2', 'A3', 'Baa1', 'Baa2', 'Baa3', 'Ba1', 'Ba2', 'Ba3',
+                'B1', 'B2', 'B3', 'Caa1', 'Caa2', 'Caa3', 'Ca', 'C']
+
+# field -> (deliverables sending it, required for Public, required for Private, rule); rules:
+#   ('enum', values) | ('number', min, max) | ('integer', min, max) | ('weight',) | ('date',) | ('regex', pattern)
+dict_fieldrules = {
+    'entityName':             (tuple_core, False, True,  None),
+    'primaryCountry':         (tuple_core+('transRiskRegion',), False, True,  ('regex', r"[A-Z]{3}")),
+    'countryWeight':          (tuple_core, False, False, ('weight',)),
+    'EDF-XIndustryClass':     (tuple_core+('transRiskIndustry', 'transRiskRegion'), False, True,  ('enum', ['GCAM', 'NDY', 'SIC'])),
+    'EDF-XIndustryCode':      (tuple_core+('transRiskIndustry', 'transRiskRegion'), False, True,  None),
+    'EDF-XIndustryWeight':    (tuple_core, False, False, ('weight',)),
+    # PD above 1 is capped to 1 when the request is built
+    'PD':                     (tuple_core, False, False, ('number', 0, None)),
+    'impliedRating':          (tuple_core, False, False, ('enum', list_ratings)),
+    'financialStatementDate': (tuple_core, False, False, ('date',)),
+    'asOfDate':               (tuple_core, False, False, ('date',)),
+    'netSales':               (tuple_core, False, False, ('number', None, None)),
+    'totalAssets':            (tuple_core, False, False, ('number', 0, None)),
+    'regionClassification':   (('esg',), True,  True,  ('enum', ['NUTS', 'ISO'])),
+    'regionCode':             (('esg',), True,  True,  None),
+    'ESGIndustryClass':       (('esg',), False, False, ('enum', ['NACE'])),
+    'ESGIndustryCode':        (('esg',), False, False, None),
+    'periodYear':             (('esg',), False, False, ('integer', 2012, None)),
+    'employeeCount':          (('esg',), False, False, ('integer', 0, None)),
+    'assetTurnover':          (('esg',), False, False, ('number', 0, None)),
+    'ESGtotalAssets':         (('esg',), False, False, ('number', 0, None)),
+    'carbonIntensity':        (('esg',), False, False, ('enum', ['High', 'Mixed', 'Low'])),
+}
+
+# Climate Adjusted PD properties: parameter -> (rule, required)
+dict_propertyrules = {
+    'asyncResponse':          ('boolean', True),
+    'scenarioCategory':       ('text', True),
+    'transition':             ('boolean', False),
+    'physical':               ('boolean', False),
+    'combined':               ('boolean', False),
+    'resultDetailMain':       ('boolean', False),
+    'resultDetailTransition': ('boolean', False),
+}
+
+# %%
+def isBlank(sr):
+    # None, NaN and empty / whitespace-only strings
+    return sr.isna() | sr.astype(str).str.strip().eq('')
+
+def checkRule(sr, rule):
+    # True where a (non-blank) value breaks the rule
+    if rule[0] == 'enum':
+        return ~sr.isin(rule[1])
+    if rule[0] == 'regex':
+        return ~sr.astype(str).str.fullmatch(rule[1])
+    if rule[0] == 'date':
+        # Excel dates arrive as datetimes, text dates are sent as their first 10 characters (YYYY-MM-DD); the text
+        # of a datetime starts with its YYYY-MM-DD as well, that of a number does not
+        if pd.api.types.is_datetime64_any_dtype(sr):
+            return pd.Series(False, index=sr.index)
+        return pd.to_datetime(sr.astype(str).str[:10], format="%Y-%m-%d", errors='coerce').isna()
+
+    sr_number = pd.to_numeric(sr, errors='coerce')
+    bool_invalid = sr_number.isna()
+    if rule[0] == 'weight':
+        return bool_invalid | (sr_number != 1)
+    if rule[0] == 'integer':
+        bool_invalid |= sr_number.mod(1).ne(0)
+    if rule[1] is not None:
+        bool_invalid |= sr_number < rule[1]
+    if rule[2] is not None:
+        bool_invalid |= sr_number > rule[2]
+    return bool_invalid
+
+def describeRule(rule):
+    if rule[0] == 'enum':
+        return f"not one of {', '.join(rule[1])}"
+    if rule[0] == 'regex':
+        return "not a three-letter ISO code"
+    if rule[0] == 'date':
+        return "not a date (YYYY-MM-DD)"
+    if rule[0] == 'weight':
+        return "not 1"
+    str_rule = "not a number" if rule[0] == 'number' else "not a whole number"
+    if rule[1] is not None or rule[2] is not None:
+        str_rule += f" in [{rule[1] if rule[1] is not None else '-inf'}, {rule[2] if rule[2] is not None else 'inf'}]"
+    return str_rule
+
+# %%
+def validateInputTable(df_inputtable, dict_dcontrol, int_rowoffset=0):
+    # returns the rows valid for at least one enabled deliverable, the rows left out of any of them and, per enabled
+    # deliverable, the index of its valid rows. The rejected rows get their row number in the sheet (rowNo, from the
+    # index of the rows as read, after int_rowoffset rows of earlier chunks), the broken rules (rejectReasons) and
+    # the deliverables they are left out of (excludedFrom)
+    list_enabled = [name for name, flag in dict_deliverables.items() if dict_dcontrol.get(flag) == 'ENABLE']
+
+    df = df_inputtable.reset_index(drop=True)
+    # issue -> (rows, deliverables it takes the rows out of)
+    dict_issues = {}
+    def addIssue(str_issue, bool_issue, tuple_deliverables):
+        bool_prev = dict_issues[str_issue][0] if str_issue in dict_issues else False
+        dict_issues[str_issue] = (bool_prev | pd.Series(bool_issue, index=df.index), tuple_deliverables)
+
+    if 'firmStatus' in df.columns:
+        bool_statusblank = isBlank(df['firmStatus'])
+        addIssue('firmStatus is not Public or Private', ~bool_statusblank & ~df['firmStatus'].isin(['Public', 'Private']), tuple(list_enabled))
+        # a blank firmStatus is taken as Private
+        bool_public = df['firmStatus'].eq('Public').to_numpy()
+    else:
+        bool_public = np.zeros(len(df), dtype=bool)
+
+    for field, (tuple_deliverables, bool_reqpublic, bool_reqprivate, rule) in dict_fieldrules.items():
+        tuple_deliverables = tuple(x for x in tuple_deliverables if x in list_enabled)
+        if len(tuple_deliverables) == 0:
+            continue
+        # totalAssets is sent to both APIs
+        str_column = 'totalAssets' if field == 'ESGtotalAssets' else field
+        # Public firms only send their entityId to the EDF-X endpoints
+        bool_used = ~bool_public if tuple_deliverables != ('esg',) else np.ones(len(df), dtype=bool)
+        if str_column not in df.columns:
+            if bool_reqpublic or bool_reqprivate:
+                addIssue(f"{str_column} is missing", (bool_used & bool_public & bool_reqpublic) | (bool_used & ~bool_public & bool_reqprivate), tuple_deliverables)
+            continue
+
+        bool_blank = isBlank(df[str_column])
+        bool_required = np.where(bool_public, bool_reqpublic, bool_reqprivate)
+        addIssue(f"{str_column} is missing", bool_used & bool_required & bool_blank, tuple_deliverables)
+        if rule is not None:
+            addIssue(f"{str_column} is {describeRule(rule)}", bool_used & ~bool_blank & checkRule(df[str_column], rule), tuple_deliverables)
+
+    tuple_coreenabled = tuple(x for x in tuple_core if x in list_enabled)
+    if len(tuple_coreenabled) > 0:
+        # only one of PD and impliedRating is required for private firms
+        bool_nopd = isBlank(df['PD']) if 'PD' in df.columns else True
+        bool_norating = isBlank(df['impliedRating']) if 'impliedRating' in df.columns else True
+        addIssue("PD and impliedRating are both missing", pd.Series(~bool_public, index=df.index) & bool_nopd & bool_norating, tuple_coreenabled)
+
+    df_issues = pd.DataFrame({str_issue: bool_issue for str_issue, (bool_issue, tuple_deliverables) in dict_issues.items()}, index=df.index).fillna(False).astype(bool)
+    # rows left out of each deliverable: those with an issue of that deliverable
+    df_excluded = pd.DataFrame({name: np.zeros(len(df), dtype=bool) for name in list_enabled}, index=df.index)
+    for str_issue, (bool_issue, tuple_deliverables) in dict_issues.items():
+        for name in tuple_deliverables:
+            df_excluded[name] |= df_issues[str_issue].to_numpy()
+    bool_rejected = df_excluded.any(axis=1).to_numpy()
+    bool_valid = ~df_excluded.all(axis=1).to_numpy() if len(list_enabled) > 0 else np.ones(len(df), dtype=bool)
+    dict_validrows = {name: df_inputtable.index[~df_excluded[name].to_numpy()] for name in list_enabled}
+
+    df_rejected = df_inputtable[bool_rejected].copy()
+    # the header is row 1 of the sheet
+    df_rejected.insert(0, 'rowNo', df_rejected.index+int_rowoffset+2)
+    # issue text of each rejected row: True * "text; " keeps the text, False * "text; " is ""
+    df_rejected.insert(1, 'rejectReasons', df_issues[bool_rejected].dot(df_issues.columns+"; ").str.rstrip("; ").to_numpy() if len(df_issues.columns) > 0 else "")
+    df_rejected.insert(2, 'excludedFrom', df_excluded[bool_rejected].dot(df_excluded.columns+", ").str.rstrip(", ").to_numpy() if len(list_enabled) > 0 else "")
+
+    return df_inputtable[bool_valid], df_rejected, dict_validrows
+
+def validateCPDProperties(df_cpdproperties, dict_dcontrol):
+    # list of the problems of the Climate Adjusted PD properties sheet; any of them stops the run
+    dict_properties = df_cpdproperties.set_index('Parameter')['Value'].to_dict()
+    list_issues = []
+    for str_parameter, (str_rule, bool_required) in dict_propertyrules.items():
+        value = dict_properties.get(str_parameter)
+        if value is None or (isinstance(value, float) and np.isnan(value)) or str(value).strip() == '':
+            list_issues.append(f"{str_parameter} is missing") if bool_required else None
+        elif str_rule == 'boolean' and not isinstance(value, (bool, np.bool_)):
+            list_issues.append(f"{str_parameter} is not TRUE or FALSE: {value!r}")
+        elif str_rule == 'text' and not isinstance(value, str):
+            list_issues.append(f"{str_parameter} is not a text: {value!r}")
+    if dict_dcontrol.get('Retrieve Climate Adjusted PDs') == 'ENABLE' and not any(dict_properties.get(x) is True for x in ('transition', 'physical', 'combined')):
+        list_issues.append("none of transition, physical and combined is TRUE")
+
+    return list_issues
@@ -90,27 +90,210 @@ it provides means for analyzing physical and transition risks’ impact on publi
      
 """
 # %%
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import json
 import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import pipeline_metrics as pm
+from . import wire_format as wf
 
 
 # %%
 # Calculate the path to the `config.json` file in the parent directory
 config_path = Path(__file__).resolve().parent.parent / "config.json"
-if not config_path.exists():
-    raise FileNotFoundError(f"Config file not found: {config_path}")
 
-# Load the JSON configuration
-with open(config_path, "r") as f:
-    config = json.load(f)
-
-dict_auth = config.get("auth", {})
-if not dict_auth:
-    raise KeyError("Missing 'auth' section in config.json")
-# Now `dict_auth` contains dynamically loaded clientId, clientSecret, and URL
+# config.json is only read when it is first needed (i.e. by the first API call), not at import time
+lock_config = threading.Lock()
+dict_config = {}
+
+def getConfig(section=None):
+    with lock_config:
+        if 'config' not in dict_config:
+            if not config_path.exists():
+                raise FileNotFoundError(f"Config file not found: {config_path}")
+            # Load the JSON configuration
+            with open(config_path, "r") as f:
+                dict_config['config'] = json.load(f)
+    
+    config = dict_config['config']
+    return config if section is None else config.get(section, {})
+
+def getDictAuth():
+    dict_auth = getConfig("auth")
+    if not dict_auth:
+        raise KeyError("Missing 'auth' section in config.json")
+    # `dict_auth` contains dynamically loaded clientId, clientSecret, and URL
+    return dict_auth
+
+# Optional "client" section: limits shared by every thread of a run
+#   maxConcurrency - max. number of HTTP calls in flight at the same time
+#   poolSize       - max. number of keep-alive connections per host
+#   maxQueryLength - max. length of the query string of a transition risk GET (longer code lists are sharded)
+#   gzipRequests   - endpoints (e.g. ["climate_pds_TPC", "ESG"]) whose POST bodies are sent gzip-compressed;
+#                    only for endpoints known to accept Content-Encoding: gzip, none by default
+#   gzipMinBytes   - smallest body that is compressed (default 1024)
+#   reportWorkers, reportUrlTTL, reportUrlMargin - scheduling of the report downloads, see ownfirm_to_moodys_connectors.py
+#   esgBatchSize, esgWorkers, esgRetries - batching of the ESG Score Predictor records, see ownfirm_to_moodys_connectors.py
+#   timeouts       - read timeout in seconds per endpoint, e.g. {"default": 300, "climate_pds_TPC": 600}
+#   connectTimeout - connect timeout in seconds of every call (default 10)
+#   hedgeRequests  - GET endpoints hedged, with the seconds after which the duplicate is sent,
+#                    e.g. {"industry_T": 10, "region_T": 10, "process_status": 5}; none by default
+#   breakerFailures, breakerCooldown - circuit breaker of each endpoint, see sendRequest (defaults 5 and 30 s;
+#                    0 failures disables the breakers)
+#   processTimeout - seconds an asynchronous process is polled for before it is given up (default 3600)
+# One session (i.e. one connection pool) and one token for the whole process, shared by all threads;
+# both are created on first use.
+lock_client = threading.Lock()
+dict_clientstate = {}
+lock_token = threading.Lock()
+dict_tokencache = {}
+
+def getClient():
+    with lock_client:
+        if 'session' not in dict_clientstate:
+            dict_client = getConfig("client")
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=dict_client.get("poolSize", 16)))
+            dict_clientstate['session'] = session
+            dict_clientstate['semaphore'] = threading.BoundedSemaphore(dict_client.get("maxConcurrency", 8))
+    
+    return dict_clientstate['session'], dict_clientstate['semaphore']
+
+class CircuitOpenError(requests.ConnectionError):
+    # raised instead of sending a request to an endpoint whose circuit breaker is open
+    pass
+
+# Circuit breaker of each endpoint. After breakerFailures failures in a row (connection error, timeout, 429 or 5xx)
+# the breaker opens: no request is sent to the endpoint, and the requests arriving are held (dispatch is paused)
+# until breakerCooldown seconds have passed. Then a single probe request is sent (half-open): if it succeeds the
+# breaker closes and the held requests go ahead; if it fails the breaker opens again and the held requests fail
+# fast with CircuitOpenError instead of each waiting for its own timeout.
+lock_breakers = threading.Condition()
+dict_breakers = {}
+
+def acquireBreaker(str_endpoint):
+    # returns True if the caller is the probe of a half-open breaker
+    dict_client = getConfig("client")
+    if int(dict_client.get("breakerFailures", 5)) <= 0:
+        return False
+    float_cooldown = float(dict_client.get("breakerCooldown", 30))
+    with lock_breakers:
+        dict_breaker = dict_breakers.setdefault(str_endpoint, {'state': 'closed', 'failures': 0, 'opened': 0.0, 'generation': 0})
+        int_generation = None
+        while dict_breaker['state'] != 'closed':
+            if int_generation is not None and dict_breaker['generation'] != int_generation:
+                raise CircuitOpenError(f"Circuit breaker of {str_endpoint} is open")
+            int_generation = dict_breaker['generation']
+            float_wait = dict_breaker['opened']+float_cooldown-time.time()
+            if dict_breaker['state'] == 'open' and float_wait <= 0:
+                dict_breaker['state'] = 'half_open'
+                pm.setBreakerState(str_endpoint, 'half_open')
+                return True
+            lock_breakers.wait(timeout=float_wait if dict_breaker['state'] == 'open' else None)
+    return False
+
+def releaseBreaker(str_endpoint, bool_success, bool_probe):
+    dict_client = getConfig("client")
+    int_failures = int(dict_client.get("breakerFailures", 5))
+    if int_failures <= 0:
+        return None
+    with lock_breakers:
+        dict_breaker = dict_breakers[str_endpoint]
+        if bool_success:
+            dict_breaker['failures'] = 0
+            if bool_probe:
+                dict_breaker['state'] = 'closed'
+                pm.setBreakerState(str_endpoint, 'closed')
+                lock_breakers.notify_all()
+            return None
+        dict_breaker['failures'] += 1
+        if bool_probe or (dict_breaker['state'] == 'closed' and dict_breaker['failures'] >= int_failures):
+            dict_breaker['state'] = 'open'
+            dict_breaker['opened'] = time.time()
+            dict_breaker['generation'] += 1
+            pm.setBreakerState(str_endpoint, 'open')
+            lock_breakers.notify_all()
+
+# Hedged requests: a GET of an endpoint listed in hedgeRequests that has not answered after its delay is sent a
+# second time, and the first of the two answers is used; the other one is left to finish and discarded.
+lock_hedges = threading.Lock()
+dict_hedgestate = {}
+
+def getHedgeExecutor():
+    with lock_hedges:
+        if 'executor' not in dict_hedgestate:
+            dict_hedgestate['executor'] = ThreadPoolExecutor(max_workers=2*getConfig("client").get("maxConcurrency", 8), thread_name_prefix="hedge")
+    return dict_hedgestate['executor']
+
+def sendHedged(str_endpoint, float_delay, method, url, **kwargs):
+    executor = getHedgeExecutor()
+    future_first = executor.submit(pm.bindRun(performRequest), str_endpoint, method, url, **kwargs)
+    set_done, set_pending = wait([future_first], timeout=float_delay)
+    if len(set_done) > 0:
+        return future_first.result()
+    future_hedge = executor.submit(pm.bindRun(performRequest), str_endpoint, method, url, **kwargs)
+    pm.countHedge(str_endpoint)
+    set_pending = {future_first, future_hedge}
+    while len(set_pending) > 0:
+        set_done, set_pending = wait(set_pending, return_when=FIRST_COMPLETED)
+        for future in set_done:
+            if future.exception() is None:
+                pm.countHedge(str_endpoint, bool_won=True) if future is future_hedge else None
+                return future.result()
+    # both failed: the error of the first request
+    return future_first.result()
+
+def getTimeout(str_endpoint):
+    # (connect, read) timeout of the endpoint
+    dict_client = getConfig("client")
+    dict_timeouts = dict_client.get("timeouts", {})
+    return (float(dict_client.get("connectTimeout", 10)), float(dict_timeouts.get(str_endpoint, dict_timeouts.get("default", 300))))
+
+def sendRequest(str_endpoint, method, url, **kwargs):
+    # every HTTP call of the module goes through here: it is bounded by the endpoint's timeout, hedged if it is a
+    # GET listed in hedgeRequests, and held or failed fast by the endpoint's circuit breaker
+    kwargs.setdefault('timeout', getTimeout(str_endpoint))
+    float_hedge = getConfig("client").get("hedgeRequests", {}).get(str_endpoint) if method == "GET" else None
+    bool_probe = acquireBreaker(str_endpoint)
+    try:
+        # a probe is sent once only
+        if float_hedge is not None and not bool_probe:
+            response = sendHedged(str_endpoint, float(float_hedge), method, url, **kwargs)
+        else:
+            response = performRequest(str_endpoint, method, url, **kwargs)
+    except Exception:
+        releaseBreaker(str_endpoint, False, bool_probe)
+        raise
+    releaseBreaker(str_endpoint, response.status_code != 429 and response.status_code < 500, bool_probe)
+    return response
+
+def performRequest(str_endpoint, method, url, **kwargs):
+    # one HTTP call, throttled by the shared semaphore; its latency, status code and size are recorded per
+    # endpoint in the pipeline metrics
+    session, semaphore_requests = getClient()
+    with semaphore_requests:
+        pm.addGauge("requests_in_flight", 1)
+        dtts_begin = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            pm.observeRequest(str_endpoint, time.perf_counter()-dtts_begin, "error", 0)
+            raise
+        finally:
+            pm.addGauge("requests_in_flight", -1)
+    pm.observeRequest(str_endpoint, time.perf_counter()-dtts_begin, response.status_code, len(response.content), getWireBytes(response))
+    return response
+
+def getWireBytes(response):
+    # bytes read from the socket, i.e. before requests decompressed the body (None if not known)
+    try:
+        int_wirebytes = response.raw.tell()
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return int_wirebytes if isinstance(int_wirebytes, int) and int_wirebytes > 0 else None
 
 """
 The EDF-X API Climate 
@@ -137,13 +320,27 @@ dict_ESG_EDFX = {
 }
 
 # %%
-def getAuth():
+def getAuth(bool_refresh=False):
     # descriptions of response status code 
     # 200	OK - User Authenticated
     # 401	Unauthorized - Provided credentials are not valid
     # 4XX	Parameter Request Error - The request parameters are incorrect
     # 5XX	Server Error - A problem has been found with the system
     
+    # the token is cached and shared until shortly before it expires
+    with lock_token:
+        if not bool_refresh and dict_tokencache.get('expiry', 0) > time.time():
+            return 200, dict_tokencache['token']
+        
+        rs, dict_token = requestAuth()
+        if rs == 200:
+            dict_tokencache['token'] = dict_token
+            dict_tokencache['expiry'] = time.time() + float(dict_token.get('expires_in', 3600)) - 60
+        
+    return rs, dict_token
+
+def requestAuth():
+    dict_auth = getDictAuth()
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
         'Accept': 'application/json'
@@ -156,10 +353,10 @@ def getAuth():
     }
     
     dict_token = {}
-    response = requests.post(dict_auth['URL'], headers=headers, data=data)
+    response = sendRequest("auth", "POST", dict_auth['URL'], headers=headers, data=data)
     rs = response.status_code
     if rs == 200:
-        dict_token = json.loads(response.text)
+        dict_token = wf.loadsResponse(response)
     else:
         print(f"Moody's Authentication failed with status code: {rs}")
     
@@ -199,47 +396,63 @@ def getResponse(dict_token, info_type, json_data):
     
     if method == "POST":
         header = {"Authorization": "Bearer "+dict_token['id_token'],"Content-Type":"application/json"} 
-        response = requests.post(url=url, headers=header, data=json_data)
+        # json_data: the payload serialised by wf.encodeJSON (or any JSON text)
+        bytes_json = json_data.encode('utf-8') if isinstance(json_data, str) else json_data
+        bytes_body = bytes_json
+        dict_client = getConfig("client")
+        if info_type in dict_client.get("gzipRequests", []):
+            bytes_body, bool_gzip = wf.compressBody(bytes_json, dict_client.get("gzipMinBytes", 1024))
+            if bool_gzip:
+                header["Content-Encoding"] = "gzip"
+        pm.observeRequestBody(info_type, len(bytes_json), len(bytes_body), wf.getIndentedBytes(bytes_json))
+        response = sendRequest(info_type, method, url=url, headers=header, data=bytes_body)
     else:
         header = {"Authorization": "Bearer "+dict_token['id_token']} 
-        response = requests.get(url=url, headers=header, params=json_data)
+        response = sendRequest(info_type, method, url=url, headers=header, params=json_data)
     rs = response.status_code
     
     return rs, response
 
 # %%
 def getDownloadLink(url):
-    response = requests.get(url, verify=False)
+    response = sendRequest("download", "GET", url, verify=False)
     return response.status_code, response
 
 # %%
 def getProcessResult(dict_token, pid):
-    
+    # polls the status of the process until it is completed or errored; raises requests.Timeout if it is neither
+    # after processTimeout seconds
     header = {"Authorization": "Bearer "+dict_token['id_token']} #do not add content-type
     url_status = dict_ESG_EDFX["URL_EDFX"][0]+dict_ESG_EDFX['process_Id'][0]+"/"+pid+"/status"
+    float_deadline = time.monotonic()+float(getConfig("client").get("processTimeout", 3600))
 
     rs = 000
     rs_data = None
     while True:
-        response = requests.get(url=url_status, headers=header)
-        status = response.json()["status"]
+        response = sendRequest("process_status", "GET", url=url_status, headers=header)
+        status = wf.loadsResponse(response)["status"]
         if status == "Errored":
             rs = 500
             break
         elif status == "Completed":
             url_files = dict_ESG_EDFX["URL_EDFX"][0]+dict_ESG_EDFX['process_Id'][0]+"/"+pid+"/files"
-            res = requests.get(url=url_files, headers=header)
-            dl_url = res.json()["downloadLink"]
+            res = sendRequest("process_files", "GET", url=url_files, headers=header)
+            dl_url = wf.loadsResponse(res)["downloadLink"]
             rs, rs_data = getDownloadLink(url=dl_url)
             break
+        elif time.monotonic() >= float_deadline:
+            raise requests.Timeout(f"Process {pid} is still {status} after the processTimeout")
         else:
-            time.sleep(5)
+            # each further status poll is counted as a retry of the endpoint
+            pm.countRetry("process_status")
+            time.sleep(max(0, min(5, float_deadline-time.monotonic())))
             
     return rs, rs_data
 
 # %%
-# --- debug ---
+# --- debug: run from 01_program as python -m modules.moodys_climate_api ---
 if __name__ == '__main__':
+    import pandas as pd
     
     # test case 1 
     # ----------------------------------------------------------------
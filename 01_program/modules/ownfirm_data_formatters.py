@@ -1,6 +1,9 @@
 import pandas as pd
-import pandasql as psql
-# pip install pandasql
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from . import file_handlers as fh
+from . import wire_format as wf
 
 # %%
 def num_to_str(var):
@@ -53,22 +56,68 @@ def getDeliverableControl(dict_df):
 def genAPIInput_Entity(df_inputtable):
     # generate json to check Entity in Moodys API, public firms would not be missing value.
     data = {"queries": [{"pid": pid} for pid in df_inputtable['entityId']]}
-    json_str = str(data).replace("'", '"')
+    json_str = wf.encodeJSON(data).decode('utf-8')
     return json_str
     
 # %%
 def extractAPIOutput_Entity(api_response):
+    json_data = wf.loadsResponse(api_response)
     dict_apioutput = { 
-        'count':api_response.json()['total'],
+        'count':json_data['total'],
         'data': None
     }
     if api_response.status_code == 200 and dict_apioutput['count'] > 0:
-        df = pd.json_normalize(api_response.json(), record_path="entities")
+        df = pd.json_normalize(json_data, record_path="entities")
         dict_apioutput['data'] = df
     return dict_apioutput
 
+# %%
+def exportUnresolvedEntities(path_export, df_unresolved, logger):
+    logger.info("Begin to export the rows whose identifier could not be mapped to an entity ID ...") if logger is not None else None 
+    
+    if df_unresolved is not None and len(df_unresolved) > 0:
+        df_unresolved.to_excel(path_export+"/_unresolved_entities.xlsx", sheet_name='unresolved', columns=df_unresolved.columns.tolist())
+
+    logger.info("Finish exporting the rows whose identifier could not be mapped to an entity ID") if logger is not None else None 
+    return None
+
+# %%
+def exportRejectedRows(path_export, df_rejected, logger):
+    logger.info("Begin to export the rows of the Input Table rejected by the validation ...") if logger is not None else None 
+    
+    if df_rejected is not None and len(df_rejected) > 0:
+        df_rejected.to_excel(path_export+"/_rejected_rows.xlsx", sheet_name='rejected', columns=df_rejected.columns.tolist(), index=False)
+
+    logger.info("Finish exporting the rows of the Input Table rejected by the validation") if logger is not None else None 
+    return None
+
+# %%
+def exportDeltaSummary(path_export, df_summary, logger):
+    logger.info("Begin to export the change summary of the delta run ...") if logger is not None else None 
+    
+    df_summary.to_excel(path_export+"/_delta_summary.xlsx", sheet_name='changes', columns=df_summary.columns.tolist(), index=False)
+
+    logger.info("Finish exporting the change summary of the delta run") if logger is not None else None 
+    return None
+
+# %%
+def exportRunPlan(path_export, str_name, df_requests, df_deliverables, df_summary, logger):
+    logger.info("Begin to export the run plan ...") if logger is not None else None 
+    
+    with pd.ExcelWriter(path_export+"/"+str_name+".xlsx") as writer:
+        df_summary.to_excel(writer, sheet_name='summary', index=False)
+        df_deliverables.to_excel(writer, sheet_name='deliverables', index=False)
+        df_requests.to_excel(writer, sheet_name='requests', index=False)
+
+    logger.info("Finish exporting the run plan") if logger is not None else None 
+    return path_export+"/"+str_name+".xlsx"
+
 # %%
 def update_EntitySearch_Result(df_inputtable, dict_apioutput):
+    # pandasql (and SQLAlchemy/SQLite behind it) is only loaded when the entity search is used
+    import pandasql as psql
+    # pip install pandasql
+    
     if dict_apioutput['data'] is not None:
         df_delta1 = dict_apioutput['data'][['entityId','internationalName']].copy(deep=True)
         df_delta2 = dict_apioutput['data'][['pid','internationalName']].copy(deep=True)
@@ -271,75 +320,132 @@ def genAPIInput_ESG(df_cpdproperties, df_inputtable, logger):
     return list_apiinputs_esg
 
 # %%
-def extractAPIOutput_ClimatePDs(list_responses_climatepds, logger):
+# Flattening of the climate PD responses. Each curve (entity x risk type x scenario, or the baseline) becomes one row
+# per year, with the columns of list_climatepdcols. Bodies are flattened in tasks of whole responses, or of entity
+# ranges of one large (e.g. async) response, so that a process pool can share them out: a task gets the raw bytes of
+# small responses, or its own slice of the entities of a large response (decoded once, in the calling process), and
+# returns columnar arrays (one entry per curve, one value per year), which are concatenated once and cut into the
+# per-entity frames. The pool is started with the spawn method, as it is opened from the threads of the task graph.
+list_climatepdcols = ["scenarioCategory", "entityId", "asOfDate", "isfin", "RiskType", "Scenario", "pd", "impliedRating", "year"]
+list_risktypesmatches = ['combinedRisk','physicalRisk','transitionRisk']
+
+def flattenClimatePDTask(list_items):
+    # list_items: (response number, body or a part of it); one result per item:
+    # (response number, curves [(scenarioCategory, entityId, asOfDate, isfin, RiskType, Scenario)], years per curve,
+    #  pd, impliedRating, entities [(entityId, number of curves, errorMessage)])
+    list_results = []
+    for int_response, bytes_content in list_items:
+        json_data = wf.decodeJSON(bytes_content)
+        str_scencat = json_data["scenarioCategory"]
+        list_curves, list_lengths, list_pd, list_ir, list_entities = [], [], [], [], []
+        for entity in json_data["entities"]:
+            if "errorMessage" in entity:
+                list_entities.append((entity.get('entityId'), 0, entity['errorMessage']))
+                continue
+            tuple_entity = (str_scencat, entity["entityId"], entity["asOfDate"], entity["isfin"])
+            int_curves = len(list_curves)
+            for risktype, value in entity.items():
+                if isinstance(value, dict) and any([x in risktype for x in list_risktypesmatches]):
+                    list_pairs = [(risktype, scenario, value[scenario]) for scenario in value.keys()]
+                elif isinstance(value, dict) and risktype == 'baseline':
+                    list_pairs = [("baseline", "baseline", value)]
+                else:
+                    continue
+                for risktype_out, scenario, dict_curve in list_pairs:
+                    # the values come as a list, or as a dict keyed by year
+                    list_curvepd = list(dict_curve["pd"].values()) if isinstance(dict_curve["pd"], dict) else dict_curve["pd"]
+                    list_curveir = list(dict_curve["impliedRating"].values()) if isinstance(dict_curve["impliedRating"], dict) else dict_curve["impliedRating"]
+                    # a curve is as long as the longer of its PDs and implied ratings, as in a column-wise concat
+                    int_years = max(len(list_curvepd), len(list_curveir))
+                    list_curves.append(tuple_entity+(risktype_out, scenario))
+                    list_lengths.append(int_years)
+                    list_pd += list(list_curvepd)+[None]*(int_years-len(list_curvepd))
+                    list_ir += list(list_curveir)+[None]*(int_years-len(list_curveir))
+            list_entities.append((entity["entityId"], len(list_curves)-int_curves, None))
+        list_results.append((int_response, list_curves, np.array(list_lengths, dtype=np.int64),
+                             np.array(list_pd, dtype=np.float64), list_ir, list_entities))
+    return list_results
+
+def genClimatePDTasks(list_contents, int_taskbytes):
+    # small bodies are packed together up to int_taskbytes per task; a larger one is cut at the byte offsets of its
+    # entities into bodies of about int_taskbytes (see wf.splitJSONArray), so that every task decodes its own bytes
+    list_tasks, list_task, int_bytes = [], [], 0
+    for int_response, bytes_content in enumerate(list_contents):
+        if bytes_content is None:
+            continue
+        if len(bytes_content) > int_taskbytes:
+            list_parts = wf.splitJSONArray(bytes_content, "entities", int_taskbytes)
+            for bytes_part in list_parts if list_parts is not None else [bytes_content]:
+                list_tasks.append([(int_response, bytes_part)])
+            continue
+        if len(list_task) > 0 and int_bytes+len(bytes_content) > int_taskbytes:
+            list_tasks.append(list_task)
+            list_task, int_bytes = [], 0
+        list_task.append((int_response, bytes_content))
+        int_bytes += len(bytes_content)
+    if len(list_task) > 0:
+        list_tasks.append(list_task)
+    return list_tasks
+
+def extractAPIOutput_ClimatePDs(list_responses_climatepds, logger, int_workers=1, int_taskbytes=1024**2):
+    # one frame per entity (None for an entity with an errorMessage and for a failed response), in the order of the
+    # responses; with int_workers > 1, the tasks run in a process pool once there is more than one task of bodies
     logger.info("Begin to flatten API outputs of climate-adjusted PDs ...") if logger is not None else None 
     
-    list_ownfirmoutputs_climatepds=[]
-    count_loop = 0    
-    for response in list_responses_climatepds:
-        count_loop +=1
-        if response.status_code == 200:
-            json_data = response.json()
-            list_scenarocat = [json_data["scenarioCategory"]]
-            list_risktypesmatches = ['combinedRisk','physicalRisk','transitionRisk']
-   
-            df_entity = pd.DataFrame()
-            for entity in json_data["entities"]:
-                # if errorMessage is found, log it and go to next iteration
-                if "errorMessage" in entity:
-                    list_ownfirmoutputs_climatepds.append(None)
-                    logger.info(f"-> Error Message: {entity['errorMessage']} showed in entity ID: {entity['entityId']} at iteration #{count_loop} of Total #{len(list_responses_climatepds)}") if logger is not None else None 
-                else: 
-                    
-                    list_entityid = [entity["entityId"],entity["asOfDate"],entity["isfin"]]
-    
-                    for risktype, value in entity.items():
-                        if isinstance(value, dict) and any([x in risktype for x in list_risktypesmatches]):
-                            for scenario in value.keys():
-                                scenario_pd = pd.Series(value[scenario]["pd"]).reset_index()[0]
-                                scenario_ir = pd.Series(value[scenario]["impliedRating"]).reset_index()[0]
-                                df_pd_ir = pd.concat([scenario_pd,scenario_ir], axis=1, keys=["pd","ir"])
-                                df_pd_ir["year"] = df_pd_ir.reset_index().index+1
-                                
-                                len_pd_ir = len(df_pd_ir)
-                                list_prefix = list_scenarocat+list_entityid+[risktype, scenario]
-                                df_prefix = pd.DataFrame([list_prefix]*len_pd_ir) 
-                                df_eachrisktype = pd.concat([df_prefix,df_pd_ir],axis=1)
-                                
-                                df_entity = pd.concat([df_entity, df_eachrisktype], ignore_index=True, sort=False)
-                                
-                        elif isinstance(value, dict) and risktype == 'baseline':
-                            baseline_pd = pd.Series(value["pd"]).reset_index()[0]
-                            baseline_ir = pd.Series(value["impliedRating"]).reset_index()[0]
-                            df_pd_ir = pd.concat([baseline_pd,baseline_ir], axis=1, keys=["pd","ir"])
-                            df_pd_ir["year"] = df_pd_ir.reset_index().index+1
-                               
-                            len_pd_ir = len(df_pd_ir)
-                            list_prefix = list_scenarocat+list_entityid+["baseline","baseline"]
-                            df_prefix = pd.DataFrame([list_prefix]*len_pd_ir) 
-                            df_baseline = pd.concat([df_prefix,df_pd_ir],axis=1)
-                                
-                            df_entity = pd.concat([df_entity, df_baseline], ignore_index=True, sort=False)
-                        else:
-                            None
-                            #print("Do nothing")
-                            
-                    # Create a DataFrame
-                    df_entity.columns = ["scenarioCategory", "entityId", "asOfDate", "isfin", "RiskType", "Scenario", "pd", "impliedRating", "year"]
-                    list_ownfirmoutputs_climatepds.append(df_entity.copy(deep=True))
-                    logger.info(f"-> Flatten response data at iteration #{count_loop} of Total #{len(list_responses_climatepds)}") if logger is not None else None 
-            
-            # end of for loop
-        else:
+    list_contents = [response.content if response.status_code == 200 else None for response in list_responses_climatepds]
+    list_tasks = genClimatePDTasks(list_contents, int_taskbytes)
+    bool_parallel = int_workers is not None and int_workers > 1 and len(list_tasks) > 1
+    logger.info(f"-> {len(list_tasks)} flatten task(s)"+(f" in {min(int_workers, len(list_tasks))} processes" if bool_parallel else "")) if logger is not None else None
+
+    list_results = []
+    if bool_parallel:
+        with ProcessPoolExecutor(max_workers=min(int_workers, len(list_tasks)), mp_context=multiprocessing.get_context("spawn")) as executor:
+            for int_done, list_taskresults in enumerate(executor.map(flattenClimatePDTask, list_tasks), 1):
+                list_results += list_taskresults
+                fh.logProgress(logger, "Climate-adjusted PD flatten tasks completed", int_done, len(list_tasks))
+    else:
+        for int_done, list_task in enumerate(list_tasks, 1):
+            list_results += flattenClimatePDTask(list_task)
+            fh.logProgress(logger, "Climate-adjusted PD flatten tasks completed", int_done, len(list_tasks))
+
+    # every curve's descriptive columns are repeated over its years, all tasks at once
+    list_curves = [curve for result in list_results for curve in result[1]]
+    arr_lengths = np.concatenate([result[2] for result in list_results]) if len(list_results) > 0 else np.empty(0, dtype=np.int64)
+    df_all = pd.DataFrame(list_curves, columns=list_climatepdcols[:6]) if len(list_curves) > 0 else pd.DataFrame(columns=list_climatepdcols[:6])
+    df_all = df_all.loc[df_all.index.repeat(arr_lengths)].reset_index(drop=True)
+    df_all["pd"] = np.concatenate([result[3] for result in list_results]) if len(list_results) > 0 else np.empty(0)
+    df_all["impliedRating"] = pd.Series([ir for result in list_results for ir in result[4]])
+    # years count from 1 within each curve
+    df_all["year"] = np.arange(len(df_all)) - np.repeat(np.cumsum(arr_lengths)-arr_lengths, arr_lengths) + 1
+
+    dict_outputs = {}
+    int_row, int_curve = 0, 0
+    for int_response, list_curvesoftask, arr_lengthsoftask, arr_pd, list_ir, list_entities in list_results:
+        for entityid, int_curves, str_error in list_entities:
+            if str_error is not None:
+                dict_outputs.setdefault(int_response, []).append(None)
+                logger.info(f"-> Error Message: {str_error} showed in entity ID: {entityid} at iteration #{int_response+1} of Total #{len(list_responses_climatepds)}") if logger is not None else None 
+                continue
+            int_rows = int(arr_lengths[int_curve:int_curve+int_curves].sum())
+            dict_outputs.setdefault(int_response, []).append(df_all.iloc[int_row:int_row+int_rows].reset_index(drop=True))
+            int_row += int_rows
+            int_curve += int_curves
+
+    # a response gives one output per entity; a failed response gives a single None
+    list_ownfirmoutputs_climatepds = []
+    for int_response, bytes_content in enumerate(list_contents):
+        if bytes_content is None:
             list_ownfirmoutputs_climatepds.append(None)
-            logger.info(f"-> No response data (i.e. status code != 200) at iteration #{count_loop} of Total #{len(list_responses_climatepds)}") if logger is not None else None 
+            logger.info(f"-> No response data (i.e. status code != 200) at iteration #{int_response+1} of Total #{len(list_responses_climatepds)}") if logger is not None else None 
+        else:
+            list_ownfirmoutputs_climatepds += dict_outputs.get(int_response, [])
             
     logger.info("Finish flattening API outputs of climate-adjusted PDs") if logger is not None else None 
             
     return list_ownfirmoutputs_climatepds
 
 # %%
-def exportAPIOutput_ClimatePDs(path_export, list_ownfirmoutputs_climatepds, logger):
+def exportAPIOutput_ClimatePDs(path_export, list_ownfirmoutputs_climatepds, logger, bool_combined=True):
     logger.info("Begin to export API outputs of climate-adjusted PDs to XLSX format ...") if logger is not None else None 
     count_loop = 0    
     for ownfirmoutput in list_ownfirmoutputs_climatepds:
@@ -348,10 +454,11 @@ def exportAPIOutput_ClimatePDs(path_export, list_ownfirmoutputs_climatepds, logg
             list_cols= ownfirmoutput.columns.tolist() 
             str_exportfilename = "climate_pd_"+ownfirmoutput['entityId'].iloc[0]+".xlsx"
             ownfirmoutput.to_excel(path_export+"/"+str_exportfilename ,sheet_name='climatePD', columns=list_cols)
-            logger.info(f"-> data is exported at iteration #{count_loop} of Total #{len(list_ownfirmoutputs_climatepds)}") if logger is not None else None 
+            fh.logProgress(logger, "Climate-adjusted PDs exported", count_loop, len(list_ownfirmoutputs_climatepds))
 
-    df_combined = pd.concat(list_ownfirmoutputs_climatepds)    
-    df_combined.to_excel(path_export+"/_combined_all.xlsx" ,sheet_name='climatePD', columns=df_combined.columns.tolist())
+    if bool_combined:
+        df_combined = pd.concat(list_ownfirmoutputs_climatepds)    
+        df_combined.to_excel(path_export+"/_combined_all.xlsx" ,sheet_name='climatePD', columns=df_combined.columns.tolist())
 
     logger.info("Finish exporting API outputs of climate-adjusted PDs to XLSX format") if logger is not None else None 
     return 
@@ -364,6 +471,16 @@ def exportPortfolioPDs(path_export, df_portfolio_edf, logger):
     logger.info("Finish exporting Portfolio PDs to XLSX format") if logger is not None else None 
     return 
 
+def exportPortfolioLoss(path_export, df_lossstats, df_lossdist, logger):
+    logger.info("Begin to export simulated Portfolio Losses to XLSX format ...") if logger is not None else None 
+    
+    with pd.ExcelWriter(path_export+"/_PortfolioLoss.xlsx") as writer:
+        df_lossstats.to_excel(writer, sheet_name='Loss_Statistics')
+        df_lossdist.to_excel(writer, sheet_name='Loss_Distribution')
+
+    logger.info("Finish exporting simulated Portfolio Losses to XLSX format") if logger is not None else None 
+    return 
+
 # %%
 def genAPIInput_TransRiskIndustry(df_cpdproperties, df_inputtable, logger):
 
@@ -387,7 +504,7 @@ def extractAPIOutput_TransRiskIndustry(obj_responses_industry, logger):
     logger.info("Begin to flatten API outputs of Transition Risk Drivers for Industry ...") if logger is not None else None 
     
     flattened_data = []
-    for scenario, entries in obj_responses_industry.json().items():
+    for scenario, entries in wf.loadsResponse(obj_responses_industry).items():
         for entry in entries:
             flattened_entry = {"scenario": scenario}
             for key, value in entry.items():
@@ -436,7 +553,7 @@ def extractAPIOutput_TransRiskRegion(obj_responses_region, logger):
     logger.info("Begin to flatten API outputs of Transition Risk Drivers for Region ...") if logger is not None else None 
     
     flattened_data = []
-    for scenario, entries in obj_responses_region.json().items():
+    for scenario, entries in wf.loadsResponse(obj_responses_region).items():
         for entry in entries:
             flattened_entry = {"scenario": scenario}
             for key, value in entry.items():
@@ -479,7 +596,7 @@ def extractAPIOutput_ESG(response_esg, logger):
     new_df = df_domain_scores.join(df_info_inputs).ffill()
     """
     df_ownfirmoutputs_esg = pd.DataFrame()
-    for apioutput in response_esg.json():
+    for apioutput in wf.loadsResponse(response_esg):
         df_domain_scores = pd.json_normalize(apioutput, record_path=['domainScores'])
         df_info_inputs = pd.json_normalize(apioutput, record_path=None, meta=['inputs', 'info', 'globalScores']).drop(columns=['domainScores'])
         df_combined = df_domain_scores.join(df_info_inputs).ffill()
@@ -1,7 +1,23 @@
+import os
+import shutil
 import pandas as pd
+import numpy as np
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+list_portfoliokeys = ['Scenario','RiskType','year']
+list_portfoliocols = ['pd','forward_pd','change of forward_pd from baseline']
 
 def calculatePortfolioPD (list_ownfirmoutputs_climatepds):
     
+    df_edf1 = calculateForwardPDs(list_ownfirmoutputs_climatepds)
+    df_portfolio_edf = aggregatePortfolioPD(df_edf1)
+
+    return df_portfolio_edf
+
+def calculateForwardPDs(list_ownfirmoutputs_climatepds):
+    # entity-level forward PDs; only depends on each entity's own curves, so it can be done chunk by chunk
     df_combined = pd.concat(list_ownfirmoutputs_climatepds)    
 
     df_edf = df_combined.sort_values(by=["entityId","RiskType","Scenario","year"])
@@ -15,10 +31,230 @@ def calculatePortfolioPD (list_ownfirmoutputs_climatepds):
     df_edf1 = pd.merge(df_edf, df_edf_bl, on=['entityId','year'])
     df_edf1['change of forward_pd from baseline'] = df_edf1['forward_pd']/df_edf1['forward_pd_baseline'] - 1
     df_edf1 = df_edf1.sort_values(by=["entityId","RiskType","Scenario","year"])
+
+    return df_edf1
+
+def aggregatePortfolioPD(df_edf1):
     
-    df_portfolio_edf = df_edf1.groupby(['Scenario','RiskType','year'])[['pd','forward_pd','change of forward_pd from baseline']].median()
+    df_portfolio_edf = df_edf1.groupby(list_portfoliokeys)[list_portfoliocols].median()
+
+
+    return df_portfolio_edf
 
+def aggregatePortfolioPDParts(iter_parts, path_spill):
+    # streaming mode: the same medians as aggregatePortfolioPD, from the forward PDs written chunk by chunk.
+    # The parts are read one at a time and the values of each (Scenario, RiskType, year) group are appended to a
+    # float64 file of its own under path_spill; the median is then taken one group at a time, so memory is bounded
+    # by a part and by the entities of one group. Group files left by an interrupted run are dropped first
+    shutil.rmtree(path_spill, ignore_errors=True)
+    os.makedirs(path_spill)
+    dict_files = {}
+    for df_part in iter_parts:
+        for tuple_key, df_group in df_part.groupby(list_portfoliokeys)[list_portfoliocols]:
+            tuple_key = (str(tuple_key[0]), str(tuple_key[1]), int(tuple_key[2]))
+            path_group = dict_files.setdefault(tuple_key, f"{path_spill}/group-{len(dict_files):05d}.f64")
+            with open(path_group, 'ab') as file:
+                df_group.to_numpy(dtype=np.float64).tofile(file)
+    if len(dict_files) == 0:
+        os.rmdir(path_spill)
+        return None
 
+    list_keys = sorted(dict_files)
+    list_medians = []
+    for tuple_key in list_keys:
+        arr_values = np.fromfile(dict_files[tuple_key], dtype=np.float64).reshape(-1, len(list_portfoliocols))
+        list_medians.append(pd.DataFrame(arr_values, columns=list_portfoliocols).median())
+        os.remove(dict_files[tuple_key])
+    os.rmdir(path_spill)
+    df_portfolio_edf = pd.DataFrame(list_medians, index=pd.MultiIndex.from_tuples(list_keys, names=list_portfoliokeys), columns=list_portfoliocols)
     return df_portfolio_edf
 
 
+# %%
+# Vasicek one-factor portfolio loss simulation.
+# Each obligor defaults in a simulated scenario when its latent asset return
+#     X = sqrt(rho) * Z + sqrt(1 - rho) * eps,    Z, eps ~ N(0, 1)
+# falls below the default threshold ndtri(PD), where PD is the cumulative climate-adjusted PD (in %) of the
+# horizon year. Z is shared by all obligors and all (Scenario, RiskType, year) groups of a simulated scenario, so
+# every group is evaluated on the same random numbers.
+# The simulations are drawn in blocks of int_blocksims and the obligors in tiles of int_tileobligors columns; Z of a
+# block and the eps of each (block, tile) come from child seeds of their own, so a given seed gives the same losses
+# whatever the chunk size or the number of worker processes. A chunk is a run of whole blocks, evaluated one tile
+# at a time: its float32 draws and default indicators take int_blocksims x int_tileobligors x 8 bytes per block
+# (32 MB, the smallest possible chunk) whatever the number of obligors. Only running sums, a histogram and the
+# largest losses of each group are kept, so memory is bounded by the chunk size rather than the number of
+# simulated scenarios or obligors.
+int_blocksims = 4096
+int_tileobligors = 1024
+dict_lossworker = {}
+
+def initLossWorker(arr_thresholds, arr_weights, float_rho, arr_binedges, int_tailsize, int_seed):
+    # keeps the obligor data once per process instead of pickling it with every chunk
+    dict_lossworker['thresholds'] = arr_thresholds
+    dict_lossworker['weights'] = arr_weights
+    dict_lossworker['rho'] = float_rho
+    dict_lossworker['binedges'] = arr_binedges
+    dict_lossworker['tailsize'] = int_tailsize
+    dict_lossworker['seed'] = int_seed
+
+def genLossChunks(int_nsims, int_obligors, int_groups, int_chunkbytes):
+    # chunks of whole blocks, (block, simulations) each, bounded by int_chunkbytes: the draws and default indicators
+    # of a tile plus the float64 losses of every group (one block at least)
+    list_blocks = [(int_block, min(int_blocksims, int_nsims-int_start)) for int_block, int_start in enumerate(range(0, int_nsims, int_blocksims))]
+    int_blockbytes = int_blocksims*(8*min(int_tileobligors, max(int_obligors, 1)) + 12*int_groups + 4)
+    int_chunkblocks = max(1, int_chunkbytes // int_blockbytes)
+    return [list_blocks[i:i+int_chunkblocks] for i in range(0, len(list_blocks), int_chunkblocks)]
+
+def simulateLossChunk(list_blocks):
+    arr_thresholds = dict_lossworker['thresholds']
+    arr_weights = dict_lossworker['weights']
+    float_rho = dict_lossworker['rho']
+    arr_binedges = dict_lossworker['binedges']
+    int_tailsize = dict_lossworker['tailsize']
+    int_seed = dict_lossworker['seed']
+
+    int_nsims = sum(int_size for int_block, int_size in list_blocks)
+    int_obligors = arr_weights.shape[0]
+    int_groups = arr_thresholds.shape[0]
+    arr_z = np.empty(int_nsims, dtype=np.float32)
+    int_start = 0
+    for int_block, int_size in list_blocks:
+        rng = np.random.default_rng(np.random.SeedSequence(int_seed, spawn_key=(int_block,)))
+        rng.standard_normal(out=arr_z[int_start:int_start+int_size], dtype=np.float32)
+        int_start += int_size
+    arr_z *= np.float32(math.sqrt(float_rho))
+
+    # the losses of every group add up over the tiles; the draws and default indicators of a tile are written into
+    # the same buffers for every tile and group
+    arr_loss = np.zeros((int_groups, int_nsims))
+    arr_loss32 = np.empty(int_nsims, dtype=np.float32)
+    arr_x = np.empty((int_nsims, 0), dtype=np.float32)
+    for int_tile, int_col in enumerate(range(0, int_obligors, int_tileobligors)):
+        int_cols = min(int_tileobligors, int_obligors-int_col)
+        if arr_x.shape[1] != int_cols:
+            arr_x = np.empty((int_nsims, int_cols), dtype=np.float32)
+            arr_default = np.empty_like(arr_x)
+        int_start = 0
+        for int_block, int_size in list_blocks:
+            rng = np.random.default_rng(np.random.SeedSequence(int_seed, spawn_key=(int_block, int_tile)))
+            rng.standard_normal(out=arr_x[int_start:int_start+int_size], dtype=np.float32)
+            int_start += int_size
+        arr_x *= np.float32(math.sqrt(1 - float_rho))
+        arr_x += arr_z[:, None]
+        for g in range(int_groups):
+            np.less(arr_x, arr_thresholds[g, int_col:int_col+int_cols], out=arr_default)
+            np.matmul(arr_default, arr_weights[int_col:int_col+int_cols], out=arr_loss32)
+            arr_loss[g] += arr_loss32
+
+    arr_sum = arr_loss.sum(axis=1)
+    arr_sumsq = np.einsum('ij,ij->i', arr_loss, arr_loss)
+    arr_hist = np.zeros((int_groups, len(arr_binedges)-1), dtype=np.int64)
+    arr_tail = np.empty((int_groups, min(int_tailsize, int_nsims)))
+    for g in range(int_groups):
+        arr_hist[g] = np.histogram(arr_loss[g], bins=arr_binedges)[0]
+        if int_nsims > int_tailsize:
+            arr_tail[g] = np.partition(arr_loss[g], int_nsims-int_tailsize)[-int_tailsize:]
+        else:
+            arr_tail[g] = arr_loss[g]
+
+    return arr_sum, arr_sumsq, arr_hist, arr_tail
+
+def prepareLossSimulationInputs(list_ownfirmoutputs_climatepds, list_years, list_exposures=None, list_lgds=None, float_lgd=0.45):
+    # pip install scipy
+    from scipy.special import ndtri
+    
+    # one obligor per flattened output (i.e. per row of the Input Table); failed entities (None) are skipped
+    if list_exposures is not None and len(list_exposures) != len(list_ownfirmoutputs_climatepds):
+        raise ValueError("list_exposures must be aligned with list_ownfirmoutputs_climatepds")
+    if list_lgds is not None and len(list_lgds) != len(list_ownfirmoutputs_climatepds):
+        raise ValueError("list_lgds must be aligned with list_ownfirmoutputs_climatepds")
+
+    list_frames = []
+    list_weights = []
+    for i, ownfirmoutput in enumerate(list_ownfirmoutputs_climatepds):
+        if ownfirmoutput is None:
+            continue
+        float_ead = 1.0 if list_exposures is None or list_exposures[i] is None else float(list_exposures[i])
+        float_obllgd = float_lgd if list_lgds is None or list_lgds[i] is None else float(list_lgds[i])
+        df = ownfirmoutput[['Scenario','RiskType','year','pd']].copy()
+        df['obligor'] = len(list_weights)
+        list_frames.append(df)
+        list_weights.append(float_ead * float_obllgd)
+
+    df_pd = pd.concat(list_frames, ignore_index=True)
+    df_pd[['year','pd']] = df_pd[['year','pd']].apply(pd.to_numeric)
+    df_pd = df_pd[df_pd['year'].isin(list_years)]
+    df_pd = df_pd.pivot_table(index=['Scenario','RiskType','year'], columns='obligor', values='pd', aggfunc='last')
+    df_pd = df_pd.reindex(columns=range(len(list_weights)))
+
+    # obligors without a curve for a group never default in that group
+    arr_pd = np.clip(df_pd.to_numpy(dtype=np.float64)/100, 1e-12, 1-1e-12)
+    arr_thresholds = np.where(np.isnan(arr_pd), -np.inf, ndtri(arr_pd)).astype(np.float32)
+    arr_weights = np.asarray(list_weights, dtype=np.float32)
+    arr_el = np.nan_to_num(arr_pd) @ arr_weights.astype(np.float64)
+
+    return df_pd.index, arr_thresholds, arr_weights, arr_el
+
+def simulatePortfolioLoss(list_ownfirmoutputs_climatepds, list_years=(1, 5, 10), list_exposures=None, list_lgds=None,
+                          float_lgd=0.45, float_rho=0.12, int_nsims=100000, list_confidences=(0.99, 0.995, 0.999),
+                          int_seed=20231014, int_workers=1, int_chunkbytes=256*1024**2, int_bins=200, logger=None):
+    logger.info("Begin to simulate portfolio losses ...") if logger is not None else None
+
+    idx_groups, arr_thresholds, arr_weights, arr_el = prepareLossSimulationInputs(
+        list_ownfirmoutputs_climatepds, list(list_years), list_exposures, list_lgds, float_lgd)
+    int_obligors = arr_weights.shape[0]
+    int_groups = arr_thresholds.shape[0]
+
+    list_chunks = genLossChunks(int_nsims, int_obligors, int_groups, int_chunkbytes)
+    int_tailsize = max(1, math.ceil(int_nsims*(1-min(list_confidences)))) + 1
+    arr_binedges = np.linspace(0, max(float(arr_weights.sum()), 1e-12), int_bins+1)
+    initargs = (arr_thresholds, arr_weights, float_rho, arr_binedges, int_tailsize, int_seed)
+
+    arr_sum = np.zeros(int_groups)
+    arr_sumsq = np.zeros(int_groups)
+    arr_hist = np.zeros((int_groups, int_bins), dtype=np.int64)
+    arr_tail = np.empty((int_groups, 0))
+
+    def mergeChunk(tuple_result):
+        nonlocal arr_sum, arr_sumsq, arr_hist, arr_tail
+        arr_sum = arr_sum + tuple_result[0]
+        arr_sumsq = arr_sumsq + tuple_result[1]
+        arr_hist = arr_hist + tuple_result[2]
+        arr_tail = np.concatenate([arr_tail, tuple_result[3]], axis=1)
+        if arr_tail.shape[1] > int_tailsize:
+            arr_tail = np.partition(arr_tail, arr_tail.shape[1]-int_tailsize, axis=1)[:, -int_tailsize:]
+
+    logger.info(f"-> {int_nsims} simulations over {int_obligors} obligors and {int_groups} groups in {len(list_chunks)} chunks") if logger is not None else None
+    if int_workers > 1 and len(list_chunks) > 1:
+        # spawned workers: a forked child would inherit the threads (and locks) of the concurrent deliverables
+        with ProcessPoolExecutor(max_workers=min(int_workers, len(list_chunks)), mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=initLossWorker, initargs=initargs) as executor:
+            for tuple_result in executor.map(simulateLossChunk, list_chunks):
+                mergeChunk(tuple_result)
+    else:
+        initLossWorker(*initargs)
+        for tuple_result in map(simulateLossChunk, list_chunks):
+            mergeChunk(tuple_result)
+
+    # tail statistics: VaR is the m-th largest loss and ES the mean of the m largest losses, m = N * (1 - confidence)
+    arr_tail = -np.sort(-arr_tail, axis=1)
+    arr_mean = arr_sum/int_nsims
+    df_lossstats = pd.DataFrame({
+        'expectedLoss (analytic)': arr_el,
+        'expectedLoss': arr_mean,
+        'lossStd': np.sqrt(np.maximum(arr_sumsq/int_nsims - arr_mean**2, 0)),
+    }, index=idx_groups)
+    for float_conf in list_confidences:
+        int_m = max(1, int(round(int_nsims*(1-float_conf))))
+        df_lossstats[f'VaR {float_conf:.2%}'] = arr_tail[:, int_m-1]
+        df_lossstats[f'ES {float_conf:.2%}'] = arr_tail[:, :int_m].mean(axis=1)
+
+    df_lossdist = pd.DataFrame({
+        'lossLower': np.tile(arr_binedges[:-1], int_groups),
+        'lossUpper': np.tile(arr_binedges[1:], int_groups),
+        'frequency': arr_hist.ravel()/int_nsims,
+    }, index=idx_groups.repeat(int_bins))
+
+    logger.info("Finish simulating portfolio losses") if logger is not None else None
+
+    return df_lossstats, df_lossdist
@@ -1,131 +1,506 @@
-import moodys_climate_api as mapi
+from . import moodys_climate_api as mapi
+from . import run_journal as rj
+from . import file_handlers as fh
+from . import wire_format as wf
+from . import pipeline_metrics as pm
 import json
 import time
+import re
+import queue
+import datetime
+import itertools
+import threading
+import requests
+from urllib.parse import urlencode, quote_plus, urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 
 # %%
-def obtainClimatePDs(bool_isasync, list_apiinputs_climatepds, logger):
+def coalesceAPIInputs(list_apiinputs):
+    # canonicalise each payload (key order independent) and keep only the first occurrence of each distinct request;
+    # list_fanout maps every original payload to the index of its distinct request
+    dict_seen = {}
+    list_distinct = []
+    list_fanout = []
+    for apiinput in list_apiinputs:
+        str_key = json.dumps(apiinput, sort_keys=True, ensure_ascii=False, default=str)
+        if str_key not in dict_seen:
+            dict_seen[str_key] = len(list_distinct)
+            list_distinct.append(apiinput)
+        list_fanout.append(dict_seen[str_key])
+        
+    return list_distinct, list_fanout
+
+def fanOutResponses(list_responses, list_fanout):
+    # give every originating payload (i.e. row) the response of its distinct request, in the original order
+    return [list_responses[idx] for idx in list_fanout]
+
+# %%
+def coalesceEntities(apiinput):
+    # the payload with each distinct entity once (a consolidated payload holds one entity per row of the Input
+    # Table), and the index of the distinct entity of every original entity; None if no entity is repeated
+    if not isinstance(apiinput.get("entities"), list):
+        return apiinput, None
+    list_entities, list_fanout = coalesceAPIInputs(apiinput["entities"])
+    if len(list_entities) == len(list_fanout):
+        return apiinput, None
+    return {**apiinput, "entities": list_entities}, list_fanout
+
+def fanOutEntities(response, apiinput, list_fanout):
+    # the response of a coalesced payload with the result of every original entity, in the order of the original
+    # payload; matched by entityId, and left as it is if it failed, if nothing was coalesced or if its entities
+    # cannot be matched unambiguously
+    if list_fanout is None or response.status_code != 200:
+        return response
+    list_ids = [str(entity.get("entityId")) for entity in apiinput["entities"]]
+    dict_body = wf.loadsResponse(response)
+    dict_results = {str(entity.get("entityId")): entity for entity in dict_body.get("entities", []) if isinstance(entity, dict)}
+    if len(set(list_ids)) != len(list_ids) or any(entityid not in dict_results for entityid in list_ids):
+        return response
+    dict_body["entities"] = [dict_results[list_ids[idx]] for idx in list_fanout]
+
+    response_fanned = requests.Response()
+    response_fanned.status_code = 200
+    response_fanned._content = wf.encodeJSON(dict_body)
+    response_fanned.encoding = 'utf-8'
+    return response_fanned
+
+def getFailedResponse():
+    # stands for a request that got no usable response (e.g. it timed out, its circuit breaker was open or its
+    # process errored): its entities are reported as failed when the responses are flattened
+    response_failed = requests.Response()
+    response_failed._content = b""
+    return response_failed
+
+def obtainClimatePDs(bool_isasync, list_apiinputs_climatepds, logger, dict_journal=None):
     info_type = "climate_pds_TPC"
     list_responses_climatepds = []
     count_loop = 0
     
     logger.info("Begin to request climate-adjusted PDs ...") if logger is not None else None 
     
+    # identical entities (e.g. one row per facility) are requested once only
+    list_apiinputs_all = list_apiinputs_climatepds
+    list_apiinputs_climatepds, list_fanout = coalesceAPIInputs(list_apiinputs_all)
+    logger.info(f"-> {len(list_apiinputs_climatepds)} distinct request(s) out of {len(list_apiinputs_all)}") if logger is not None else None 
+    
     for apiinput in list_apiinputs_climatepds:
         count_loop += 1
+        # and so are identical entities within a consolidated (asynchronous) payload; their results are fanned out
+        # again once the response is received, the journal keeping the response as received
+        apiinput, list_entityfanout = coalesceEntities(apiinput)
+        if list_entityfanout is not None:
+            logger.info(f"-> {len(apiinput['entities'])} distinct entities out of {len(list_entityfanout)} in request # {count_loop}") if logger is not None else None 
         
-        json_str_input = json.dumps(apiinput, indent=4, ensure_ascii=False) 
-        returncode_auth, dict_token = mapi.getAuth()
+        # completed in an earlier attempt of this run: take the stored response from the journal
+        str_key = rj.getRequestKey(info_type, apiinput)
+        if rj.isCompleted(dict_journal, str_key):
+            list_responses_climatepds.append(fanOutEntities(rj.loadResponse(dict_journal, str_key), apiinput, list_entityfanout))
+            fh.logProgress(logger, "Climate-adjusted PDs requested (or taken from journal)", count_loop, len(list_apiinputs_climatepds))
+            continue
         
-        if bool_isasync:
-            logger.info(f"-> Execute iteration # {count_loop} of Total # {len(list_apiinputs_climatepds)}") if logger is not None else None 
-            logger.info("--> Get a processID for this request ...") if logger is not None else None 
-            returncode_pid, response_pid = mapi.getResponse(dict_token, info_type, json_str_input)
-            str_processId = response_pid.json()["processId"] 
+        json_str_input = wf.encodeJSON(apiinput)
+        # a request that fails (timeout, open circuit breaker, connection error) fails its entities only; the
+        # responses already received are kept and the next request is sent
+        try:
+            returncode_auth, dict_token = mapi.getAuth()
             
-            logger.info("--> Download climate-adjusted PDs by this processID ...") if logger is not None else None 
-            returncode_pds, response_pds = mapi.getProcessResult(dict_token, str_processId)
-            list_responses_climatepds.append(response_pds)
-            
-        else:
-            logger.info(f"-> Get climate-adjusted PDs at iteration #{count_loop} of Total #{len(list_apiinputs_climatepds)}") if logger is not None else None 
-            returncode_pds, response_pds = mapi.getResponse(dict_token, info_type, json_str_input)
-            list_responses_climatepds.append(response_pds)
-            time.sleep(2) # let time to append the response object into memory
+            if bool_isasync:
+                logger.debug(f"--> Get a processID at iteration # {count_loop} of Total # {len(list_apiinputs_climatepds)} ...") if logger is not None else None 
+                returncode_pid, response_pid = mapi.getResponse(dict_token, info_type, json_str_input)
+                str_processId = wf.loadsResponse(response_pid)["processId"] 
+                
+                logger.debug(f"--> Download climate-adjusted PDs by processID {str_processId} ...") if logger is not None else None 
+                returncode_pds, response_pds = mapi.getProcessResult(dict_token, str_processId)
+            else:
+                returncode_pds, response_pds = mapi.getResponse(dict_token, info_type, json_str_input)
+                time.sleep(2) # let time to append the response object into memory
+        except requests.RequestException as e:
+            str_entities = ", ".join(str(entity.get("entityId")) for entity in apiinput.get("entities", []))
+            logger.info(f"-> Climate-adjusted PDs of entity ID(s) {str_entities} failed: {e!r}") if logger is not None else None 
+            returncode_pds, response_pds = None, None
+        
+        if returncode_pds == 200:
+            rj.recordResponse(dict_journal, str_key, info_type, response_pds)
+        list_responses_climatepds.append(fanOutEntities(response_pds, apiinput, list_entityfanout) if response_pds is not None else getFailedResponse())
+        
+        fh.logProgress(logger, "Climate-adjusted PDs requested (or taken from journal)", count_loop, len(list_apiinputs_climatepds))
             
     logger.info("Finish requesting climate-adjusted PDs") if logger is not None else None 
     
-    return list_responses_climatepds
+    return fanOutResponses(list_responses_climatepds, list_fanout)
 
 
 # %%
-def obtainTransRiskIndustry(dict_apiinputs_industry, logger):
-    info_type="industry_T"
-    
-    logger.info("Begin to request Transition Risk Drivers for Industry ...") if logger is not None else None 
+def shardAPIInputs(dict_apiinputs, str_param, int_maxlength):
+    # split the comma-separated codes of str_param (industry codes, or (region,industry) pairs) into shards
+    # whose URL-encoded query string stays within int_maxlength characters; a single code is never split
+    str_codes = dict_apiinputs[str_param]
+    list_codes = re.findall(r"\([^()]*\)", str_codes) if str_param == "regionIndustry" else [code for code in str_codes.split(",") if code != ""]
+    int_base = len(urlencode({k: v for k, v in dict_apiinputs.items() if k != str_param})) + len(str_param) + 2
+
+    list_shards = []
+    list_shard = []
+    int_length = int_base
+    for code in list_codes:
+        int_code = len(quote_plus(code)) + (3 if len(list_shard) > 0 else 0)    # 3 for the encoded comma
+        if len(list_shard) > 0 and int_length + int_code > int_maxlength:
+            list_shards.append(list_shard)
+            list_shard, int_length, int_code = [], int_base, len(quote_plus(code))
+        list_shard.append(code)
+        int_length += int_code
+    if len(list_shard) > 0 or len(list_shards) == 0:
+        list_shards.append(list_shard)
+
+    return [{**dict_apiinputs, str_param: ",".join(list_shard)} for list_shard in list_shards]
+
+def mergeJSONResponses(list_responses):
+    # one response holding the entries of every shard ({scenario: [entries]}), each distinct entry kept once
+    dict_merged = {}
+    dict_seen = {}
+    for response in list_responses:
+        for scenario, entries in wf.loadsResponse(response).items():
+            set_seen = dict_seen.setdefault(scenario, set())
+            for entry in entries:
+                str_entry = json.dumps(entry, sort_keys=True)
+                if str_entry not in set_seen:
+                    set_seen.add(str_entry)
+                    dict_merged.setdefault(scenario, []).append(entry)
+
+    response_merged = requests.Response()
+    response_merged.status_code = 200
+    response_merged._content = wf.encodeJSON(dict_merged)
+    response_merged.encoding = 'utf-8'
+    return response_merged
+
+def obtainTransRiskShard(info_type, dict_apiinputs, dict_journal):
+    # one GET of the paths plus the download of its downloadLink; returns the downloaded response (or None)
+    str_key = rj.getRequestKey(info_type, dict_apiinputs)
+    if rj.isCompleted(dict_journal, str_key):
+        return rj.loadResponse(dict_journal, str_key)
     
     returncode_auth, dict_token = mapi.getAuth()
-    returncode_industry, response_industry = mapi.getResponse(dict_token, info_type, dict_apiinputs_industry)
+    returncode_paths, response_paths = mapi.getResponse(dict_token, info_type, dict_apiinputs)
   
     response_dl = None
-    if returncode_industry == 200: 
-        str_downloadlink = response_industry.json()["downloadLink"]
+    if returncode_paths == 200: 
+        str_downloadlink = wf.loadsResponse(response_paths)["downloadLink"]
         returncode_dl, response_dl =  mapi.getDownloadLink(str_downloadlink)
-        
-        logger.info("Finish requesting Transition Risk Drivers for Industry") if logger is not None else None 
-    else:
-        
-        logger.info("Error when requesting Transition Risk Drivers for Industry") if logger is not None else None 
+        if returncode_dl == 200:
+            rj.recordResponse(dict_journal, str_key, info_type, response_dl)
             
     return response_dl
 
+def obtainTransRisk(info_type, str_param, str_label, dict_apiinputs, logger, dict_journal=None):
+    logger.info(f"Begin to request Transition Risk Drivers for {str_label} ...") if logger is not None else None 
+    
+    # long code lists are sent as several GETs at the same time (see shardAPIInputs), each one journaled on its own
+    list_shards = shardAPIInputs(dict_apiinputs, str_param, mapi.getConfig("client").get("maxQueryLength", 2000))
+    logger.info(f"-> {len(list_shards)} shard(s) of the {str_param} codes") if logger is not None else None 
+    if len(list_shards) == 1:
+        list_responses = [obtainTransRiskShard(info_type, list_shards[0], dict_journal)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(list_shards), 8), thread_name_prefix=threading.current_thread().name) as executor:
+            list_responses = list(executor.map(pm.bindRun(lambda dict_shard: obtainTransRiskShard(info_type, dict_shard, dict_journal)), list_shards))
+    
+    # all or nothing: a failed shard fails the request (the completed shards are journaled for a resume)
+    if any(response is None or response.status_code != 200 for response in list_responses):
+        logger.info(f"Error when requesting Transition Risk Drivers for {str_label}") if logger is not None else None 
+        return None
+    
+    logger.info(f"Finish requesting Transition Risk Drivers for {str_label}") if logger is not None else None 
+    return list_responses[0] if len(list_responses) == 1 else mergeJSONResponses(list_responses)
+
+def obtainTransRiskIndustry(dict_apiinputs_industry, logger, dict_journal=None):
+    return obtainTransRisk("industry_T", "industry", "Industry", dict_apiinputs_industry, logger, dict_journal)
 
 # %%
-def obtainTransRiskRegion(dict_apiinputs_region, logger):
-    info_type="region_T"
-    
-    logger.info("Begin to request Transition Risk Drivers for Region ...") if logger is not None else None 
+def obtainTransRiskRegion(dict_apiinputs_region, logger, dict_journal=None):
+    return obtainTransRisk("region_T", "regionIndustry", "Region", dict_apiinputs_region, logger, dict_journal)
+
+
+# %%
+def obtainEntityMappingBatch(str_apiinput_entity, dict_journal):
+    info_type = "entity_batch"
+    str_key = rj.getRequestKey(info_type, wf.decodeJSON(str_apiinput_entity))
+    if rj.isCompleted(dict_journal, str_key):
+        return rj.loadResponse(dict_journal, str_key)
     
     returncode_auth, dict_token = mapi.getAuth()
-    returncode_region, response_region = mapi.getResponse(dict_token, info_type, dict_apiinputs_region)
-  
-    response_dl = None
-    if returncode_region == 200: 
-        str_downloadlink = response_region.json()["downloadLink"]
-        returncode_dl, response_dl =  mapi.getDownloadLink(str_downloadlink)
-        
-        logger.info("Finish requesting Transition Risk Drivers for Region") if logger is not None else None 
-    else:
-        
-        logger.info("Error when requesting Transition Risk Drivers for Region") if logger is not None else None 
-            
-    return response_dl
+    returncode_entity, response_entity = mapi.getResponse(dict_token, info_type, str_apiinput_entity)
+    if returncode_entity == 200:
+        rj.recordResponse(dict_journal, str_key, info_type, response_entity)
+    
+    return response_entity
+
+def obtainEntityMappings(list_apiinputs_entity, logger, dict_journal=None):
+    # the batches of identifiers (genAPIInput_Entity) are sent to the mapping endpoint at the same time
+    logger.info(f"Begin to map identifiers to entity IDs in {len(list_apiinputs_entity)} batch(es) ...") if logger is not None else None 
+    
+    list_responses_entity = []
+    if len(list_apiinputs_entity) > 0:
+        with ThreadPoolExecutor(max_workers=min(len(list_apiinputs_entity), 8), thread_name_prefix=threading.current_thread().name) as executor:
+            list_responses_entity = list(executor.map(pm.bindRun(lambda str_apiinput: obtainEntityMappingBatch(str_apiinput, dict_journal)), list_apiinputs_entity))
+    
+    int_failed = sum(response is None or response.status_code != 200 for response in list_responses_entity)
+    logger.info(f"Finish mapping identifiers to entity IDs, {int_failed} batch(es) failed") if logger is not None else None 
+    
+    return list_responses_entity
 
 
 #%%
-def obtainESG(list_apiinputs_esg , logger):
+# ESG Score Predictor. The records (genAPIInput_ESG) are posted in batches of esgBatchSize records, esgWorkers
+# batches at the same time through the shared client, and every batch is journaled on its own. A batch that fails
+# (429, 5xx or a connection error) is sent again up to esgRetries times; a batch rejected for its content (400 or 422)
+# is split in halves until the records at fault are isolated, so that a bad record only fails itself. Any other 4xx
+# (e.g. 401 / 403, the credentials are not accepted) fails the whole batch at once, as splitting would not help.
+# The results are put back in the order of the records, matched by their batchResponseIdentifier, as a single response.
+
+list_esgsplitcodes = [400, 422]
+
+def matchESGResults(list_batch, list_results):
+    # the result of each record of the batch (None if it has none); records with the same identifier take their
+    # results in order, and results without a known identifier go to the records left, in order
+    dict_results = {}
+    list_unmatched = []
+    for result in list_results:
+        identifier = result.get('inputs', {}).get('batchResponseIdentifier', result.get('batchResponseIdentifier')) if isinstance(result, dict) else None
+        dict_results.setdefault(str(identifier), []).append(result) if identifier is not None else list_unmatched.append(result)
+    list_matched = [dict_results[str(x.get('batchResponseIdentifier'))].pop(0) if len(dict_results.get(str(x.get('batchResponseIdentifier')), [])) > 0 else None
+                    for x in list_batch]
+    list_unmatched += [result for list_left in dict_results.values() for result in list_left]
+    return [result if result is not None else (list_unmatched.pop(0) if len(list_unmatched) > 0 else None) for result in list_matched]
+
+def obtainESGBatch(list_batch, int_retries, logger, dict_journal=None):
+    # the results of the records of one batch, in the order of the batch (None for a record that failed)
     info_type="ESG"
+    str_key = rj.getRequestKey(info_type, list_batch)
+    if rj.isCompleted(dict_journal, str_key):
+        return matchESGResults(list_batch, wf.loadsResponse(rj.loadResponse(dict_journal, str_key)))
+    
+    json_str_input = wf.encodeJSON(list_batch)
+    returncode_esg = None
+    for int_attempt in range(int_retries+1):
+        if int_attempt > 0:
+            pm.countRetry(info_type)
+            time.sleep(min(2**int_attempt, 30))
+        try:
+            returncode_auth, dict_token = mapi.getAuth()
+            returncode_esg, response_esg = mapi.getResponse(dict_token, info_type, json_str_input)
+        except requests.RequestException as e:
+            returncode_esg = None
+            logger.info(f"-> ESG batch of {len(list_batch)} record(s) failed: {e!r}") if logger is not None else None 
+            continue
+        if returncode_esg != 429 and returncode_esg < 500:
+            break
     
+    if returncode_esg == 200:
+        rj.recordResponse(dict_journal, str_key, info_type, response_esg)
+        return matchESGResults(list_batch, wf.loadsResponse(response_esg))
+    if returncode_esg in list_esgsplitcodes and len(list_batch) > 1:
+        # rejected for the content of the batch: each half is sent on its own
+        int_half = len(list_batch)//2
+        return obtainESGBatch(list_batch[:int_half], int_retries, logger, dict_journal) + obtainESGBatch(list_batch[int_half:], int_retries, logger, dict_journal)
+    logger.info(f"-> ESG record(s) {', '.join(str(x.get('batchResponseIdentifier')) for x in list_batch)} failed with return code {returncode_esg}") if logger is not None else None 
+    return [None]*len(list_batch)
+
+def obtainESG(list_apiinputs_esg , logger, dict_journal=None):
     logger.info("Begin to request ESG Score Predictor ...") if logger is not None else None 
     
-    json_str_input = json.dumps(list_apiinputs_esg , indent=4, ensure_ascii=False) 
-    returncode_auth, dict_token = mapi.getAuth()
-    returncode_esg, response_esg = mapi.getResponse(dict_token, info_type, json_str_input)
+    dict_client = mapi.getConfig("client")
+    int_batchsize = max(1, int(dict_client.get("esgBatchSize", 100)))
+    int_workers = max(1, int(dict_client.get("esgWorkers", 4)))
+    int_retries = max(0, int(dict_client.get("esgRetries", 2)))
+    
+    # identical records (e.g. one row per facility) are requested once only
+    list_apiinputs_distinct, list_fanout = coalesceAPIInputs(list_apiinputs_esg)
+    list_batches = [list_apiinputs_distinct[i:i+int_batchsize] for i in range(0, len(list_apiinputs_distinct), int_batchsize)]
+    logger.info(f"-> {len(list_apiinputs_distinct)} distinct record(s) out of {len(list_apiinputs_esg)}, in {len(list_batches)} batch(es)") if logger is not None else None 
     
+    list_results = []
+    if len(list_batches) > 0:
+        with ThreadPoolExecutor(max_workers=min(len(list_batches), int_workers), thread_name_prefix=threading.current_thread().name) as executor:
+            for list_batchresults in executor.map(pm.bindRun(lambda list_batch: obtainESGBatch(list_batch, int_retries, logger, dict_journal)), list_batches):
+                list_results += list_batchresults
+                fh.logProgress(logger, "ESG records scored (or taken from journal)", len(list_results), len(list_apiinputs_distinct))
+    list_results = fanOutResponses(list_results, list_fanout)
+    
+    # one response with the results of every record, in the order of the records
+    response_esg = requests.Response()
+    response_esg.status_code = 200
+    response_esg._content = wf.encodeJSON([result for result in list_results if result is not None])
+    response_esg.encoding = 'utf-8'
+    
+    logger.info(f"Finish requesting ESG Score Predictor, {sum(result is None for result in list_results)} record(s) failed") if logger is not None else None 
     
     return response_esg 
 
 # %%
-def downloadReports(path_reports, list_apiinputs_reports, logger):
+# Pre-defined reports. The report URLs of an entity are pre-signed and expire, so the files are not downloaded in
+# the order their entities were requested: the URLs are requested for several entities at the same time, and every
+# returned file goes into a priority queue ordered by the expiry of its URL, which the download workers drain, the
+# earliest expiring link first. A link that expired (or is about to) before its turn, or that the server rejects as
+# expired (403), is requested again with its entity's URLs, once for all the files of the entity, and re-queued.
+# Client settings (config.json): reportWorkers (URL requests and downloads in flight, default 4), reportUrlTTL
+# (lifetime of a URL without an expiry in its query, default 300 s), reportUrlMargin (time a download needs, so a
+# URL expiring sooner is requested again first, default 30 s).
+
+def getURLExpiry(str_url, float_requested, float_ttl):
+    # epoch seconds at which a pre-signed URL expires: X-Amz-Date + X-Amz-Expires (signature v4), Expires (v2 and
+    # CloudFront), or float_ttl after the URL was requested
+    dict_query = {key.lower(): values[0] for key, values in parse_qs(urlsplit(str_url).query).items()}
+    try:
+        if 'x-amz-date' in dict_query and 'x-amz-expires' in dict_query:
+            dtts_signed = datetime.datetime.strptime(dict_query['x-amz-date'], "%Y%m%dT%H%M%SZ").replace(tzinfo=datetime.timezone.utc)
+            return dtts_signed.timestamp()+float(dict_query['x-amz-expires'])
+        if 'expires' in dict_query:
+            return float(dict_query['expires'])
+    except ValueError:
+        pass
+    return float_requested+float_ttl
+
+def getReportFilename(reporturl):
+    # the last part of the path, without the query of the signed URL
+    return urlsplit(reporturl).path.split("/")[-1]
+
+def requestReportURLs(dict_apiinputs_report):
+    # returns the status code, the response and its decoded body
+    json_str_input = wf.encodeJSON(dict_apiinputs_report)
+    returncode_auth, dict_token = mapi.getAuth()
+    returncode_report, response_report = mapi.getResponse(dict_token, "reports", json_str_input)
+    return returncode_report, response_report, wf.loadsResponse(response_report)
+
+def downloadReports(path_reports, list_apiinputs_reports, logger, dict_journal=None):
     info_type="reports"
     
     logger.info("Begin to access Pre-defined Reports ...") if logger is not None else None 
     
-    count_loop = 0    
-    for dict_apiinputs_report in list_apiinputs_reports:
-        count_loop +=1
-        
-        json_str_input = json.dumps(dict_apiinputs_report, indent=4, ensure_ascii=False) 
-        returncode_auth, dict_token = mapi.getAuth()
-        returncode_report, response_report = mapi.getResponse(dict_token, info_type, json_str_input)
-  
-        if returncode_report == 200: 
-            for reporturl in response_report.json()["reportUrls"]:
-                returncode_file_dl, file_dl =  mapi.getDownloadLink(reporturl)
-                if returncode_file_dl == 200:
-                    filename = reporturl.split("?response")[0].split("/")[-1]
-                    fullpath = f"{path_reports}/{filename}"
-                    with open(fullpath, 'wb') as file:
-                        file.write(file_dl.content)            
-            logger.info(f"-> CSV,PDF are downloaded at iteration # {count_loop} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
-        elif "detail" in response_report.json():
-            logger.info(f"->Error message :{response_report.json()['detail']} at iteration # {count_loop} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
-        elif "errorMessage" in response_report.json():
-            logger.info(f"->Error message :{response_report.json()['errorMessage']} at iteration # {count_loop} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
-        else:
-            logger.info(f"->Error message found which return code is {returncode_report} at iteration # {count_loop} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
-
-    logger.info("Finished accessing Pre-defined Reports") if logger is not None else None 
-            
-    return None
+    # the same entity's reports are downloaded once only: the files are named after the entity, so the rows of a
+    # duplicated entity would only write the same files again
+    list_apiinputs_all = list_apiinputs_reports
+    list_apiinputs_reports, _ = coalesceAPIInputs(list_apiinputs_all)
+    logger.info(f"-> {len(list_apiinputs_reports)} distinct request(s) out of {len(list_apiinputs_all)}") if logger is not None else None 
 
+    dict_client = mapi.getConfig("client")
+    int_workers = max(1, int(dict_client.get("reportWorkers", 4)))
+    float_ttl = float(dict_client.get("reportUrlTTL", 300))
+    float_margin = float(dict_client.get("reportUrlMargin", 30))
+
+    # per entity: journal key, latest response, {file: (url, expiry)}, files downloaded, files pending, and a lock
+    # held while its URLs are requested again
+    dict_entities = {}
+    lock_entities = threading.Lock()
+    queue_files = queue.PriorityQueue()
+    int_seq = itertools.count()
+    list_done = []
+    
+    def queueEntity(idx, returncode_report, response_report, dict_report, float_requested):
+        # log an error of the reports endpoint, or put every file of the entity on the queue
+        if returncode_report != 200:
+            if "detail" in dict_report:
+                logger.info(f"->Error message :{dict_report['detail']} at iteration # {idx+1} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
+            elif "errorMessage" in dict_report:
+                logger.info(f"->Error message :{dict_report['errorMessage']} at iteration # {idx+1} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
+            else:
+                logger.info(f"->Error message found which return code is {returncode_report} at iteration # {idx+1} of Total # {len(list_apiinputs_reports)}") if logger is not None else None 
+            return None
+        dict_urls = {getReportFilename(reporturl): (reporturl, getURLExpiry(reporturl, float_requested, float_ttl)) for reporturl in dict_report["reportUrls"]}
+        with lock_entities:
+            dict_entities[idx]['response'] = response_report
+            dict_entities[idx]['urls'] = dict_urls
+            dict_entities[idx]['pending'] = len(dict_urls)
+        for filename, (reporturl, float_expiry) in dict_urls.items():
+            queue_files.put((float_expiry, next(int_seq), idx, filename, 0))
+        pm.setGauge("report_downloads_queued", queue_files.qsize())
+        if len(dict_urls) == 0:
+            completeEntity(idx)
 
+    def completeEntity(idx):
+        dict_entity = dict_entities[idx]
+        rj.recordResponse(dict_journal, dict_entity['key'], info_type, dict_entity['response'], {"files": dict_entity['files']})
+        list_done.append(idx)
+        fh.logProgress(logger, "Reports downloaded (or taken from journal)", len(list_done), len(list_apiinputs_reports))
+
+    def fetchURLs(idx):
+        float_requested = time.time()
+        queueEntity(idx, *requestReportURLs(list_apiinputs_reports[idx]), float_requested)
+
+    def refreshURL(idx, filename, float_expiry):
+        # the current URL of the file: requested again, unless another file of the entity already refreshed them
+        with dict_entities[idx]['lock']:
+            reporturl, float_current = dict_entities[idx]['urls'].get(filename, (None, float_expiry))
+            if float_current > float_expiry and float_current-time.time() > float_margin:
+                return reporturl, float_current
+            pm.countRetry(info_type)
+            float_requested = time.time()
+            returncode_report, response_report, dict_report = requestReportURLs(list_apiinputs_reports[idx])
+            if returncode_report != 200:
+                return None, None
+            dict_entities[idx]['response'] = response_report
+            dict_entities[idx]['urls'] = {getReportFilename(url): (url, getURLExpiry(url, float_requested, float_ttl)) for url in dict_report["reportUrls"]}
+            return dict_entities[idx]['urls'].get(filename, (None, None))
+
+    def downloadFiles():
+        while True:
+            float_expiry, seq, idx, filename, int_attempt = queue_files.get()
+            try:
+                if idx is None:
+                    break
+                pm.setGauge("report_downloads_queued", queue_files.qsize())
+                reporturl = dict_entities[idx]['urls'].get(filename, (None, None))[0]
+                if float_expiry-time.time() < float_margin:
+                    reporturl, float_expiry = refreshURL(idx, filename, float_expiry)
+                returncode_file_dl, file_dl = mapi.getDownloadLink(reporturl) if reporturl is not None else (None, None)
+                if returncode_file_dl == 403 and int_attempt < 2:
+                    # the link expired on the way: requested again and re-queued
+                    logger.info(f"-> Report link of {filename} expired, it is requested again") if logger is not None else None
+                    reporturl, float_newexpiry = refreshURL(idx, filename, float_expiry)
+                    if reporturl is not None:
+                        queue_files.put((float_newexpiry, next(int_seq), idx, filename, int_attempt+1))
+                        continue
+                if returncode_file_dl != 200:
+                    logger.info(f"->Error message found which return code is {returncode_file_dl} when downloading {filename}") if logger is not None else None
+                    continue
+                with open(f"{path_reports}/{filename}", 'wb') as file:
+                    file.write(file_dl.content)
+                with lock_entities:
+                    dict_entities[idx]['files'].append(filename)
+                    dict_entities[idx]['pending'] -= 1
+                    bool_complete = dict_entities[idx]['pending'] == 0
+                # the entity is journaled once all of its files are downloaded
+                completeEntity(idx) if bool_complete else None
+            except Exception as e:
+                # e.g. a connection error: the entity is not journaled, and a resumed run downloads its files again
+                logger.error(f"-> Report file {filename} could not be downloaded: {e!r}") if logger is not None else None
+            finally:
+                queue_files.task_done()
+
+    list_fetch = []
+    for idx, dict_apiinputs_report in enumerate(list_apiinputs_reports):
+        # the files of this entity were all downloaded in an earlier attempt of this run
+        str_key = rj.getRequestKey(info_type, dict_apiinputs_report)
+        if rj.isCompleted(dict_journal, str_key):
+            list_done.append(idx)
+            fh.logProgress(logger, "Reports downloaded (or taken from journal)", len(list_done), len(list_apiinputs_reports))
+            continue
+        dict_entities[idx] = {'key': str_key, 'response': None, 'urls': {}, 'files': [], 'pending': 0, 'lock': threading.Lock()}
+        list_fetch.append(idx)
+
+    list_threads = [threading.Thread(target=pm.bindRun(downloadFiles), name=f"{threading.current_thread().name}_dl{i+1}", daemon=True) for i in range(int_workers)]
+    for thread in list_threads:
+        thread.start()
+    if len(list_fetch) > 0:
+        with ThreadPoolExecutor(max_workers=min(len(list_fetch), int_workers), thread_name_prefix=threading.current_thread().name) as executor:
+            for future in [executor.submit(pm.bindRun(fetchURLs), idx) for idx in list_fetch]:
+                if future.exception() is not None:
+                    logger.error(f"-> Report URLs could not be requested: {future.exception()!r}") if logger is not None else None
+    # every queued file (including the re-queued ones) is handled before the workers are stopped
+    queue_files.join()
+    for thread in list_threads:
+        queue_files.put((float('inf'), next(int_seq), None, None, 0))
+    for thread in list_threads:
+        thread.join()
+    pm.setGauge("report_downloads_queued", 0)
+
+    logger.info(f"Finished accessing Pre-defined Reports, {len(list_apiinputs_reports)-len(list_done)} entit(ies) incomplete") if logger is not None else None 
+            
+    return None
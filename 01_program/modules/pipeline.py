@@ -0,0 +1,645 @@
+import pandas as pd
+import json
+import os
+import time
+import datetime
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from . import lazyModule
+fh = lazyModule(".file_handlers", __package__)
+adf = lazyModule(".ownfirm_data_formatters", __package__)
+amodel = lazyModule(".ownfirm_models", __package__)
+amc = lazyModule(".ownfirm_to_moodys_connectors", __package__)
+rj = lazyModule(".run_journal", __package__)
+pm = lazyModule(".pipeline_metrics", __package__)
+pprof = lazyModule(".pipeline_profiler", __package__)
+rs = lazyModule(".reference_store", __package__)
+ii = lazyModule(".identifier_index", __package__)
+iv = lazyModule(".input_validation", __package__)
+tss = lazyModule(".term_structure_store", __package__)
+rc = lazyModule(".run_catalogue", __package__)
+rd = lazyModule(".run_delta", __package__)
+dw = lazyModule(".dataset_writer", __package__)
+
+# %%
+@contextmanager
+def runStage(str_stage, str_run, path_target):
+    # every stage is timed into the pipeline metrics, and profiled when profiling is enabled (main.py --profile)
+    with pm.timeStage(str_stage, str_run), pprof.profileStage(path_target, str_stage):
+        yield
+
+def getFlattenWorkers():
+    # processes flattening the climate PD responses; one (in the calling process) when profiling, so that the
+    # profiler sees the flatten code
+    return 1 if pprof.dict_profiling['enabled'] else os.cpu_count()
+
+def getLossWorkers(dict_run):
+    # processes simulating the portfolio losses (main.py --loss-workers); one when profiling, as for the flatten
+    return 1 if pprof.dict_profiling['enabled'] else max(1, dict_run.get('int_lossworkers', 1))
+
+def fetchMissingTransitionPaths(path_store, dict_apiinputs, func_obtain, func_extract, logger, dict_journal=None):
+    # only the codes missing from the local reference store are requested, and their paths are added to the store;
+    # returns the raw response, or None if every code was in the store already
+    dict_apiinputs_missing = rs.filterMissingCodes(path_store, dict_apiinputs)
+    if dict_apiinputs_missing is None:
+        logger.info("-> All codes are in the reference store, nothing is requested") if logger is not None else None
+        return None
+    obj_responses = func_obtain(dict_apiinputs_missing, logger, dict_journal)
+    if obj_responses is not None:
+        int_rows = rs.storeTransitionPaths(path_store, dict_apiinputs_missing, func_extract(obj_responses, logger))
+        logger.info(f"-> {int_rows} value(s) of {len(rs.parseCodes(dict_apiinputs_missing))} code(s) are added to the reference store") if logger is not None else None
+    return obj_responses
+
+def resolveEntities(path_index, df_inputtable, logger, dict_journal=None, int_batchsize=100):
+    # Public rows are looked up by their identifier in the local index, after the unknown identifiers are mapped by
+    # the entity_batch endpoint in batches. Returns the rows with the entity IDs resolved (the original identifier is
+    # kept in inputIdentifier) and the rows that cannot be resolved. Identifiers of a failed batch stay unknown and
+    # their rows are kept, so that an outage of the mapping endpoint does not drop any row.
+    bool_public = df_inputtable['firmStatus'] == "Public"
+    sr_identifier = df_inputtable['entityId'].map(adf.num_to_str)
+    list_identifiers = sr_identifier[bool_public].tolist()
+
+    list_unknown = ii.findUnknownIdentifiers(path_index, list_identifiers)
+    if len(list_unknown) > 0:
+        list_batches = [list_unknown[i:i+int_batchsize] for i in range(0, len(list_unknown), int_batchsize)]
+        list_apiinputs_entity = [adf.genAPIInput_Entity(pd.DataFrame({'entityId': list_batch})) for list_batch in list_batches]
+        list_responses_entity = amc.obtainEntityMappings(list_apiinputs_entity, logger, dict_journal)
+        for list_batch, response_entity in zip(list_batches, list_responses_entity):
+            if response_entity is not None and response_entity.status_code == 200:
+                ii.storeMappings(path_index, list_batch, adf.extractAPIOutput_Entity(response_entity)['data'])
+    dict_entityids = ii.lookupIdentifiers(path_index, list_identifiers)
+
+    set_unresolvable = {identifier for identifier, entityid in dict_entityids.items() if entityid is None}
+    bool_unresolved = bool_public & sr_identifier.isin(set_unresolvable)
+    df_resolved = df_inputtable[~bool_unresolved].copy()
+    df_resolved['inputIdentifier'] = df_resolved['entityId']
+    # entity IDs are text, also where the identifiers were read as numbers
+    df_resolved['entityId'] = df_resolved['entityId'].astype(object)
+    sr_entityid = sr_identifier[~bool_unresolved].map(lambda x: dict_entityids.get(x))
+    bool_mapped = bool_public[~bool_unresolved] & sr_entityid.notna()
+    df_resolved.loc[bool_mapped, 'entityId'] = sr_entityid[bool_mapped]
+
+    return df_resolved, df_inputtable[bool_unresolved]
+
+def checkCPDProperties(df_cpdproperties, dict_dcontrol, logger):
+    # the properties apply to every request of the run, so a problem there stops the run before anything is sent
+    list_issues = iv.validateCPDProperties(df_cpdproperties, dict_dcontrol)
+    for str_issue in list_issues:
+        logger.error(f"-> Climate Adjusted PD properties: {str_issue}") if logger is not None else None
+    if len(list_issues) > 0:
+        raise ValueError(f"Invalid Climate Adjusted PD properties: {'; '.join(list_issues)}")
+
+def validateInputTable(df_inputtable, dict_dcontrol, logger, int_rowoffset=0):
+    # rows breaking a rule of the Input Guideline are left out of the deliverables sending the field (see selectValidRows)
+    df_valid, df_rejected, dict_validrows = iv.validateInputTable(df_inputtable, dict_dcontrol, int_rowoffset)
+    logger.info(f"-> {len(df_rejected)} of {len(df_inputtable)} row(s) of the Input Table are rejected by the validation, "
+                f"{len(df_inputtable)-len(df_valid)} of them by every deliverable") if logger is not None and len(df_rejected) > 0 else None
+    return df_valid, df_rejected, dict_validrows
+
+def selectValidRows(dict_validrows, tuple_deliverables, df_inputtable):
+    # the rows of df_inputtable (or of a frame keeping its index) valid for any of the deliverables
+    if dict_validrows is None:
+        return df_inputtable
+    list_index = [dict_validrows[name] for name in tuple_deliverables if name in dict_validrows]
+    if len(list_index) == 0:
+        return df_inputtable
+    return df_inputtable[df_inputtable.index.isin(list_index[0].append(list_index[1:]))]
+
+def storeTermStructures(dict_paths, str_run, list_ownfirmoutputs_climatepds, logger, bool_flush=True):
+    # the PD / implied rating curves of the run are kept in the shared term structure store for later look-ups;
+    # a streaming run writes the index of the store once, at its end (bool_flush=False for its chunks)
+    path_store = dict_paths['root_path']+dict_paths['folder_reference']+"/term_structures"
+    try:
+        int_added = tss.appendTermStructures(path_store, str_run, list_ownfirmoutputs_climatepds, bool_flush=bool_flush)
+    except ValueError as e:
+        # the store is a by-product of the run: the outputs are exported all the same
+        logger.warning(f"-> The curves are not added to the term structure store: {e}") if logger is not None else None
+        return None
+    logger.info(f"-> {int_added} entity curve set(s) are added to the term structure store") if logger is not None else None
+
+def exportClimatePDDataset(path_climatePD, str_format, list_ownfirmoutputs_climatepds, logger):
+    # the climate PDs as a partitioned dataset (see dataset_writer.py) instead of one workbook per entity
+    dict_dataset = dw.openDataset(path_climatePD+"/dataset", str_format, logger=logger)
+    dw.submitOutputs(dict_dataset, 0, list_ownfirmoutputs_climatepds)
+    int_files = dw.closeDataset(dict_dataset)
+    logger.info(f"-> {int_files} partition file(s) are written into {path_climatePD}/dataset") if logger is not None else None
+
+def selectChangedClimatePDs(dict_run, list_ownfirmoutputs_climatepds):
+    # in delta mode, only the entities whose curves changed since the previous run (see run_delta.py) are exported
+    dict_delta = dict_run.get('dict_delta')
+    if dict_delta is None:
+        return list_ownfirmoutputs_climatepds
+    path_store = dict_run['dict_paths']['root_path']+dict_run['dict_paths']['folder_reference']+"/term_structures"
+    str_prevrun = dict_delta['previous']['run'] if dict_delta['previous'] is not None else None
+    list_changed, df_summary = rd.compareClimatePDs(path_store, str_prevrun, list_ownfirmoutputs_climatepds, dict_delta['rtol'])
+    dict_delta['summaries'].append(df_summary)
+    logger = dict_run['logger']
+    logger.info(f"-> Delta: {sum(df is not None for df in list_changed)} entit(ies) with new or changed climate PDs are exported") if logger is not None else None
+    return list_changed
+
+def selectChangedRows(dict_run, str_deliverable, df_ownfirmoutputs, str_name, list_keys, list_groupcols, bool_rowkey=False):
+    # the full flattened output is pickled as the base of the next delta run; in delta mode only the rows of the
+    # groups (e.g. industries) with a new or changed value are exported
+    fh.writeBinary(dict_run['path_pickle'], df_ownfirmoutputs, str_name)
+    dict_delta = dict_run.get('dict_delta')
+    if dict_delta is None or df_ownfirmoutputs is None or any(col not in df_ownfirmoutputs.columns for col in list_keys):
+        return df_ownfirmoutputs
+    df_prev = rd.loadPreviousFrame(dict_delta['previous'], dict_run['dict_paths'], str_name)
+    df_changed, df_summary = rd.compareFrames(str_deliverable, df_ownfirmoutputs, df_prev, list_keys, list_groupcols, dict_delta['rtol'], bool_rowkey=bool_rowkey)
+    dict_delta['summaries'].append(df_summary)
+    logger = dict_run['logger']
+    logger.info(f"-> Delta: {len(df_changed)} row(s) of {len(df_summary)} new or changed {str_deliverable} group(s) are exported") if logger is not None else None
+    return df_changed if len(df_changed) > 0 else None
+
+# Deliverables of a batch run. Each one receives dict_run with the shared inputs of the run:
+#   path_target, name_target, path_pickle, dict_paths, df_inputtable, df_cpdproperties, dict_dcontrol, logger, dict_journal,
+#   str_outputformat (xlsx, or parquet / csv for a partitioned climate PD dataset)
+# and saves its outputs into its own dict_paths folder under path_target.
+# Each stage is run as "<deliverable>.<stage>" (build -> submit -> flatten -> export -> portfolio), see runStage.
+def runEntities(dict_run):
+    # Public rows whose identifier cannot be mapped to an entity ID never reach the climate PD and report endpoints
+    logger = dict_run['logger']
+    str_run, path_target = dict_run.get('name_target', ""), dict_run['path_target']
+    path_index = dict_run['dict_paths']['root_path']+dict_run['dict_paths']['folder_reference']+"/identifier_index.sqlite"
+    with runStage("entities.resolve", str_run, path_target):
+        df_inputtable = selectValidRows(dict_run.get('dict_validrows'), iv.tuple_core, dict_run['df_inputtable'])
+        df_resolved, df_unresolved = resolveEntities(path_index, df_inputtable, logger, dict_run.get('dict_journal'))
+    logger.info(f"-> {len(df_unresolved)} row(s) with an unresolvable identifier are left out") if logger is not None else None
+    adf.exportUnresolvedEntities(path_target, df_unresolved, logger)
+    dict_run['df_inputtable_entities'] = df_resolved
+
+def runClimatePDs(dict_run):
+    logger = dict_run['logger']
+    str_run, path_target = dict_run.get('name_target', ""), dict_run['path_target']
+    df_inputtable = selectValidRows(dict_run.get('dict_validrows'), ('climatePDs',), dict_run.get('df_inputtable_entities', dict_run['df_inputtable']))
+    path_climatePD = fh.createFolder(path_target+dict_run['dict_paths']['output_climatePD'])
+    with runStage("climatePDs.build", str_run, path_target):
+        bool_isasync, list_apiinputs_climatepds = adf.genListOfAPIInput_ClimatePDs(dict_run['df_cpdproperties'], df_inputtable, logger)    
+    with runStage("climatePDs.submit", str_run, path_target):
+        list_responses_climatepds = amc.obtainClimatePDs(bool_isasync, list_apiinputs_climatepds, logger, dict_run.get('dict_journal'))
+    fh.writeBinary(dict_run['path_pickle'], list_responses_climatepds, "list_responses_climatepds")
+    with runStage("climatePDs.flatten", str_run, path_target):
+        list_ownfirmoutputs_climatepds = adf.extractAPIOutput_ClimatePDs(list_responses_climatepds, logger, int_workers=getFlattenWorkers())
+    with runStage("climatePDs.store", str_run, path_target):
+        storeTermStructures(dict_run['dict_paths'], str_run, list_ownfirmoutputs_climatepds, logger)
+    with runStage("climatePDs.export", str_run, path_target):
+        list_ownfirmoutputs_export = selectChangedClimatePDs(dict_run, list_ownfirmoutputs_climatepds)
+        if dict_run.get('str_outputformat', "xlsx") == "xlsx":
+            adf.exportAPIOutput_ClimatePDs(path_climatePD, list_ownfirmoutputs_export, logger, bool_combined=dict_run.get('dict_delta') is None)
+        else:
+            exportClimatePDDataset(path_climatePD, dict_run['str_outputformat'], list_ownfirmoutputs_export, logger)
+
+    with runStage("climatePDs.portfolio", str_run, path_target):
+        df_portfolio_edf = amodel.calculatePortfolioPD (list_ownfirmoutputs_climatepds)
+        adf.exportPortfolioPDs(path_climatePD, df_portfolio_edf, logger)
+
+    if dict_run['dict_dcontrol'].get('Simulate Portfolio Loss') == 'ENABLE':
+        # optional EAD / LGD columns of the Input Table, aligned with the per-row climate PD outputs
+        list_exposures = df_inputtable['EAD'].tolist() if 'EAD' in df_inputtable.columns and not bool_isasync else None
+        list_lgds = df_inputtable['LGD'].tolist() if 'LGD' in df_inputtable.columns and not bool_isasync else None
+        with runStage("climatePDs.lossSimulation", str_run, path_target):
+            df_lossstats, df_lossdist = amodel.simulatePortfolioLoss(list_ownfirmoutputs_climatepds, list_exposures=list_exposures, list_lgds=list_lgds,
+                                                                     int_workers=getLossWorkers(dict_run), logger=logger)
+            adf.exportPortfolioLoss(path_climatePD, df_lossstats, df_lossdist, logger)
+
+def runTransRiskIndustry(dict_run):
+    logger = dict_run['logger']
+    str_run, path_target = dict_run.get('name_target', ""), dict_run['path_target']
+    path_transrisk = fh.createFolder(path_target+dict_run['dict_paths']['output_transrisk'])
+    path_store = dict_run['dict_paths']['root_path']+dict_run['dict_paths']['folder_reference']+"/transition_paths.sqlite"
+    with runStage("transRiskIndustry.build", str_run, path_target):
+        df_inputtable = selectValidRows(dict_run.get('dict_validrows'), ('transRiskIndustry',), dict_run['df_inputtable'])
+        dict_apiinputs_industry = adf.genAPIInput_TransRiskIndustry(dict_run['df_cpdproperties'], df_inputtable, logger)
+    with runStage("transRiskIndustry.submit", str_run, path_target):
+        obj_responses_industry = fetchMissingTransitionPaths(path_store, dict_apiinputs_industry, amc.obtainTransRiskIndustry, adf.extractAPIOutput_TransRiskIndustry, logger, dict_run.get('dict_journal'))
+    fh.writeBinary(dict_run['path_pickle'], obj_responses_industry, "obj_responses_industry") if obj_responses_industry is not None else None
+    with runStage("transRiskIndustry.flatten", str_run, path_target):
+        df_ownfirmoutputs_industry = rs.lookupTransitionPaths(path_store, dict_apiinputs_industry)
+    with runStage("transRiskIndustry.export", str_run, path_target):
+        df_ownfirmoutputs_industry = selectChangedRows(dict_run, "transRiskIndustry", df_ownfirmoutputs_industry, "df_ownfirmoutputs_industry",
+                                                       ['industry', 'scenario', 'year'], ['industry'])
+        adf.exportAPIOutput_TransRiskIndustry(path_transrisk, df_ownfirmoutputs_industry, logger)
+
+def runTransRiskRegion(dict_run):
+    logger = dict_run['logger']
+    str_run, path_target = dict_run.get('name_target', ""), dict_run['path_target']
+    path_transrisk = fh.createFolder(path_target+dict_run['dict_paths']['output_transrisk'])
+    path_store = dict_run['dict_paths']['root_path']+dict_run['dict_paths']['folder_reference']+"/transition_paths.sqlite"
+    with runStage("transRiskRegion.build", str_run, path_target):
+        df_inputtable = selectValidRows(dict_run.get('dict_validrows'), ('transRiskRegion',), dict_run['df_inputtable'])
+        dict_apiinputs_region = adf.genAPIInput_TransRiskRegion(dict_run['df_cpdproperties'], df_inputtable, logger)
+    with runStage("transRiskRegion.submit", str_run, path_target):
+        obj_responses_region = fetchMissingTransitionPaths(path_store, dict_apiinputs_region, amc.obtainTransRiskRegion, adf.extractAPIOutput_TransRiskRegion, logger, dict_run.get('dict_journal'))
+    fh.writeBinary(dict_run['path_pickle'], obj_responses_region, "obj_responses_region") if obj_responses_region is not None else None
+    with runStage("transRiskRegion.flatten", str_run, path_target):
+        df_ownfirmoutputs_region = rs.lookupTransitionPaths(path_store, dict_apiinputs_region)
+    with runStage("transRiskRegion.export", str_run, path_target):
+        df_ownfirmoutputs_region = selectChangedRows(dict_run, "transRiskRegion", df_ownfirmoutputs_region, "df_ownfirmoutputs_region",
+                                                     ['region', 'industry', 'scenario', 'year'], ['region', 'industry'])
+        adf.exportAPIOutput_TransRiskRegion(path_transrisk, df_ownfirmoutputs_region, logger)
+
+def runReports(dict_run):
+    # only available when entity Id is valid BVD id
+    logger = dict_run['logger']
+    str_run, path_target = dict_run.get('name_target', ""), dict_run['path_target']
+    path_reports = fh.createFolder(path_target+dict_run['dict_paths']['output_reports'])
+    with runStage("reports.build", str_run, path_target):
+        df_inputtable = selectValidRows(dict_run.get('dict_validrows'), ('reports',), dict_run.get('df_inputtable_entities', dict_run['df_inputtable']))
+        list_apiinputs_reports = adf.genListOfAPIInput_Reports(dict_run['df_cpdproperties'], df_inputtable, logger)    
+    # as response has expiring time limit, it must be handled one by one, not in batch mode
+    with runStage("reports.submit", str_run, path_target):
+        amc.downloadReports(path_reports, list_apiinputs_reports, logger, dict_run.get('dict_journal'))
+
+def runESG(dict_run):
+    logger = dict_run['logger']
+    str_run, path_target = dict_run.get('name_target', ""), dict_run['path_target']
+    path_esg = fh.createFolder(path_target+dict_run['dict_paths']['output_esg'])
+    with runStage("esg.build", str_run, path_target):
+        df_inputtable = selectValidRows(dict_run.get('dict_validrows'), ('esg',), dict_run['df_inputtable'])
+        list_apiinputs_esg = adf.genAPIInput_ESG(dict_run['df_cpdproperties'], df_inputtable, logger)    
+    with runStage("esg.submit", str_run, path_target):
+        response_esg = amc.obtainESG(list_apiinputs_esg , logger, dict_run.get('dict_journal'))
+    fh.writeBinary(dict_run['path_pickle'], response_esg, "response_esg")
+    with runStage("esg.flatten", str_run, path_target):
+        df_ownfirmoutputs_esg = adf.extractAPIOutput_ESG(response_esg, logger)
+    with runStage("esg.export", str_run, path_target):
+        # the rows of an entity are its domain scores, matched by their position
+        df_ownfirmoutputs_esg = selectChangedRows(dict_run, "esg", df_ownfirmoutputs_esg, "df_ownfirmoutputs_esg",
+                                                  ['inputs.batchResponseIdentifier'], ['inputs.batchResponseIdentifier'], bool_rowkey=True)
+        adf.exportAPIOutput_ESG(path_esg, df_ownfirmoutputs_esg, logger)    
+
+# %%
+# Task graph of the deliverables: name -> (Deliverables Control flag(s), function, names of the tasks it depends on).
+# A task with a tuple of flags runs if any of them is enabled. The deliverables have no data dependencies on each
+# other, so every branch can run at the same time once the identifiers are resolved.
+dict_deliverabletasks = {
+    'entities':         (('Retrieve Climate Adjusted PDs', 'Access Pre-defined reports'), runEntities, []),
+    'climatePDs':       ('Retrieve Climate Adjusted PDs', runClimatePDs, ['entities']),
+    'transRiskIndustry':('Retrieve Transition Risk Drivers for Industry (Sector)', runTransRiskIndustry, []),
+    'transRiskRegion':  ('Retrieve Transition Risk Drivers for Country (Region)', runTransRiskRegion, []),
+    'reports':          ('Access Pre-defined reports', runReports, ['entities']),
+    'esg':              ('Request ESG Score Predictor', runESG, []),
+}
+
+def genDeliverableTasks(dict_dcontrol):
+    # keep the enabled deliverables only; a dependency on a disabled deliverable is dropped
+    dict_tasks = {name: (func, deps) for name, (flag, func, deps) in dict_deliverabletasks.items()
+                  if any(dict_dcontrol.get(x) == 'ENABLE' for x in (flag if isinstance(flag, tuple) else (flag,)))}
+    return {name: (func, [dep for dep in deps if dep in dict_tasks]) for name, (func, deps) in dict_tasks.items()}
+
+def runTask(name, func, dict_run):
+    # name the worker thread after the task, so that each branch can be told apart in the log
+    thread = threading.current_thread()
+    str_threadname = thread.name
+    thread.name = name
+    try:
+        return func(dict_run)
+    finally:
+        thread.name = str_threadname
+
+def runTaskGraph(dict_tasks, dict_run, int_workers, logger):
+    # run every task as soon as all of its dependencies are completed, up to int_workers at the same time;
+    # a failed task is logged and only the tasks depending on it are skipped
+    logger.info(f"Begin to run {len(dict_tasks)} task(s) with {int_workers} worker(s): {', '.join(dict_tasks)}") if logger is not None else None
+
+    dict_status = {}
+    dict_running = {}
+    with ThreadPoolExecutor(max_workers=max(1, int_workers)) as executor:
+        while len(dict_status) < len(dict_tasks):
+            for name, (func, deps) in dict_tasks.items():
+                if name in dict_status or name in dict_running.values():
+                    continue
+                if any(dict_status.get(dep) in ('failed', 'skipped') for dep in deps):
+                    dict_status[name] = 'skipped'
+                    logger.info(f"-> Task {name} is skipped as a dependency did not complete") if logger is not None else None
+                elif all(dict_status.get(dep) == 'completed' for dep in deps):
+                    dict_running[executor.submit(pm.bindRun(runTask), name, func, dict_run)] = name
+            
+            pm.setGauge("tasks_running", len(dict_running))
+            if len(dict_running) == 0:
+                continue
+            set_done, set_pending = wait(dict_running, return_when=FIRST_COMPLETED)
+            for future in set_done:
+                name = dict_running.pop(future)
+                if future.exception() is None:
+                    dict_status[name] = 'completed'
+                    logger.info(f"-> Task {name} is completed") if logger is not None else None
+                else:
+                    dict_status[name] = 'failed'
+                    logger.error(f"-> Task {name} failed: {future.exception()!r}", exc_info=future.exception()) if logger is not None else None
+
+    pm.setGauge("tasks_running", 0)
+    logger.info("Finish running tasks") if logger is not None else None
+
+    return dict_status
+
+# %%
+def runWorkbook(path_file, path_outray, dict_paths, int_workers, path_target=None, bool_isolatedlog=False, bool_delta=False, float_tolerance=1e-6,
+                str_outputformat="xlsx", int_lossworkers=1):
+    # one batch run of one workbook into its own (new, or given when resuming) out-tray folder; with bool_delta,
+    # only what changed since the previous run of the same workbook is exported (see run_delta.py)
+    dtts_begin = datetime.datetime.now()
+    dict_xlsxmeta, dict_xlsx = fh.readXLSXFile(path_file)
+    if path_target is None:
+        path_target, name_target = fh.createFolder(path_outray, dict_xlsxmeta['name'], dtts_begin)
+    else:
+        name_target = os.path.basename(path_target)
+    path_pickle = fh.createFolder(path_target+dict_paths['folder_pickle'])
+    # the requests of this thread and of the task threads it starts are counted into this run's metrics
+    pm.setRun(name_target)
+
+    # create log file    
+    logger = fh.createLog(path_target, name_target, bool_isolatedlog, bool_queued=True)
+    # every completed request is journaled, so that the run can be resumed with --resume if it is interrupted
+    dict_journal = rj.openJournal(path_target)
+    logger.info(f"Resume run with {len(dict_journal['entries'])} completed request(s) in the journal") if len(dict_journal['entries']) > 0 else None
+
+    # obtain Input Table and Parameters in dataframe format
+    df_inputtable = adf.getInputTable(dict_xlsx)
+    df_cpdproperties = adf.getCPDProperties(dict_xlsx)
+    dict_dcontrol = adf.getDeliverableControl(dict_xlsx)
+
+    # pre-flight validation: nothing is sent for an invalid workbook or row
+    with pm.timeStage("validate", name_target):
+        try:
+            checkCPDProperties(df_cpdproperties, dict_dcontrol, logger)
+        except ValueError:
+            pm.resetMetrics(name_target)
+            fh.closeLog(logger, dtts_begin, datetime.datetime.now())
+            raise
+        df_inputtable, df_rejected, dict_validrows = validateInputTable(df_inputtable, dict_dcontrol, logger)
+        adf.exportRejectedRows(path_target, df_rejected, logger)
+
+    # the deliverables are independent branches of a task graph and run concurrently, sharing one API client
+    dict_run = {
+        'path_target': path_target, 'name_target': name_target, 'path_pickle': path_pickle, 'dict_paths': dict_paths,
+        'df_inputtable': df_inputtable, 'dict_validrows': dict_validrows, 'df_cpdproperties': df_cpdproperties, 'dict_dcontrol': dict_dcontrol, 'logger': logger,
+        'dict_journal': dict_journal, 'str_outputformat': str_outputformat, 'int_lossworkers': int_lossworkers
+    }
+    if bool_delta:
+        dict_previous = rd.findPreviousRun(path_outray+"/_run_catalogue.sqlite", dict_xlsxmeta['file'], name_target)
+        dict_run['dict_delta'] = {'previous': dict_previous, 'rtol': float_tolerance, 'summaries': []}
+        logger.info(f"Delta mode: compare with the previous run {dict_previous['run']}" if dict_previous is not None else "Delta mode: no previous run of the workbook, everything is exported")
+    with pm.timeStage("total", name_target):
+        dict_status = runTaskGraph(genDeliverableTasks(dict_dcontrol), dict_run, int_workers, logger)
+    if bool_delta:
+        adf.exportDeltaSummary(path_target, pd.concat([pd.DataFrame(columns=rd.list_summarycols)]+dict_run['dict_delta']['summaries'], ignore_index=True), logger)
+    pm.writeMetrics(path_target, name_target)
+    pm.resetMetrics(name_target)
+    logger.info(f"Pipeline metrics are saved into {path_target}/metrics.prom and metrics.json")
+
+    dtts_finish = datetime.datetime.now()
+    dict_runinfo = {'workbook': dict_xlsxmeta['file'], 'mode': "delta" if bool_delta else "batch", 'started': dtts_begin.strftime("%Y-%m-%d %H:%M:%S"),
+                    'finished': dtts_finish.strftime("%Y-%m-%d %H:%M:%S"), 'rowsValid': len(df_inputtable), 'rowsRejected': len(df_rejected)}
+    rc.recordRun(path_outray+"/_run_catalogue.sqlite", path_target, dict_runinfo, df_cpdproperties, dict_dcontrol, dict_status)
+    fh.closeLog(logger, dtts_begin, dtts_finish) 
+
+    return path_target, dict_status
+
+# %%
+def watchInTray(path_intray, path_outray, dict_paths, int_jobs, int_workers, float_poll, logger, bool_delta=False, float_tolerance=1e-6, str_outputformat="xlsx",
+                int_lossworkers=1):
+    # Service mode: every workbook dropped into the in-tray becomes a job of its own. A pool of int_jobs workers
+    # runs the jobs (each with int_workers deliverable branches), all sharing the API token and connection pool,
+    # and each workbook is moved into its own run folder as soon as its run finishes.
+    logger.info(f"Begin watching {path_intray} with {int_jobs} job worker(s), polling every {float_poll} second(s) ...") if logger is not None else None
+
+    queue_jobs = queue.Queue()
+    set_queued = set()
+    dict_failed = {}
+    lock_queued = threading.Lock()
+
+    def workJobs():
+        while True:
+            filename = queue_jobs.get()
+            pm.setGauge("jobs_queued", queue_jobs.qsize(), "")
+            if filename is None:
+                break
+            try:
+                logger.info(f"-> Job {filename} is started ({queue_jobs.qsize()} job(s) waiting)") if logger is not None else None
+                path_target, dict_status = runWorkbook(path_intray+"/"+filename, path_outray, dict_paths, int_workers, bool_isolatedlog=True,
+                                                       bool_delta=bool_delta, float_tolerance=float_tolerance, str_outputformat=str_outputformat,
+                                                       int_lossworkers=int_lossworkers)
+                fh.moveFile(filename, path_intray, path_target)
+                logger.info(f"-> Job {filename} is completed into {path_target}: {dict_status}") if logger is not None else None
+            except Exception as e:
+                # the workbook stays in the in-tray and is not picked up again until it is modified
+                dict_failed[filename] = os.path.getmtime(path_intray+"/"+filename) if os.path.exists(path_intray+"/"+filename) else None
+                logger.error(f"-> Job {filename} failed: {e!r}", exc_info=e) if logger is not None else None
+            finally:
+                with lock_queued:
+                    set_queued.discard(filename)
+                queue_jobs.task_done()
+
+    list_threads = [threading.Thread(target=workJobs, name=f"job{i+1}", daemon=True) for i in range(max(1, int_jobs))]
+    for thread in list_threads:
+        thread.start()
+
+    # a file is queued once its size and modification time did not change over one polling interval,
+    # so that a workbook that is still being copied into the in-tray is not read half-written
+    dict_seen = {}
+    try:
+        while True:
+            for filename in fh.findInputFiles(path_intray):
+                full_path = path_intray+"/"+filename
+                try:
+                    tuple_stat = (os.path.getsize(full_path), os.path.getmtime(full_path))
+                except OSError:
+                    continue
+                with lock_queued:
+                    if filename in set_queued or dict_failed.get(filename, -1) == tuple_stat[1]:
+                        continue
+                    if dict_seen.get(filename) == tuple_stat:
+                        set_queued.add(filename)
+                        dict_failed.pop(filename, None)
+                        queue_jobs.put(filename)
+                        pm.setGauge("jobs_queued", queue_jobs.qsize(), "")
+                        logger.info(f"-> Job {filename} is queued") if logger is not None else None
+                dict_seen[filename] = tuple_stat
+            time.sleep(float_poll)
+    except KeyboardInterrupt:
+        logger.info("Stop watching; waiting for the running jobs to finish ...") if logger is not None else None
+    finally:
+        # queued jobs that have not started are dropped; their workbooks stay in the in-tray
+        while True:
+            try:
+                queue_jobs.get_nowait()
+                queue_jobs.task_done()
+            except queue.Empty:
+                break
+        for thread in list_threads:
+            queue_jobs.put(None)
+        for thread in list_threads:
+            thread.join()
+
+    logger.info("Finish watching the in-tray") if logger is not None else None
+
+    return None
+
+# %%
+def markChunkCompleted(path_target, int_part, int_rows):
+    # append-only manifest of the chunks whose outputs are durable
+    with open(f"{path_target}/stream_manifest.jsonl", 'a', encoding='utf-8') as file:
+        file.write(json.dumps({"part": int_part, "rows": int_rows})+"\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+# %%
+def runStreamingPipeline(path_file, path_target, dict_paths, dict_dcontrol, df_cpdproperties, int_chunksize, logger, dict_journal=None, str_outputformat="xlsx"):
+    # Each chunk of the Input Table goes through payload build -> submit -> flatten -> append-to-output
+    # -> entity-level portfolio inputs before the next chunk is read, so memory is bounded by the chunk size.
+    # Outputs of the chunks are written as part files (see fh.writePart) under the deliverable folders; with a
+    # parquet / csv str_outputformat, the climate PDs of each chunk go into the partitioned dataset instead, written
+    # in the background while the next chunk is processed.
+    logger.info(f"Begin streaming pipeline in chunks of {int_chunksize} rows ...") if logger is not None else None
+    # stage timings add up over the chunks
+    str_run = os.path.basename(path_target)
+    pm.setRun(str_run)
+    dtts_begin = time.perf_counter()
+    dtts_started = datetime.datetime.now()
+
+    bool_climatepds = dict_dcontrol.get('Retrieve Climate Adjusted PDs') == 'ENABLE'
+    bool_industry = dict_dcontrol.get('Retrieve Transition Risk Drivers for Industry (Sector)') == 'ENABLE'
+    bool_region = dict_dcontrol.get('Retrieve Transition Risk Drivers for Country (Region)') == 'ENABLE'
+    bool_reports = dict_dcontrol.get('Access Pre-defined reports') == 'ENABLE'
+    bool_esg = dict_dcontrol.get('Request ESG Score Predictor') == 'ENABLE'
+
+    path_climatePD = fh.createFolder(path_target+dict_paths['output_climatePD']) if bool_climatepds else None
+    path_transrisk = fh.createFolder(path_target+dict_paths['output_transrisk']) if bool_industry or bool_region else None
+    path_reports = fh.createFolder(path_target+dict_paths['output_reports']) if bool_reports else None
+    path_esg = fh.createFolder(path_target+dict_paths['output_esg']) if bool_esg else None
+    dict_dataset = dw.openDataset(path_climatePD+"/dataset", str_outputformat, logger=logger) if bool_climatepds and str_outputformat != "xlsx" else None
+    # chunks whose dataset parts are still being written: (part, rows, futures of the writes)
+    list_pending = []
+    if bool_climatepds and dict_dcontrol.get('Simulate Portfolio Loss') == 'ENABLE':
+        logger.info("-> Simulate Portfolio Loss needs the whole portfolio at once and is skipped in streaming mode") if logger is not None else None
+
+    # transition risk drivers only depend on the distinct industry / region codes, which are collected across chunks
+    list_codecols = ['EDF-XIndustryClass', 'EDF-XIndustryCode', 'primaryCountry']
+    df_codes = None
+    path_index = dict_paths['root_path']+dict_paths['folder_reference']+"/identifier_index.sqlite"
+
+    checkCPDProperties(df_cpdproperties, dict_dcontrol, logger)
+
+    int_part = 0
+    int_rowoffset = 0
+    int_rejected = 0
+    int_valid = 0
+    for df_chunk in fh.iterXLSXChunks(path_file, 'Input Table', int_chunksize):
+        int_part += 1
+        df_inputtable = adf.getInputTable({'Input Table': df_chunk})
+        with runStage("validate", str_run, path_target):
+            df_inputtable, df_rejected, dict_validrows = validateInputTable(df_inputtable, dict_dcontrol, logger, int_rowoffset)
+            if len(df_rejected) > 0:
+                fh.writePart(path_target, "_rejected_rows", int_part, df_rejected)
+        int_rowoffset += len(df_chunk)
+        int_rejected += len(df_rejected)
+        # rows without an entityId are dropped by getInputTable, so they are neither valid nor rejected
+        int_valid += len(df_inputtable)
+        logger.info(f"-> Chunk #{int_part}: {len(df_inputtable)} row(s)") if logger is not None else None
+        list_futures = []
+        if len(df_inputtable) == 0:
+            continue
+
+        if bool_climatepds or bool_reports:
+            with runStage("entities.resolve", str_run, path_target):
+                df_inputtable_entities, df_unresolved = resolveEntities(path_index, selectValidRows(dict_validrows, iv.tuple_core, df_inputtable), logger, dict_journal)
+            if len(df_unresolved) > 0:
+                logger.info(f"-> {len(df_unresolved)} row(s) with an unresolvable identifier are left out") if logger is not None else None
+                fh.writePart(path_target, "_unresolved_entities", int_part, df_unresolved)
+
+        if bool_climatepds:
+            with runStage("climatePDs.build", str_run, path_target):
+                bool_isasync, list_apiinputs_climatepds = adf.genListOfAPIInput_ClimatePDs(df_cpdproperties, selectValidRows(dict_validrows, ('climatePDs',), df_inputtable_entities), logger)
+            with runStage("climatePDs.submit", str_run, path_target):
+                list_responses_climatepds = amc.obtainClimatePDs(bool_isasync, list_apiinputs_climatepds, logger, dict_journal)
+            with runStage("climatePDs.flatten", str_run, path_target):
+                list_ownfirmoutputs_climatepds = adf.extractAPIOutput_ClimatePDs(list_responses_climatepds, logger, int_workers=getFlattenWorkers())
+            del list_responses_climatepds
+            with runStage("climatePDs.store", str_run, path_target):
+                storeTermStructures(dict_paths, str_run, list_ownfirmoutputs_climatepds, logger, bool_flush=False)
+            with runStage("climatePDs.export", str_run, path_target):
+                list_valid = [df for df in list_ownfirmoutputs_climatepds if df is not None]
+                if dict_dataset is not None:
+                    list_futures = dw.submitOutputs(dict_dataset, int_part, list_valid)
+                else:
+                    adf.exportAPIOutput_ClimatePDs(path_climatePD, list_ownfirmoutputs_climatepds, logger, bool_combined=False)
+                    if len(list_valid) > 0:
+                        fh.writePart(path_climatePD, "_combined_all", int_part, pd.concat(list_valid))
+                if len(list_valid) > 0:
+                    df_edf1 = amodel.calculateForwardPDs(list_valid)
+                    fh.writePart(path_climatePD, "_forward_pds", int_part,
+                                 df_edf1[['entityId']+amodel.list_portfoliokeys+amodel.list_portfoliocols])
+
+        if bool_industry or bool_region:
+            # the codes of a row are kept with the transition risk deliverables it is valid for
+            df_chunkcodes = df_inputtable[list_codecols].assign(
+                bool_industry=df_inputtable.index.isin(selectValidRows(dict_validrows, ('transRiskIndustry',), df_inputtable).index),
+                bool_region=df_inputtable.index.isin(selectValidRows(dict_validrows, ('transRiskRegion',), df_inputtable).index))
+            df_codes = pd.concat([df_codes, df_chunkcodes]).drop_duplicates()
+
+        if bool_reports:
+            with runStage("reports.submit", str_run, path_target):
+                list_apiinputs_reports = adf.genListOfAPIInput_Reports(df_cpdproperties, selectValidRows(dict_validrows, ('reports',), df_inputtable_entities), logger)
+                amc.downloadReports(path_reports, list_apiinputs_reports, logger, dict_journal)
+
+        if bool_esg:
+            with runStage("esg.submit", str_run, path_target):
+                list_apiinputs_esg = adf.genAPIInput_ESG(df_cpdproperties, selectValidRows(dict_validrows, ('esg',), df_inputtable), logger)
+                response_esg = amc.obtainESG(list_apiinputs_esg , logger, dict_journal)
+            with runStage("esg.export", str_run, path_target):
+                fh.writePart(path_esg, "ESG_scores", int_part, adf.extractAPIOutput_ESG(response_esg, logger))
+
+        # a chunk is completed once its dataset parts are on disk as well, in the order of the chunks
+        list_pending.append((int_part, len(df_inputtable), list_futures))
+        while len(list_pending) > 0 and all(future.done() and future.exception() is None for future in list_pending[0][2]):
+            markChunkCompleted(path_target, *list_pending.pop(0)[:2])
+        logger.info(f"-> Chunk #{int_part} is processed") if logger is not None else None
+
+    if dict_dataset is not None:
+        with runStage("climatePDs.export", str_run, path_target):
+            int_files = dw.closeDataset(dict_dataset)
+        logger.info(f"-> {int_files} partition file(s) are written into {path_climatePD}/dataset") if logger is not None else None
+    for int_pendingpart, int_rows, list_futures in list_pending:
+        markChunkCompleted(path_target, int_pendingpart, int_rows)
+
+    if bool_climatepds:
+        with runStage("climatePDs.store", str_run, path_target):
+            tss.flushTermStructures(dict_paths['root_path']+dict_paths['folder_reference']+"/term_structures", str_run)
+    if bool_climatepds:
+        # the median needs every entity: the forward PD parts are regrouped on disk and taken one group at a time
+        with runStage("climatePDs.portfolio", str_run, path_target):
+            df_portfolio_edf = amodel.aggregatePortfolioPDParts(fh.iterParts(path_climatePD, "_forward_pds", amodel.list_portfoliokeys+amodel.list_portfoliocols),
+                                                               path_climatePD+"/_portfolio_groups")
+            if df_portfolio_edf is not None:
+                adf.exportPortfolioPDs(path_climatePD, df_portfolio_edf, logger)
+
+    path_store = dict_paths['root_path']+dict_paths['folder_reference']+"/transition_paths.sqlite"
+    if bool_industry and df_codes is not None:
+        with runStage("transRiskIndustry.submit", str_run, path_target):
+            dict_apiinputs_industry = adf.genAPIInput_TransRiskIndustry(df_cpdproperties, df_codes[df_codes['bool_industry']], logger)
+            fetchMissingTransitionPaths(path_store, dict_apiinputs_industry, amc.obtainTransRiskIndustry, adf.extractAPIOutput_TransRiskIndustry, logger, dict_journal)
+        with runStage("transRiskIndustry.export", str_run, path_target):
+            df_ownfirmoutputs_industry = rs.lookupTransitionPaths(path_store, dict_apiinputs_industry)
+            adf.exportAPIOutput_TransRiskIndustry(path_transrisk, df_ownfirmoutputs_industry, logger)
+
+    if bool_region and df_codes is not None:
+        with runStage("transRiskRegion.submit", str_run, path_target):
+            dict_apiinputs_region = adf.genAPIInput_TransRiskRegion(df_cpdproperties, df_codes[df_codes['bool_region']], logger)
+            fetchMissingTransitionPaths(path_store, dict_apiinputs_region, amc.obtainTransRiskRegion, adf.extractAPIOutput_TransRiskRegion, logger, dict_journal)
+        with runStage("transRiskRegion.export", str_run, path_target):
+            df_ownfirmoutputs_region = rs.lookupTransitionPaths(path_store, dict_apiinputs_region)
+            adf.exportAPIOutput_TransRiskRegion(path_transrisk, df_ownfirmoutputs_region, logger)
+
+    pm.observeStage("total", time.perf_counter()-dtts_begin, str_run)
+    pm.writeMetrics(path_target, str_run)
+    pm.resetMetrics(str_run)
+    dict_runinfo = {'workbook': os.path.basename(path_file), 'mode': "stream", 'started': dtts_started.strftime("%Y-%m-%d %H:%M:%S"),
+                    'finished': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'rowsValid': int_valid, 'rowsRejected': int_rejected}
+    rc.recordRun(dict_paths['root_path']+dict_paths['folder_outtray']+"/_run_catalogue.sqlite", path_target, dict_runinfo,
+                 df_cpdproperties, dict_dcontrol, {'chunks': int_part})
+    logger.info(f"Finish streaming pipeline, {int_part} chunk(s) processed") if logger is not None else None
+
+    return int_part
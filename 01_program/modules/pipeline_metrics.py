@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Pipeline metrics, shared by all threads (and by all jobs of the --watch service) and kept per run:
+#   stage durations      - per stage, from timeStage() / observeStage()
+#   requests             - per endpoint: count by status code, latency histogram, bytes downloaded and sent
+#                          (decoded and as on the wire, i.e. after compression; request bodies also as the
+#                          indented JSON they were sent as before the compact wire format)
+#   retries              - per endpoint, from countRetry()
+#   hedges               - per endpoint, duplicate GETs sent and how many of them answered first, from countHedge()
+#   breakers             - per endpoint, circuit breaker state and number of times it opened, from setBreakerState()
+#   gauges               - e.g. requests in flight, job queue depth
+# Everything is keyed by (run, name). Request counters and gauges go to the run of the calling thread (see setRun(),
+# bindRun()), so that the concurrent jobs of the --watch service do not count each other's requests; what is recorded
+# outside of a run (run "", e.g. the job queue depth) is process-wide and goes into every run's metrics.
+# writeMetrics() saves them into a run folder as a Prometheus textfile (metrics.prom) and a JSON summary
+# (metrics.json), and resetMetrics(str_run) drops the run when it finishes.
+
+list_latencybuckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+lock_metrics = threading.Lock()
+dict_metrics = {'stages': {}, 'requests': {}, 'retries': {}, 'gauges': {}, 'bodies': {}, 'hedges': {}, 'breakers': {}}
+
+# run of the current thread
+var_run = contextvars.ContextVar('str_run', default="")
+
+# numeric value of the breaker states in metrics.prom
+dict_breakerstates = {'closed': 0, 'half_open': 1, 'open': 2}
+
+# %%
+def setRun(str_run):
+    # the metrics recorded by this thread from now on belong to str_run
+    var_run.set(str_run)
+
+def bindRun(func):
+    # threads do not inherit context variables: func records its metrics under the run of the thread that bound it
+    str_run = var_run.get()
+    def runBound(*args, **kwargs):
+        token = var_run.set(str_run)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            var_run.reset(token)
+    return runBound
+
+def resetMetrics(str_run=None):
+    # drop the metrics of str_run, or all of them
+    with lock_metrics:
+        for dict_values in dict_metrics.values():
+            for key in [key for key in dict_values if str_run is None or key[0] == str_run]:
+                del dict_values[key]
+
+def getRunMetrics(str_kind, str_run):
+    # {name: values} of str_run (lock_metrics is held)
+    return {name: values for (run, name), values in dict_metrics[str_kind].items() if run == str_run}
+
+@contextmanager
+def timeStage(str_stage, str_run=""):
+    dtts_begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        observeStage(str_stage, time.perf_counter()-dtts_begin, str_run)
+
+def observeStage(str_stage, float_seconds, str_run=""):
+    with lock_metrics:
+        dict_stage = dict_metrics['stages'].setdefault((str_run, str_stage), {'seconds': 0.0, 'count': 0})
+        dict_stage['seconds'] += float_seconds
+        dict_stage['count'] += 1
+
+def observeRequest(str_endpoint, float_seconds, status, int_bytes, int_wirebytes=None):
+    with lock_metrics:
+        dict_endpoint = dict_metrics['requests'].setdefault((var_run.get(), str_endpoint), {
+            'count': 0, 'statuses': {}, 'seconds': 0.0, 'bytes': 0, 'wireBytes': 0, 'buckets': [0]*(len(list_latencybuckets)+1)
+        })
+        dict_endpoint['count'] += 1
+        dict_endpoint['statuses'][str(status)] = dict_endpoint['statuses'].get(str(status), 0) + 1
+        dict_endpoint['seconds'] += float_seconds
+        dict_endpoint['bytes'] += int_bytes
+        dict_endpoint['wireBytes'] += int_wirebytes if int_wirebytes is not None else int_bytes
+        # buckets are stored non-cumulative, the last one being +Inf
+        idx = next((i for i, bound in enumerate(list_latencybuckets) if float_seconds <= bound), len(list_latencybuckets))
+        dict_endpoint['buckets'][idx] += 1
+
+def observeRequestBody(str_endpoint, int_bytes, int_wirebytes, int_baselinebytes=None):
+    # size of a request body before and after compression, and in the indented JSON of before (wf.getIndentedBytes)
+    with lock_metrics:
+        dict_body = dict_metrics['bodies'].setdefault((var_run.get(), str_endpoint), {'bytes': 0, 'wireBytes': 0, 'baselineBytes': 0})
+        dict_body['bytes'] += int_bytes
+        dict_body['wireBytes'] += int_wirebytes
+        dict_body['baselineBytes'] += int_baselinebytes if int_baselinebytes is not None else int_bytes
+
+def countRetry(str_endpoint, int_count=1):
+    with lock_metrics:
+        key = (var_run.get(), str_endpoint)
+        dict_metrics['retries'][key] = dict_metrics['retries'].get(key, 0) + int_count
+
+def countHedge(str_endpoint, bool_won=False):
+    # a hedged (duplicate) request was sent, or (bool_won) it answered before the original request
+    with lock_metrics:
+        dict_hedge = dict_metrics['hedges'].setdefault((var_run.get(), str_endpoint), {'sent': 0, 'won': 0})
+        dict_hedge['won' if bool_won else 'sent'] += 1
+
+def setBreakerState(str_endpoint, str_state):
+    with lock_metrics:
+        dict_breaker = dict_metrics['breakers'].setdefault((var_run.get(), str_endpoint), {'state': 'closed', 'opened': 0})
+        dict_breaker['opened'] += 1 if str_state == 'open' else 0
+        dict_breaker['state'] = str_state
+
+def setGauge(str_name, float_value, str_run=None):
+    # str_run "" for a process-wide gauge
+    with lock_metrics:
+        dict_metrics['gauges'][(var_run.get() if str_run is None else str_run, str_name)] = float_value
+
+def addGauge(str_name, float_value):
+    with lock_metrics:
+        key = (var_run.get(), str_name)
+        dict_metrics['gauges'][key] = dict_metrics['gauges'].get(key, 0) + float_value
+
+# %%
+def estimateQuantile(list_buckets, float_q):
+    # upper bound of the histogram bucket holding the q-quantile (None when empty or in the +Inf bucket)
+    int_total = sum(list_buckets)
+    if int_total == 0:
+        return None
+    int_cum = 0
+    for i, int_count in enumerate(list_buckets):
+        int_cum += int_count
+        if int_cum >= float_q*int_total:
+            return list_latencybuckets[i] if i < len(list_latencybuckets) else None
+    return None
+
+def getBytesSaved(dict_endpoint, dict_body):
+    # bytes kept off the wire: by compression for the responses, by the compact encoding and compression for the
+    # request bodies
+    return dict_endpoint.get('bytes', 0)-dict_endpoint.get('wireBytes', 0)+dict_body.get('baselineBytes', 0)-dict_body.get('wireBytes', 0)
+
+def getSummary(str_run=None):
+    # JSON-friendly snapshot of str_run (by default, the run of the calling thread)
+    str_run = var_run.get() if str_run is None else str_run
+    with lock_metrics:
+        dict_requests, dict_bodies, dict_retries = getRunMetrics('requests', str_run), getRunMetrics('bodies', str_run), getRunMetrics('retries', str_run)
+        dict_summary = {
+            'run': str_run,
+            'stages': {stage: dict(values) for stage, values in getRunMetrics('stages', str_run).items()},
+            'endpoints': {},
+            'gauges': {**getRunMetrics('gauges', ""), **getRunMetrics('gauges', str_run)},
+        }
+        for str_endpoint, dict_endpoint in dict_requests.items():
+            dict_summary['endpoints'][str_endpoint] = {
+                'count': dict_endpoint['count'],
+                'statuses': dict(dict_endpoint['statuses']),
+                'secondsTotal': dict_endpoint['seconds'],
+                'secondsMean': dict_endpoint['seconds']/dict_endpoint['count'],
+                'secondsP50': estimateQuantile(dict_endpoint['buckets'], 0.5),
+                'secondsP95': estimateQuantile(dict_endpoint['buckets'], 0.95),
+                'bytes': dict_endpoint['bytes'],
+                'wireBytes': dict_endpoint['wireBytes'],
+                'requestBytes': dict_bodies.get(str_endpoint, {}).get('bytes', 0),
+                'requestWireBytes': dict_bodies.get(str_endpoint, {}).get('wireBytes', 0),
+                'requestBaselineBytes': dict_bodies.get(str_endpoint, {}).get('baselineBytes', 0),
+                'bytesSaved': getBytesSaved(dict_endpoint, dict_bodies.get(str_endpoint, {})),
+                'retries': dict_retries.get(str_endpoint, 0),
+                'latencyBuckets': dict(zip([str(b) for b in list_latencybuckets]+['+Inf'], dict_endpoint['buckets'])),
+            }
+        for str_endpoint, int_retries in dict_retries.items():
+            if str_endpoint not in dict_summary['endpoints']:
+                dict_summary['endpoints'][str_endpoint] = {'count': 0, 'retries': int_retries}
+        for str_endpoint, dict_hedge in getRunMetrics('hedges', str_run).items():
+            dict_summary['endpoints'].setdefault(str_endpoint, {'count': 0}).update({'hedges': dict_hedge['sent'], 'hedgesWon': dict_hedge['won']})
+        for str_endpoint, dict_breaker in getRunMetrics('breakers', str_run).items():
+            dict_summary['endpoints'].setdefault(str_endpoint, {'count': 0}).update({'breakerState': dict_breaker['state'], 'breakerOpened': dict_breaker['opened']})
+
+    return dict_summary
+
+def formatPrometheus(str_run=None):
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    str_run = var_run.get() if str_run is None else str_run
+    list_lines = []
+    with lock_metrics:
+        dict_requests, dict_bodies = getRunMetrics('requests', str_run), getRunMetrics('bodies', str_run)
+        dict_hedges, dict_breakers = getRunMetrics('hedges', str_run), getRunMetrics('breakers', str_run)
+
+        list_lines += ["# HELP climateapi_stage_duration_seconds Time spent in a pipeline stage.",
+                       "# TYPE climateapi_stage_duration_seconds gauge"]
+        for stage, values in sorted(getRunMetrics('stages', str_run).items()):
+            list_lines.append(f'climateapi_stage_duration_seconds{{run="{label(str_run)}",stage="{label(stage)}"}} {values["seconds"]:.6f}')
+
+        list_lines += ["# HELP climateapi_requests_total HTTP requests sent, by endpoint and status code.",
+                       "# TYPE climateapi_requests_total counter"]
+        for str_endpoint, dict_endpoint in sorted(dict_requests.items()):
+            for status, int_count in sorted(dict_endpoint['statuses'].items()):
+                list_lines.append(f'climateapi_requests_total{{endpoint="{label(str_endpoint)}",status="{label(status)}"}} {int_count}')
+
+        list_lines += ["# HELP climateapi_request_duration_seconds HTTP request latency, by endpoint.",
+                       "# TYPE climateapi_request_duration_seconds histogram"]
+        for str_endpoint, dict_endpoint in sorted(dict_requests.items()):
+            int_cum = 0
+            for bound, int_count in zip([str(b) for b in list_latencybuckets]+['+Inf'], dict_endpoint['buckets']):
+                int_cum += int_count
+                list_lines.append(f'climateapi_request_duration_seconds_bucket{{endpoint="{label(str_endpoint)}",le="{bound}"}} {int_cum}')
+            list_lines.append(f'climateapi_request_duration_seconds_sum{{endpoint="{label(str_endpoint)}"}} {dict_endpoint["seconds"]:.6f}')
+            list_lines.append(f'climateapi_request_duration_seconds_count{{endpoint="{label(str_endpoint)}"}} {dict_endpoint["count"]}')
+
+        list_lines += ["# HELP climateapi_response_bytes_total Response bytes downloaded, by endpoint.",
+                       "# TYPE climateapi_response_bytes_total counter"]
+        for str_endpoint, dict_endpoint in sorted(dict_requests.items()):
+            list_lines.append(f'climateapi_response_bytes_total{{endpoint="{label(str_endpoint)}"}} {dict_endpoint["bytes"]}')
+
+        list_lines += ["# HELP climateapi_response_wire_bytes_total Response bytes received on the wire (compressed), by endpoint.",
+                       "# TYPE climateapi_response_wire_bytes_total counter"]
+        for str_endpoint, dict_endpoint in sorted(dict_requests.items()):
+            list_lines.append(f'climateapi_response_wire_bytes_total{{endpoint="{label(str_endpoint)}"}} {dict_endpoint["wireBytes"]}')
+
+        list_lines += ["# HELP climateapi_request_bytes_total Request body bytes before compression, by endpoint.",
+                       "# TYPE climateapi_request_bytes_total counter"]
+        for str_endpoint, dict_body in sorted(dict_bodies.items()):
+            list_lines.append(f'climateapi_request_bytes_total{{endpoint="{label(str_endpoint)}"}} {dict_body["bytes"]}')
+
+        list_lines += ["# HELP climateapi_request_wire_bytes_total Request body bytes sent on the wire (compressed), by endpoint.",
+                       "# TYPE climateapi_request_wire_bytes_total counter"]
+        for str_endpoint, dict_body in sorted(dict_bodies.items()):
+            list_lines.append(f'climateapi_request_wire_bytes_total{{endpoint="{label(str_endpoint)}"}} {dict_body["wireBytes"]}')
+
+        list_lines += ["# HELP climateapi_request_baseline_bytes_total Request body bytes in the indented JSON sent before the compact wire format, by endpoint.",
+                       "# TYPE climateapi_request_baseline_bytes_total counter"]
+        for str_endpoint, dict_body in sorted(dict_bodies.items()):
+            list_lines.append(f'climateapi_request_baseline_bytes_total{{endpoint="{label(str_endpoint)}"}} {dict_body["baselineBytes"]}')
+
+        list_lines += ["# HELP climateapi_bytes_saved_total Bytes kept off the wire by the compact encoding of the requests and by compression, by endpoint.",
+                       "# TYPE climateapi_bytes_saved_total counter"]
+        for str_endpoint in sorted(set(dict_requests) | set(dict_bodies)):
+            list_lines.append(f'climateapi_bytes_saved_total{{endpoint="{label(str_endpoint)}"}} {getBytesSaved(dict_requests.get(str_endpoint, {}), dict_bodies.get(str_endpoint, {}))}')
+
+        list_lines += ["# HELP climateapi_retries_total Requests sent again, by endpoint.",
+                       "# TYPE climateapi_retries_total counter"]
+        for str_endpoint, int_retries in sorted(getRunMetrics('retries', str_run).items()):
+            list_lines.append(f'climateapi_retries_total{{endpoint="{label(str_endpoint)}"}} {int_retries}')
+
+        list_lines += ["# HELP climateapi_hedged_requests_total Duplicate GETs sent for slow requests, by endpoint.",
+                       "# TYPE climateapi_hedged_requests_total counter"]
+        for str_endpoint, dict_hedge in sorted(dict_hedges.items()):
+            list_lines.append(f'climateapi_hedged_requests_total{{endpoint="{label(str_endpoint)}"}} {dict_hedge["sent"]}')
+
+        list_lines += ["# HELP climateapi_hedged_wins_total Duplicate GETs that answered before the original request, by endpoint.",
+                       "# TYPE climateapi_hedged_wins_total counter"]
+        for str_endpoint, dict_hedge in sorted(dict_hedges.items()):
+            list_lines.append(f'climateapi_hedged_wins_total{{endpoint="{label(str_endpoint)}"}} {dict_hedge["won"]}')
+
+        list_lines += ["# HELP climateapi_circuit_breaker_state Circuit breaker state, by endpoint (0 closed, 1 half-open, 2 open).",
+                       "# TYPE climateapi_circuit_breaker_state gauge"]
+        for str_endpoint, dict_breaker in sorted(dict_breakers.items()):
+            list_lines.append(f'climateapi_circuit_breaker_state{{endpoint="{label(str_endpoint)}"}} {dict_breakerstates[dict_breaker["state"]]}')
+
+        list_lines += ["# HELP climateapi_circuit_breaker_opened_total Times the circuit breaker opened, by endpoint.",
+                       "# TYPE climateapi_circuit_breaker_opened_total counter"]
+        for str_endpoint, dict_breaker in sorted(dict_breakers.items()):
+            list_lines.append(f'climateapi_circuit_breaker_opened_total{{endpoint="{label(str_endpoint)}"}} {dict_breaker["opened"]}')
+
+        for str_name, float_value in sorted({**getRunMetrics('gauges', ""), **getRunMetrics('gauges', str_run)}.items()):
+            list_lines += [f"# TYPE climateapi_{str_name} gauge", f"climateapi_{str_name} {float_value}"]
+
+    return "\n".join(list_lines)+"\n"
+
+def writeMetrics(path_target, str_run=None):
+    # both files are renamed into place, so that a textfile collector never reads a half-written file
+    for str_file, str_content in [("metrics.prom", formatPrometheus(str_run)),
+                                  ("metrics.json", json.dumps(getSummary(str_run), indent=4))]:
+        with open(f"{path_target}/{str_file}.tmp", 'w', encoding='utf-8') as file:
+            file.write(str_content)
+        os.replace(f"{path_target}/{str_file}.tmp", f"{path_target}/{str_file}")
+
+    return f"{path_target}/metrics.json"
@@ -0,0 +1,73 @@
+import os
+import io
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Profiling of the pipeline stages, enabled by main.py --profile. Each stage of a run gets, in <run folder>/profile:
+#   <stage>.prof        - cProfile stats (open with snakeviz, or convert to a flame graph with flameprof / gprof2dot)
+#   <stage>_cpu.txt     - top functions by cumulative time
+#   <stage>_memory.txt  - peak traced memory and top allocations (by line) of the stage still alive at its end
+# A stage that runs more than once in a run (e.g. per chunk in streaming mode) adds up into the same .prof,
+# and its memory report is the one of the call with the highest peak.
+# Only one profiler can be active at a time (and cProfile only sees the calling thread), so profiled stages run
+# one after the other; main.py runs the deliverables with one worker when profiling.
+
+lock_profiler = threading.Lock()
+dict_profiling = {'enabled': False, 'int_top': 25, 'profilers': {}, 'peaks': {}}
+
+# %%
+def enableProfiling(int_top=25, int_frames=1):
+    dict_profiling['enabled'] = True
+    dict_profiling['int_top'] = int_top
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(int_frames)
+
+@contextmanager
+def profileStage(path_target, str_stage):
+    if not dict_profiling['enabled']:
+        yield
+        return
+
+    with lock_profiler:
+        key = (path_target, str_stage)
+        profiler = dict_profiling['profilers'].setdefault(key, cProfile.Profile())
+        # only the allocations of this stage are traced: comparing two snapshots of the whole heap is far slower
+        tracemalloc.clear_traces()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            int_peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            writeStageProfile(path_target, str_stage, profiler, snapshot, int_peak)
+
+def writeStageProfile(path_target, str_stage, profiler, snapshot, int_peak):
+    path_profile = f"{path_target}/profile"
+    os.makedirs(path_profile, exist_ok=True)
+    int_top = dict_profiling['int_top']
+
+    profiler.dump_stats(f"{path_profile}/{str_stage}.prof")
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(int_top)
+    with open(f"{path_profile}/{str_stage}_cpu.txt", 'w', encoding='utf-8') as file:
+        file.write(stream.getvalue())
+
+    key = (path_target, str_stage)
+    if int_peak < dict_profiling['peaks'].get(key, -1):
+        return None
+    dict_profiling['peaks'][key] = int_peak
+
+    # allocations made by the profiling itself are left out
+    set_skipped = {tracemalloc.__file__, pstats.__file__, cProfile.__file__}
+    list_stats = [stat for stat in snapshot.statistics('lineno') if stat.traceback[0].filename not in set_skipped]
+    with open(f"{path_profile}/{str_stage}_memory.txt", 'w', encoding='utf-8') as file:
+        file.write(f"Peak traced memory during the stage: {int_peak/1024/1024:.2f} MiB\n")
+        file.write(f"Top {int_top} allocations made during the stage and still alive at its end:\n")
+        for stat in list_stats[:int_top]:
+            file.write(f"{stat}\n")
+
+    return None
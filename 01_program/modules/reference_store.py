@@ -0,0 +1,133 @@
+import os
+import re
+import sqlite3
+import datetime
+import threading
+import pandas as pd
+
+# Local reference store of the transition paths for industry and region, shared by all runs (SQLite):
+#   transition_paths - long format, one row per (scenarioCategory, industry, region, scenario, year, variable);
+#                      region is '' for the industry-level paths, value is numeric, valueText keeps non-numeric values
+#   fetched_codes    - the industry codes and (region,industry) pairs already fetched per scenarioCategory
+# Only the codes missing from fetched_codes are requested from the API, every lookup is answered from the store.
+# The paths only change with the NGFS scenario vintage: delete the store file to fetch everything again.
+
+lock_store = threading.Lock()
+
+list_idcols = ['scenarioCategory', 'industry', 'region', 'scenario', 'year']
+
+str_schema = """
+CREATE TABLE IF NOT EXISTS transition_paths (
+    scenarioCategory TEXT NOT NULL,
+    industry         TEXT NOT NULL,
+    region           TEXT NOT NULL,
+    scenario         TEXT NOT NULL,
+    year             INTEGER NOT NULL,
+    variable         TEXT NOT NULL,
+    value            REAL,
+    valueText        TEXT,
+    PRIMARY KEY (scenarioCategory, industry, region, scenario, year, variable)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_transition_paths_region ON transition_paths (scenarioCategory, region, industry);
+CREATE TABLE IF NOT EXISTS fetched_codes (
+    scenarioCategory TEXT NOT NULL,
+    industry         TEXT NOT NULL,
+    region           TEXT NOT NULL,
+    fetched          TEXT NOT NULL,
+    PRIMARY KEY (scenarioCategory, industry, region)
+) WITHOUT ROWID;
+"""
+
+# %%
+def openStore(path_store):
+    os.makedirs(os.path.dirname(path_store), exist_ok=True)
+    conn = sqlite3.connect(path_store, timeout=60)
+    # concurrent runs (e.g. --watch jobs) read while another one writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(str_schema)
+    return conn
+
+def parseCodes(dict_apiinputs):
+    # (industry, region) pairs of an API input of genAPIInput_TransRiskIndustry / genAPIInput_TransRiskRegion
+    if "regionIndustry" in dict_apiinputs:
+        return [(industry.strip(), region.strip()) for region, industry in re.findall(r"\(([^,()]*),([^,()]*)\)", dict_apiinputs["regionIndustry"])]
+    return [(code.strip(), '') for code in dict_apiinputs["industry"].split(",") if code.strip() != ""]
+
+def formatCodes(dict_apiinputs, list_codes):
+    # the same API input, for the given (industry, region) pairs only
+    dict_subset = dict(dict_apiinputs)
+    if "regionIndustry" in dict_apiinputs:
+        dict_subset["regionIndustry"] = ",".join(f"({region},{industry})" for industry, region in list_codes)
+    else:
+        dict_subset["industry"] = ",".join(industry for industry, region in list_codes)
+    return dict_subset
+
+# %%
+def filterMissingCodes(path_store, dict_apiinputs):
+    # the API input restricted to the codes that are not in the store yet, or None if all of them are
+    list_codes = list(dict.fromkeys(parseCodes(dict_apiinputs)))
+    conn = openStore(path_store)
+    try:
+        set_fetched = set(conn.execute("SELECT industry, region FROM fetched_codes WHERE scenarioCategory = ?",
+                                       (dict_apiinputs["scenarioCategory"],)).fetchall())
+    finally:
+        conn.close()
+
+    list_missing = [code for code in list_codes if code not in set_fetched]
+    if len(list_missing) == 0:
+        return None
+    return formatCodes(dict_apiinputs, list_missing)
+
+def storeTransitionPaths(path_store, dict_apiinputs, df_ownfirmoutputs):
+    # save the flattened paths (extractAPIOutput_TransRiskIndustry / Region) of the fetched codes in long format;
+    # codes without any path are marked as fetched too, so that they are not requested again
+    str_scencat = dict_apiinputs["scenarioCategory"]
+    df_long = pd.DataFrame(columns=list_idcols+['variable', 'value', 'valueText'])
+    if df_ownfirmoutputs is not None and len(df_ownfirmoutputs) > 0:
+        df = df_ownfirmoutputs.copy()
+        if 'region' not in df.columns:
+            df['region'] = ''
+        df['scenarioCategory'] = str_scencat
+        df['year'] = pd.to_numeric(df['year']).astype(int)
+        df_long = df.melt(id_vars=list_idcols, var_name='variable', value_name='valueText')
+        df_long['value'] = pd.to_numeric(df_long['valueText'], errors='coerce')
+        df_long['valueText'] = df_long['valueText'].where(df_long['value'].isna(), None)
+
+    str_fetched = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    list_fetched = [(str_scencat, industry, region, str_fetched) for industry, region in parseCodes(dict_apiinputs)]
+    with lock_store:
+        conn = openStore(path_store)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO transition_paths VALUES (?,?,?,?,?,?,?,?)",
+                                 df_long[list_idcols+['variable', 'value', 'valueText']].astype(object).where(df_long.notna(), None).itertuples(index=False, name=None))
+                conn.executemany("INSERT OR REPLACE INTO fetched_codes VALUES (?,?,?,?)", list_fetched)
+        finally:
+            conn.close()
+
+    return len(df_long)
+
+def lookupTransitionPaths(path_store, dict_apiinputs):
+    # the paths of the codes of an API input, in the layout of extractAPIOutput_TransRiskIndustry / Region
+    bool_region = "regionIndustry" in dict_apiinputs
+    conn = openStore(path_store)
+    try:
+        conn.execute("CREATE TEMP TABLE codes (industry TEXT NOT NULL, region TEXT NOT NULL)")
+        conn.executemany("INSERT INTO codes VALUES (?,?)", set(parseCodes(dict_apiinputs)))
+        df_long = pd.read_sql_query(
+            "SELECT t.* FROM codes c JOIN transition_paths t ON t.scenarioCategory = ? AND t.industry = c.industry AND t.region = c.region",
+            conn, params=(dict_apiinputs["scenarioCategory"],))
+    finally:
+        conn.close()
+
+    if len(df_long) == 0:
+        return None
+
+    list_keys = ['scenario', 'region', 'industry', 'year'] if bool_region else ['scenario', 'industry', 'year']
+    df_long['value'] = df_long['value'].astype(object).where(df_long['value'].notna(), df_long['valueText'])
+    df_wide = df_long.pivot(index=list_keys, columns='variable', values='value').reset_index()
+    df_wide = df_wide.infer_objects()
+    df_wide.columns.name = None
+    list_sortcols = ['region', 'industry', 'scenario', 'year'] if bool_region else ['industry', 'scenario', 'year']
+
+    return df_wide.sort_values(by=list_sortcols).reset_index(drop=True)
@@ -0,0 +1,131 @@
+import os
+import json
+import sqlite3
+import threading
+import pandas as pd
+from . import term_structure_store as tss
+
+# Catalogue of the runs in the out-tray (SQLite, 03_out_tray/_run_catalogue.sqlite), written when a run finishes:
+#   runs    - run folder, workbook, mode, start / finish time, row counts, task status and the climate PD
+#             parameters (scenarioCategory, risk types, asyncResponse ...)
+#   outputs - every file written into the run folder, with its deliverable folder and size
+# The time series queries read the curves from the term structure store (see term_structure_store.py), so only
+# the requested entities of the selected runs are read, never whole runs or their workbooks.
+
+lock_catalogue = threading.Lock()
+
+str_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run              TEXT NOT NULL PRIMARY KEY,
+    workbook         TEXT,
+    mode             TEXT,
+    started          TEXT,
+    finished         TEXT,
+    path             TEXT,
+    rowsValid        INTEGER,
+    rowsRejected     INTEGER,
+    scenarioCategory TEXT,
+    transition       INTEGER,
+    physical         INTEGER,
+    combined         INTEGER,
+    asyncResponse    INTEGER,
+    parameters       TEXT,
+    deliverables     TEXT,
+    status           TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_runs_workbook ON runs (workbook, started);
+CREATE TABLE IF NOT EXISTS outputs (
+    run         TEXT NOT NULL,
+    file        TEXT NOT NULL,
+    deliverable TEXT,
+    bytes       INTEGER,
+    PRIMARY KEY (run, file)
+) WITHOUT ROWID;
+"""
+
+# %%
+def openCatalogue(path_catalogue):
+    os.makedirs(os.path.dirname(path_catalogue), exist_ok=True)
+    conn = sqlite3.connect(path_catalogue, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(str_schema)
+    return conn
+
+def listOutputs(path_target):
+    # (relative file, deliverable folder, size) of every file of the run folder
+    list_outputs = []
+    for path_dir, list_dirs, list_files in os.walk(path_target):
+        str_reldir = os.path.relpath(path_dir, path_target).replace("\\", "/")
+        for filename in list_files:
+            str_file = filename if str_reldir == "." else f"{str_reldir}/{filename}"
+            list_outputs.append((str_file, str_reldir.split("/")[0] if str_reldir != "." else "", os.path.getsize(os.path.join(path_dir, filename))))
+    return list_outputs
+
+def recordRun(path_catalogue, path_target, dict_runinfo, df_cpdproperties, dict_dcontrol, dict_status):
+    # dict_runinfo: workbook, mode, started, finished, rowsValid, rowsRejected
+    dict_properties = df_cpdproperties.set_index('Parameter')['Value'].to_dict()
+    def flag(name):
+        return int(dict_properties[name]) if isinstance(dict_properties.get(name), bool) else None
+    str_run = os.path.basename(path_target)
+
+    tuple_run = (
+        str_run, dict_runinfo.get('workbook'), dict_runinfo.get('mode'), dict_runinfo.get('started'), dict_runinfo.get('finished'),
+        os.path.abspath(path_target), dict_runinfo.get('rowsValid'), dict_runinfo.get('rowsRejected'),
+        dict_properties.get('scenarioCategory'), flag('transition'), flag('physical'), flag('combined'), flag('asyncResponse'),
+        json.dumps(dict_properties, default=str),
+        json.dumps([name for name, value in dict_dcontrol.items() if value == 'ENABLE']),
+        json.dumps(dict_status, default=str),
+    )
+    list_outputs = [(str_run,)+output for output in listOutputs(path_target)]
+    with lock_catalogue:
+        conn = openCatalogue(path_catalogue)
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", tuple_run)
+                conn.execute("DELETE FROM outputs WHERE run = ?", (str_run,))
+                conn.executemany("INSERT INTO outputs VALUES (?,?,?,?)", list_outputs)
+        finally:
+            conn.close()
+
+    return str_run
+
+# %%
+def listRuns(path_catalogue, str_workbook=None, str_scencat=None, int_last=None):
+    # runs of the catalogue, oldest first (the last int_last only, if given)
+    if not os.path.exists(path_catalogue):
+        return pd.DataFrame()
+    str_query = "SELECT * FROM runs WHERE (? IS NULL OR workbook = ?) AND (? IS NULL OR scenarioCategory = ?) ORDER BY started DESC"
+    conn = openCatalogue(path_catalogue)
+    try:
+        df_runs = pd.read_sql_query(str_query + (f" LIMIT {int(int_last)}" if int_last is not None else ""), conn,
+                                    params=(str_workbook, str_workbook, str_scencat, str_scencat))
+    finally:
+        conn.close()
+    return df_runs.iloc[::-1].reset_index(drop=True)
+
+def listRunOutputs(path_catalogue, str_run, str_deliverable=None):
+    conn = openCatalogue(path_catalogue)
+    try:
+        return pd.read_sql_query("SELECT * FROM outputs WHERE run = ? AND (? IS NULL OR deliverable = ?) ORDER BY file", conn,
+                                 params=(str_run, str_deliverable, str_deliverable))
+    finally:
+        conn.close()
+
+def queryPDSeries(path_catalogue, path_store, list_entityids, str_risktype, str_scenario, str_scencat,
+                  int_year=None, str_workbook=None, int_last=12, str_field='pd'):
+    # one curve of the given entities over the last int_last runs (e.g. combinedRisk / a scenario, for scenarioCategory NGFS):
+    # indexed by (run, entityId) with one column per year, and with the finish time of each run; with int_year,
+    # a time series of that year's value only (rows: run, columns: entityId)
+    df_runs = listRuns(path_catalogue, str_workbook, str_scencat, int_last)
+    if len(df_runs) == 0:
+        return None
+    df_curves = tss.compareCurves(path_store, df_runs['run'].tolist(), str_scencat, list_entityids, str_risktype, str_scenario, str_field)
+    if df_curves is None:
+        return None
+
+    if int_year is not None:
+        df_series = df_curves[int_year].unstack('entityId')
+        df_series.index = pd.MultiIndex.from_arrays([df_series.index, df_series.index.map(df_runs.set_index('run')['finished'])], names=['run', 'finished'])
+        return df_series
+    df_curves.insert(0, 'finished', df_curves.index.get_level_values('run').map(df_runs.set_index('run')['finished']))
+    return df_curves
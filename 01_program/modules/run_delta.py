@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import pandas as pd
+from . import file_handlers as fh
+from . import term_structure_store as tss
+from . import run_catalogue as rc
+
+# Delta mode (main.py --delta): the outputs of a run are compared with those of the previous run of the same
+# workbook, and only what changed is exported. A value has changed when
+#   |new - previous| > float_atol + float_rtol * |previous|      (numbers)
+#   new != previous                                              (text, e.g. implied ratings)
+# The previous values are read from the term structure store (climate PDs, stored as float32: keep float_rtol
+# above ~1e-7) and from the flattened outputs pickled in the previous run folder (transition drivers, ESG),
+# so delta runs can follow each other. Every comparison adds its rows to the change summary of the run:
+#   deliverable, key, status (new / changed / removed), valuesChanged, maxAbsDiff
+
+list_summarycols = ['deliverable', 'key', 'status', 'valuesChanged', 'maxAbsDiff']
+
+# %%
+def findPreviousRun(path_catalogue, str_workbook, str_run):
+    # the last batch run of the workbook before this one (streaming runs keep no flattened outputs), or None
+    df_runs = rc.listRuns(path_catalogue, str_workbook)
+    if len(df_runs) == 0:
+        return None
+    df_runs = df_runs[(df_runs['run'] != str_run) & df_runs['mode'].isin(['batch', 'delta'])]
+    if len(df_runs) == 0:
+        return None
+    return df_runs.iloc[-1].to_dict()
+
+def compareValues(sr_new, sr_prev, float_rtol, float_atol):
+    # True where the value changed, and the absolute difference of numbers (NaN otherwise)
+    arr_new = pd.to_numeric(sr_new, errors='coerce').to_numpy(dtype=np.float64)
+    arr_prev = pd.to_numeric(sr_prev, errors='coerce').to_numpy(dtype=np.float64)
+    bool_number = ~np.isnan(arr_new) & ~np.isnan(arr_prev)
+    arr_diff = np.where(bool_number, np.abs(arr_new-arr_prev), np.nan)
+    bool_changednumber = bool_number & (arr_diff > float_atol + float_rtol*np.abs(arr_prev))
+    # anything else (text, missing on one side) is compared as text, a missing value on both sides is no change
+    bool_bothmissing = (sr_new.isna() & sr_prev.isna()).to_numpy()
+    bool_changedtext = ~bool_number & ~bool_bothmissing & (sr_new.astype(str).to_numpy() != sr_prev.astype(str).to_numpy())
+    return bool_changednumber | bool_changedtext, arr_diff
+
+# %%
+def compareClimatePDs(path_store, str_prevrun, list_ownfirmoutputs_climatepds, float_rtol=1e-6, float_atol=1e-9):
+    # list of the outputs whose curves changed (None for the unchanged ones, aligned with the input) and the summary
+    list_changed = []
+    list_summary = []
+    dict_seen = {}
+    for ownfirmoutput in list_ownfirmoutputs_climatepds:
+        if ownfirmoutput is None or len(ownfirmoutput) == 0:
+            list_changed.append(None)
+            continue
+        str_entityid = str(ownfirmoutput['entityId'].iloc[0])
+        str_scencat = str(ownfirmoutput['scenarioCategory'].iloc[0])
+        # an entity repeated in the outputs is compared (and exported) once
+        if (str_scencat, str_entityid) in dict_seen:
+            list_changed.append(None)
+            continue
+        dict_seen[(str_scencat, str_entityid)] = True
+
+        tuple_prev = tss.getCurve(path_store, str_prevrun, str_scencat, str_entityid) if str_prevrun is not None else None
+        if tuple_prev is None:
+            list_changed.append(ownfirmoutput)
+            list_summary.append(('climatePDs', str_entityid, 'new', len(ownfirmoutput), np.nan))
+            continue
+
+        list_curves, arr_prevpd, arr_previr = tuple_prev
+        dict_rows = {curve: i for i, curve in enumerate(list_curves)}
+        df = ownfirmoutput.drop_duplicates(subset=['RiskType', 'Scenario', 'year'])
+        arr_year = pd.to_numeric(df['year']).to_numpy(dtype=int)
+        arr_row = np.array([dict_rows.get(curve, -1) for curve in zip(df['RiskType'], df['Scenario'])])
+        bool_known = (arr_row >= 0) & (arr_year >= 1) & (arr_year <= arr_prevpd.shape[1])
+        arr_pd = np.full(len(df), np.nan)
+        arr_ir = np.full(len(df), None, dtype=object)
+        arr_pd[bool_known] = arr_prevpd[arr_row[bool_known], arr_year[bool_known]-1]
+        arr_ir[bool_known] = arr_previr[arr_row[bool_known], arr_year[bool_known]-1]
+        arr_ir[bool_known & (arr_ir == '')] = None
+
+        bool_pd, arr_diff = compareValues(df['pd'].reset_index(drop=True), pd.Series(arr_pd), float_rtol, float_atol)
+        bool_ir, _ = compareValues(df['impliedRating'].reset_index(drop=True), pd.Series(arr_ir), float_rtol, float_atol)
+        # a curve (or a year) that the previous run did not have counts as a change
+        int_changed = int((bool_pd | bool_ir | ~bool_known).sum())
+        int_removed = sum(1 for curve in list_curves if curve not in set(zip(df['RiskType'], df['Scenario'])))
+        if int_changed > 0 or int_removed > 0:
+            list_changed.append(ownfirmoutput)
+            list_summary.append(('climatePDs', str_entityid, 'changed', int_changed, np.nanmax(arr_diff) if np.any(~np.isnan(arr_diff)) else np.nan))
+        else:
+            list_changed.append(None)
+
+    # entities of the previous run that are no longer there
+    for str_scencat in set(scencat for scencat, entityid in dict_seen) if str_prevrun is not None else []:
+        dict_curves = tss.openTermStructures(path_store, str_prevrun, str_scencat)
+        if dict_curves is not None:
+            for str_entityid in dict_curves['index']['entities']:
+                if (str_scencat, str_entityid) not in dict_seen:
+                    list_summary.append(('climatePDs', str_entityid, 'removed', 0, np.nan))
+
+    return list_changed, pd.DataFrame(list_summary, columns=list_summarycols)
+
+def compareFrames(str_deliverable, df_new, df_prev, list_keys, list_groupcols, float_rtol=1e-6, float_atol=1e-9, bool_rowkey=False):
+    # rows of df_new whose group (e.g. an industry, an ESG entity) has any new or changed value, and the summary;
+    # with bool_rowkey, the rows of a group are also matched by their position in the group
+    if df_new is None or len(df_new) == 0:
+        return df_new, pd.DataFrame(columns=list_summarycols)
+    df_output = df_new
+    if bool_rowkey:
+        df_new = df_new.assign(rowInGroup=df_new.groupby(list_groupcols, sort=False).cumcount())
+        df_prev = df_prev.assign(rowInGroup=df_prev.groupby(list_groupcols, sort=False).cumcount()) if df_prev is not None else None
+        list_keys = list_keys+['rowInGroup']
+    if df_prev is None or len(df_prev) == 0:
+        df_summary = df_new.groupby(list_groupcols, sort=False).size().reset_index(name='valuesChanged')
+        df_summary = pd.DataFrame({'deliverable': str_deliverable, 'key': df_summary[list_groupcols].astype(str).agg('|'.join, axis=1),
+                                   'status': 'new', 'valuesChanged': df_summary['valuesChanged'], 'maxAbsDiff': np.nan})
+        return df_output, df_summary
+
+    list_valuecols = [col for col in df_new.columns if col not in list_keys]
+    df_merged = df_new.reset_index(drop=True).merge(df_prev[[col for col in df_prev.columns if col in list_keys+list_valuecols]],
+                                                    on=list_keys, how='outer', suffixes=('', '.previous'), indicator=True)
+    arr_changed = np.zeros(len(df_merged), dtype=int)
+    arr_diff = np.full(len(df_merged), np.nan)
+    for col in list_valuecols:
+        sr_prev = df_merged[col+'.previous'] if col+'.previous' in df_merged.columns else pd.Series(np.nan, index=df_merged.index)
+        bool_changed, arr_coldiff = compareValues(df_merged[col], sr_prev, float_rtol, float_atol)
+        arr_changed += bool_changed
+        arr_diff = np.fmax(arr_diff, arr_coldiff)
+    df_merged['valuesChanged'] = np.where(df_merged['_merge'] == 'both', arr_changed, len(list_valuecols))
+    df_merged['absDiff'] = arr_diff
+    df_merged['key'] = df_merged[list_groupcols].astype(str).agg('|'.join, axis=1)
+
+    df_groups = df_merged.groupby('key', sort=False).agg(
+        valuesChanged=('valuesChanged', 'sum'), maxAbsDiff=('absDiff', 'max'),
+        bool_new=('_merge', lambda sr: (sr == 'left_only').all()),
+        bool_removed=('_merge', lambda sr: (sr == 'right_only').all())).reset_index()
+    df_groups['status'] = np.where(df_groups['bool_removed'], 'removed', np.where(df_groups['bool_new'], 'new', 'changed'))
+    df_groups = df_groups[df_groups['valuesChanged'] > 0]
+    df_summary = df_groups.assign(deliverable=str_deliverable)[list_summarycols]
+
+    sr_key = df_new[list_groupcols].astype(str).agg('|'.join, axis=1)
+    return df_output[sr_key.isin(set(df_groups['key'])).to_numpy()], df_summary
+
+# %%
+def loadPreviousFrame(dict_previous, dict_paths, str_name):
+    # a flattened output pickled in the previous run folder, or None
+    if dict_previous is None:
+        return None
+    path_pickle = dict_previous['path']+dict_paths['folder_pickle']
+    if not os.path.exists(f"{path_pickle}/{str_name}.pkl"):
+        return None
+    return fh.readBinary(path_pickle, str_name)
@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+import threading
+import datetime
+import requests
+
+# Append-only journal of the completed API requests of a run, kept in <run folder>/journal:
+#   journal.jsonl    - one line per completed request: key, infoType, statusCode, file, time (+ extra info)
+#   responses/*.bin  - the raw body of each stored response
+# The body is written (and renamed into place) before its journal line, so every journal line points to a
+# complete body. A run that is resumed on the same folder skips every request whose key is in the journal.
+
+lock_journal = threading.Lock()
+
+# %%
+def getRequestKey(info_type, apiinput):
+    # the same payload always gives the same key, independent of the order of its keys
+    str_canonical = json.dumps(apiinput, sort_keys=True, ensure_ascii=False, default=str)
+    return info_type+"_"+hashlib.sha1(str_canonical.encode('utf-8')).hexdigest()
+
+# %%
+def openJournal(path_target):
+    path_journal = f"{path_target}/journal"
+    os.makedirs(path_journal+"/responses", exist_ok=True)
+
+    dict_journal = {'path': path_journal, 'entries': {}}
+    if os.path.exists(path_journal+"/journal.jsonl"):
+        with open(path_journal+"/journal.jsonl", 'r', encoding='utf-8') as file:
+            list_lines = file.readlines()
+        # terminate a line cut by an interrupted run, so that the next entry starts on a line of its own
+        if len(list_lines) > 0 and not list_lines[-1].endswith("\n"):
+            with open(path_journal+"/journal.jsonl", 'a', encoding='utf-8') as file:
+                file.write("\n")
+        for line in list_lines:
+            try:
+                dict_entry = json.loads(line)
+            except ValueError:
+                # a line cut by an interrupted run is ignored; its request is simply sent again
+                continue
+            dict_journal['entries'][dict_entry['key']] = dict_entry
+
+    return dict_journal
+
+def isCompleted(dict_journal, key):
+    return dict_journal is not None and key in dict_journal['entries']
+
+# %%
+def recordResponse(dict_journal, key, info_type, response, dict_extra=None):
+    if dict_journal is None:
+        return None
+
+    str_file = None
+    if response is not None:
+        str_file = f"responses/{key}.bin"
+        full_path = f"{dict_journal['path']}/{str_file}"
+        with open(full_path+".tmp", 'wb') as file:
+            file.write(response.content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(full_path+".tmp", full_path)
+
+    dict_entry = {
+        "key": key,
+        "infoType": info_type,
+        "statusCode": response.status_code if response is not None else None,
+        "file": str_file,
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    if dict_extra is not None:
+        dict_entry.update(dict_extra)
+
+    with lock_journal:
+        with open(dict_journal['path']+"/journal.jsonl", 'a', encoding='utf-8') as file:
+            file.write(json.dumps(dict_entry, ensure_ascii=False)+"\n")
+            file.flush()
+            os.fsync(file.fileno())
+        dict_journal['entries'][key] = dict_entry
+
+    return dict_entry
+
+def loadResponse(dict_journal, key):
+    # rebuild a requests.Response from the stored body, so that the extract functions can use it as usual
+    dict_entry = dict_journal['entries'][key]
+    if dict_entry['file'] is None:
+        return None
+
+    response = requests.Response()
+    response.status_code = dict_entry['statusCode']
+    with open(f"{dict_journal['path']}/{dict_entry['file']}", 'rb') as file:
+        response._content = file.read()
+    response.encoding = 'utf-8'
+
+    return response
@@ -0,0 +1,247 @@
+import os
+import json
+import math
+import datetime
+import pandas as pd
+from urllib.parse import urlencode
+from . import lazyModule
+fh = lazyModule(".file_handlers", __package__)
+adf = lazyModule(".ownfirm_data_formatters", __package__)
+amc = lazyModule(".ownfirm_to_moodys_connectors", __package__)
+mapi = lazyModule(".moodys_climate_api", __package__)
+pm = lazyModule(".pipeline_metrics", __package__)
+ppl = lazyModule(".pipeline", __package__)
+rs = lazyModule(".reference_store", __package__)
+ii = lazyModule(".identifier_index", __package__)
+rc = lazyModule(".run_catalogue", __package__)
+wf = lazyModule(".wire_format", __package__)
+iv = lazyModule(".input_validation", __package__)
+
+# Run planner (main.py plan [WORKBOOK]): every payload of a batch run of the workbook is built, without credentials
+# and without sending any request, and the run is projected from the requests of previous runs:
+#   requests - per endpoint, the requests the run would send after coalescing, batching and sharding, leaving out
+#              the transition risk codes already in the reference store and the identifiers already in the index
+#   bytes    - request bodies (query strings for GETs) as they would be encoded; responses are estimated from the
+#              response bytes per request byte (POSTs) or per request (GETs) of previous runs
+#   seconds  - mean latency of each endpoint over the last int_history runs of the catalogue (their metrics.json),
+#              spread over the requests the deliverable keeps in flight (at most maxConcurrency), plus the fixed
+#              waits of the client (2 s after each synchronous climate PD request, 5 s between status polls)
+# The deliverables are laid out on int_workers workers along the task graph of the run (see runTaskGraph), and the
+# wall time is never less than all the request time divided by maxConcurrency. Only request time is projected, not
+# the flatten / export stages. An endpoint that no previous run called is taken at float_defaultseconds a request;
+# an identifier not in the index yet is planned as if it resolved to an entity of its own.
+
+float_defaultseconds = 1.0
+
+list_plancols = ['deliverable', 'endpoint', 'requests', 'requestBytes', 'responseBytes', 'secondsMean', 'secondsP95', 'inFlight', 'seconds']
+
+# %%
+def getClientSettings():
+    # the client settings of config.json, or the defaults if there is no config.json (planning needs no credentials)
+    try:
+        return mapi.getConfig("client")
+    except FileNotFoundError:
+        return {}
+
+def getRequestBytes(str_infotype, apiinput):
+    # size of the body (POST) or of the query string (GET) of a request
+    if mapi.dict_ESG_EDFX[str_infotype][1] == "GET":
+        return len(urlencode(apiinput))
+    return len(apiinput.encode('utf-8') if isinstance(apiinput, str) else wf.encodeJSON(apiinput))
+
+def loadLatencyHistory(path_catalogue, int_history=10):
+    # per endpoint over the last int_history runs: count, seconds, response and request bytes, latency buckets.
+    # Only per-run metrics are summed: a metrics.json without 'run' was written when the request counters were
+    # process-wide and, in --watch mode, also counts the requests of the jobs before it.
+    df_runs = rc.listRuns(path_catalogue, int_last=int_history)
+    dict_history = {}
+    for str_path in (df_runs['path'].tolist() if len(df_runs) > 0 else []):
+        if not os.path.exists(str_path+"/metrics.json"):
+            continue
+        with open(str_path+"/metrics.json", 'r', encoding='utf-8') as file:
+            dict_metrics = json.load(file)
+        if 'run' not in dict_metrics:
+            continue
+        dict_endpoints = dict_metrics.get('endpoints', {})
+        for str_endpoint, dict_endpoint in dict_endpoints.items():
+            if dict_endpoint.get('count', 0) == 0:
+                continue
+            dict_sums = dict_history.setdefault(str_endpoint, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'requestBytes': 0,
+                                                               'buckets': [0]*(len(pm.list_latencybuckets)+1)})
+            dict_sums['count'] += dict_endpoint['count']
+            dict_sums['seconds'] += dict_endpoint['secondsMean']*dict_endpoint['count']
+            dict_sums['bytes'] += dict_endpoint.get('bytes', 0)
+            dict_sums['requestBytes'] += dict_endpoint.get('requestBytes', 0)
+            for i, int_count in enumerate(dict_endpoint.get('latencyBuckets', {}).values()):
+                dict_sums['buckets'][i] += int_count
+    return dict_history
+
+# %%
+def estimateEndpoint(dict_history, str_deliverable, str_endpoint, int_requests, int_requestbytes, int_inflight, float_waits=0.0):
+    # one row of the plan: int_requests requests to str_endpoint, int_inflight of them at the same time
+    dict_sums = dict_history.get(str_endpoint)
+    if dict_sums is not None:
+        float_mean = dict_sums['seconds']/dict_sums['count']
+        float_p95 = pm.estimateQuantile(dict_sums['buckets'], 0.95)
+        if dict_sums['requestBytes'] > 0 and int_requestbytes > 0:
+            int_responsebytes = int(int_requestbytes*dict_sums['bytes']/dict_sums['requestBytes'])
+        else:
+            int_responsebytes = int(int_requests*dict_sums['bytes']/dict_sums['count'])
+    else:
+        float_mean, float_p95, int_responsebytes = float_defaultseconds, None, None
+    float_seconds = math.ceil(int_requests/max(1, int_inflight))*float_mean + float_waits if int_requests > 0 else 0.0
+    return (str_deliverable, str_endpoint, int_requests, int_requestbytes, int_responsebytes, float_mean, float_p95, int_inflight, float_seconds)
+
+def planEntities(path_index, df_inputtable):
+    # the rows with the entity IDs already in the index (rows known to be unresolvable are left out, as in a run)
+    # and the identifiers that the mapping endpoint would be asked for
+    bool_public = df_inputtable['firmStatus'] == "Public"
+    sr_identifier = df_inputtable['entityId'].map(adf.num_to_str)
+    list_identifiers = sr_identifier[bool_public].tolist()
+    list_unknown = ii.findUnknownIdentifiers(path_index, list_identifiers) if len(list_identifiers) > 0 else []
+    dict_entityids = ii.lookupIdentifiers(path_index, list_identifiers) if len(list_identifiers) > 0 else {}
+
+    # unresolved identifiers checked too long ago are asked again, so they are not left out yet
+    set_unknown = set(list_unknown)
+    set_unresolvable = {identifier for identifier, entityid in dict_entityids.items() if entityid is None and identifier not in set_unknown}
+    bool_unresolved = bool_public & sr_identifier.isin(set_unresolvable)
+    df_resolved = df_inputtable[~bool_unresolved].copy()
+    df_resolved['entityId'] = df_resolved['entityId'].astype(object)
+    sr_entityid = sr_identifier[~bool_unresolved].map(lambda x: dict_entityids.get(x))
+    bool_mapped = bool_public[~bool_unresolved] & sr_entityid.notna()
+    df_resolved.loc[bool_mapped, 'entityId'] = sr_entityid[bool_mapped]
+    return df_resolved, list_unknown
+
+def planTransRisk(dict_history, dict_client, path_store, str_deliverable, str_infotype, str_param, dict_apiinputs):
+    # the shards of the codes missing from the reference store, each one a GET plus the download of its link
+    dict_apiinputs_missing = rs.filterMissingCodes(path_store, dict_apiinputs)
+    list_shards = amc.shardAPIInputs(dict_apiinputs_missing, str_param, dict_client.get("maxQueryLength", 2000)) if dict_apiinputs_missing is not None else []
+    int_inflight = min(max(1, len(list_shards)), 8, dict_client.get("maxConcurrency", 8))
+    return [estimateEndpoint(dict_history, str_deliverable, str_infotype, len(list_shards), sum(getRequestBytes(str_infotype, x) for x in list_shards), int_inflight),
+            estimateEndpoint(dict_history, str_deliverable, "download", len(list_shards), 0, int_inflight)]
+
+def planRequests(dict_plan, dict_history, dict_client):
+    # rows of the plan (list_plancols) of every enabled deliverable, each from the rows valid for it
+    dict_paths, df_inputtable, df_cpdproperties = dict_plan['dict_paths'], dict_plan['df_inputtable'], dict_plan['df_cpdproperties']
+    dict_validrows = dict_plan.get('dict_validrows')
+    int_concurrency = dict_client.get("maxConcurrency", 8)
+    path_reference = dict_paths['root_path']+dict_paths['folder_reference']
+    list_rows = []
+
+    if 'entities' in dict_plan['dict_tasks']:
+        df_entities, list_unknown = planEntities(path_reference+"/identifier_index.sqlite", ppl.selectValidRows(dict_validrows, iv.tuple_core, df_inputtable))
+        list_apiinputs_entity = [adf.genAPIInput_Entity(pd.DataFrame({'entityId': list_unknown[i:i+100]})) for i in range(0, len(list_unknown), 100)]
+        list_rows.append(estimateEndpoint(dict_history, 'entities', "entity_batch", len(list_apiinputs_entity),
+                                          sum(getRequestBytes("entity_batch", x) for x in list_apiinputs_entity),
+                                          min(max(1, len(list_apiinputs_entity)), 8, int_concurrency)))
+    else:
+        df_entities = df_inputtable
+
+    if 'climatePDs' in dict_plan['dict_tasks']:
+        # the climate PD requests are sent one after another
+        bool_isasync, list_apiinputs_climatepds = adf.genListOfAPIInput_ClimatePDs(df_cpdproperties, ppl.selectValidRows(dict_validrows, ('climatePDs',), df_entities), None)
+        list_distinct = amc.coalesceAPIInputs(list_apiinputs_climatepds)[0]
+        # a consolidated payload is sent with each of its distinct entities once
+        list_distinct = [amc.coalesceEntities(apiinput)[0] for apiinput in list_distinct]
+        int_requests = len(list_distinct)
+        int_requestbytes = sum(getRequestBytes("climate_pds_TPC", x) for x in list_distinct)
+        if bool_isasync:
+            # status polls per process as in previous runs (at least one), 5 s apart
+            dict_polls, dict_pids = dict_history.get("process_status"), dict_history.get("climate_pds_TPC")
+            float_polls = max(1.0, dict_polls['count']/dict_pids['count']) if dict_polls is not None and dict_pids is not None else 1.0
+            list_rows.append(estimateEndpoint(dict_history, 'climatePDs', "climate_pds_TPC", int_requests, int_requestbytes, 1))
+            list_rows.append(estimateEndpoint(dict_history, 'climatePDs', "process_status", int(round(int_requests*float_polls)), 0, 1,
+                                              float_waits=int_requests*(float_polls-1)*5))
+            list_rows.append(estimateEndpoint(dict_history, 'climatePDs', "process_files", int_requests, 0, 1))
+            list_rows.append(estimateEndpoint(dict_history, 'climatePDs', "download", int_requests, 0, 1))
+        else:
+            list_rows.append(estimateEndpoint(dict_history, 'climatePDs', "climate_pds_TPC", int_requests, int_requestbytes, 1, float_waits=int_requests*2))
+
+    path_store = path_reference+"/transition_paths.sqlite"
+    if 'transRiskIndustry' in dict_plan['dict_tasks']:
+        list_rows += planTransRisk(dict_history, dict_client, path_store, 'transRiskIndustry', "industry_T", "industry",
+                                   adf.genAPIInput_TransRiskIndustry(df_cpdproperties, ppl.selectValidRows(dict_validrows, ('transRiskIndustry',), df_inputtable), None))
+    if 'transRiskRegion' in dict_plan['dict_tasks']:
+        list_rows += planTransRisk(dict_history, dict_client, path_store, 'transRiskRegion', "region_T", "regionIndustry",
+                                   adf.genAPIInput_TransRiskRegion(df_cpdproperties, ppl.selectValidRows(dict_validrows, ('transRiskRegion',), df_inputtable), None))
+
+    if 'reports' in dict_plan['dict_tasks']:
+        # one climate report (one file to download) per entity
+        list_distinct = amc.coalesceAPIInputs(adf.genListOfAPIInput_Reports(df_cpdproperties, ppl.selectValidRows(dict_validrows, ('reports',), df_entities), None))[0]
+        int_inflight = min(max(1, int(dict_client.get("reportWorkers", 4))), int_concurrency)
+        list_rows.append(estimateEndpoint(dict_history, 'reports', "reports", len(list_distinct), sum(getRequestBytes("reports", x) for x in list_distinct), int_inflight))
+        list_rows.append(estimateEndpoint(dict_history, 'reports', "download", len(list_distinct), 0, int_inflight))
+
+    if 'esg' in dict_plan['dict_tasks']:
+        list_distinct = amc.coalesceAPIInputs(adf.genAPIInput_ESG(df_cpdproperties, ppl.selectValidRows(dict_validrows, ('esg',), df_inputtable), None))[0]
+        int_batchsize = max(1, int(dict_client.get("esgBatchSize", 100)))
+        list_batches = [list_distinct[i:i+int_batchsize] for i in range(0, len(list_distinct), int_batchsize)]
+        int_inflight = min(max(1, int(dict_client.get("esgWorkers", 4))), int_concurrency)
+        list_rows.append(estimateEndpoint(dict_history, 'esg', "ESG", len(list_batches), sum(getRequestBytes("ESG", x) for x in list_batches), int_inflight))
+
+    return pd.DataFrame(list_rows, columns=list_plancols)
+
+# %%
+def projectWallTime(dict_tasks, dict_seconds, int_workers):
+    # start and finish time of every task when run as runTaskGraph does: each one as soon as its dependencies are
+    # completed and a worker is free, in the order of the task graph
+    list_free = [0.0]*max(1, int_workers)
+    dict_start, dict_finish = {}, {}
+    while len(dict_finish) < len(dict_tasks):
+        float_free = min(list_free)
+        list_ready = [(max([float_free]+[dict_finish[dep] for dep in deps]), name) for name, (func, deps) in dict_tasks.items()
+                      if name not in dict_finish and all(dep in dict_finish for dep in deps)]
+        float_start, name = min(list_ready, key=lambda x: x[0])
+        dict_start[name], dict_finish[name] = float_start, float_start+dict_seconds.get(name, 0.0)
+        list_free[list_free.index(float_free)] = dict_finish[name]
+    return dict_start, dict_finish
+
+def summarisePlan(df_requests, dict_tasks, int_workers, int_concurrency):
+    # per deliverable: requests, bytes and projected start / finish; and the projected wall time of the run
+    df_deliverables = df_requests.groupby('deliverable', sort=False).agg(
+        requests=('requests', 'sum'), requestBytes=('requestBytes', 'sum'), responseBytes=('responseBytes', 'sum'),
+        seconds=('seconds', 'sum')).reindex(list(dict_tasks)).fillna(0)
+    dict_start, dict_finish = projectWallTime(dict_tasks, df_deliverables['seconds'].to_dict(), int_workers)
+    df_deliverables['start'] = pd.Series(dict_start)
+    df_deliverables['finish'] = pd.Series(dict_finish)
+    # all deliverables share the maxConcurrency slots of the client
+    float_busy = (df_requests['requests']*df_requests['secondsMean']).sum()
+    float_wall = max(max(dict_finish.values(), default=0.0), float_busy/max(1, int_concurrency))
+    return df_deliverables.reset_index(names='deliverable'), float_wall
+
+def planWorkbook(path_file, dict_paths, int_workers, int_history=10, list_workers=(1, 2, 5)):
+    # returns the requests per endpoint, the deliverables and the summary (the projected wall time at several --workers)
+    dict_xlsxmeta, dict_xlsx = fh.readXLSXFile(path_file)
+    df_cpdproperties = adf.getCPDProperties(dict_xlsx)
+    dict_dcontrol = adf.getDeliverableControl(dict_xlsx)
+    # an invalid workbook is not run, so it is not planned either
+    ppl.checkCPDProperties(df_cpdproperties, dict_dcontrol, None)
+    df_inputtable, df_rejected, dict_validrows = ppl.validateInputTable(adf.getInputTable(dict_xlsx), dict_dcontrol, None)
+
+    dict_client = getClientSettings()
+    int_concurrency = dict_client.get("maxConcurrency", 8)
+    path_outray = dict_paths['root_path']+dict_paths['folder_outtray']
+    dict_history = loadLatencyHistory(path_outray+"/_run_catalogue.sqlite", int_history)
+    dict_plan = {'dict_paths': dict_paths, 'df_inputtable': df_inputtable, 'dict_validrows': dict_validrows, 'df_cpdproperties': df_cpdproperties,
+                 'dict_tasks': ppl.genDeliverableTasks(dict_dcontrol)}
+    df_requests = planRequests(dict_plan, dict_history, dict_client)
+    df_deliverables, float_wall = summarisePlan(df_requests, dict_plan['dict_tasks'], int_workers, int_concurrency)
+
+    list_summary = [('workbook', dict_xlsxmeta['file']), ('rowsValid', len(df_inputtable)), ('rowsRejected', len(df_rejected)),
+                    ('maxConcurrency', int_concurrency), ('endpointsWithoutHistory', ", ".join(x for x in df_requests.loc[df_requests['requests'] > 0, 'endpoint'].unique() if x not in dict_history)),
+                    ('requests', int(df_requests['requests'].sum())), ('requestBytes', int(df_requests['requestBytes'].sum())),
+                    ('responseBytes', int(df_requests['responseBytes'].fillna(0).sum())), (f'seconds (--workers {int_workers})', round(float_wall, 1))]
+    for int_option in sorted(set(list_workers)-{int_workers}):
+        list_summary.append((f'seconds (--workers {int_option})', round(summarisePlan(df_requests, dict_plan['dict_tasks'], int_option, int_concurrency)[1], 1)))
+    df_summary = pd.DataFrame(list_summary, columns=['item', 'value'])
+
+    return df_requests, df_deliverables, df_summary
+
+def planRun(path_file, dict_paths, int_workers, int_history=10):
+    # plans the workbook and saves the plan into the out-tray (_plan_<workbook>_<timestamp>.xlsx); returns its path
+    dtts_begin = datetime.datetime.now()
+    df_requests, df_deliverables, df_summary = planWorkbook(path_file, dict_paths, int_workers, int_history)
+    str_name = os.path.splitext(os.path.basename(path_file))[0]
+    path_outray = fh.createFolder(dict_paths['root_path']+dict_paths['folder_outtray'])
+    path_plan = adf.exportRunPlan(path_outray, f"_plan_{str_name}_{dtts_begin.strftime('%Y%m%d_%H%M%S')}", df_requests, df_deliverables, df_summary, None)
+    return path_plan, df_requests, df_deliverables, df_summary
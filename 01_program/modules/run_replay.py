@@ -0,0 +1,128 @@
+import os
+import datetime
+import pandas as pd
+from . import lazyModule
+fh = lazyModule(".file_handlers", __package__)
+adf = lazyModule(".ownfirm_data_formatters", __package__)
+amodel = lazyModule(".ownfirm_models", __package__)
+amc = lazyModule(".ownfirm_to_moodys_connectors", __package__)
+rj = lazyModule(".run_journal", __package__)
+pm = lazyModule(".pipeline_metrics", __package__)
+ppl = lazyModule(".pipeline", __package__)
+
+# Offline replay of a finished run (main.py replay <run folder>): the raw responses kept in the journal of the run
+# are flattened, exported and aggregated again into <run folder>/replay_<timestamp>, without credentials and
+# without sending any request. Every stage is timed (and profiled with --profile) as in a live run, so the CPU-bound
+# half of the pipeline can be benchmarked on production payloads; with int_repeat, each stage is run several times.
+# Responses are replayed in the order they were journaled:
+#   - an entity requested for several rows (or in several chunks of a streaming run) is replayed once
+#   - the transition risk drivers are those requested by the run, not the codes already in the reference store
+# Entity mappings and reports are not replayed: they have no flatten stage.
+
+# %%
+def listJournalResponses(dict_journal, str_infotype):
+    # the stored responses of one endpoint, in the order they were completed
+    return [rj.loadResponse(dict_journal, key) for key, dict_entry in dict_journal['entries'].items()
+            if dict_entry['infoType'] == str_infotype and dict_entry['file'] is not None]
+
+def replayClimatePDs(dict_replay):
+    logger = dict_replay['logger']
+    str_run, path_target = dict_replay['name_target'], dict_replay['path_target']
+    path_climatePD = fh.createFolder(path_target+dict_replay['dict_paths']['output_climatePD'])
+    with ppl.runStage("climatePDs.load", str_run, path_target):
+        list_responses_climatepds = listJournalResponses(dict_replay['dict_journal'], "climate_pds_TPC")
+    logger.info(f"-> {len(list_responses_climatepds)} climate PD response(s) in the journal") if logger is not None else None
+    if len(list_responses_climatepds) == 0:
+        return None
+    with ppl.runStage("climatePDs.flatten", str_run, path_target):
+        list_ownfirmoutputs_climatepds = adf.extractAPIOutput_ClimatePDs(list_responses_climatepds, logger, int_workers=ppl.getFlattenWorkers())
+    with ppl.runStage("climatePDs.export", str_run, path_target):
+        adf.exportAPIOutput_ClimatePDs(path_climatePD, list_ownfirmoutputs_climatepds, logger)
+    with ppl.runStage("climatePDs.portfolio", str_run, path_target):
+        df_portfolio_edf = amodel.calculatePortfolioPD(list_ownfirmoutputs_climatepds)
+        adf.exportPortfolioPDs(path_climatePD, df_portfolio_edf, logger)
+
+def replayTransRisk(dict_replay, str_deliverable, str_infotype, func_extract, func_export):
+    logger = dict_replay['logger']
+    str_run, path_target = dict_replay['name_target'], dict_replay['path_target']
+    path_transrisk = fh.createFolder(path_target+dict_replay['dict_paths']['output_transrisk'])
+    with ppl.runStage(f"{str_deliverable}.load", str_run, path_target):
+        list_responses = listJournalResponses(dict_replay['dict_journal'], str_infotype)
+        # the shards of a long code list are merged as in the live run
+        obj_responses = list_responses[0] if len(list_responses) == 1 else amc.mergeJSONResponses(list_responses) if len(list_responses) > 1 else None
+    logger.info(f"-> {len(list_responses)} {str_deliverable} response(s) in the journal") if logger is not None else None
+    if obj_responses is None:
+        return None
+    with ppl.runStage(f"{str_deliverable}.flatten", str_run, path_target):
+        df_ownfirmoutputs = func_extract(obj_responses, logger)
+    with ppl.runStage(f"{str_deliverable}.export", str_run, path_target):
+        func_export(path_transrisk, df_ownfirmoutputs, logger)
+
+def replayTransRiskIndustry(dict_replay):
+    return replayTransRisk(dict_replay, "transRiskIndustry", "industry_T", adf.extractAPIOutput_TransRiskIndustry, adf.exportAPIOutput_TransRiskIndustry)
+
+def replayTransRiskRegion(dict_replay):
+    return replayTransRisk(dict_replay, "transRiskRegion", "region_T", adf.extractAPIOutput_TransRiskRegion, adf.exportAPIOutput_TransRiskRegion)
+
+def replayESG(dict_replay):
+    logger = dict_replay['logger']
+    str_run, path_target = dict_replay['name_target'], dict_replay['path_target']
+    path_esg = fh.createFolder(path_target+dict_replay['dict_paths']['output_esg'])
+    with ppl.runStage("esg.load", str_run, path_target):
+        list_responses_esg = listJournalResponses(dict_replay['dict_journal'], "ESG")
+    logger.info(f"-> {len(list_responses_esg)} ESG response(s) in the journal") if logger is not None else None
+    if len(list_responses_esg) == 0:
+        return None
+    with ppl.runStage("esg.flatten", str_run, path_target):
+        # one response per chunk of a streaming run
+        df_ownfirmoutputs_esg = pd.concat([adf.extractAPIOutput_ESG(response_esg, logger) for response_esg in list_responses_esg], ignore_index=True)
+    with ppl.runStage("esg.export", str_run, path_target):
+        adf.exportAPIOutput_ESG(path_esg, df_ownfirmoutputs_esg, logger)
+
+# deliverables replayed, in this order
+dict_replaytasks = {
+    'climatePDs':        replayClimatePDs,
+    'transRiskIndustry': replayTransRiskIndustry,
+    'transRiskRegion':   replayTransRiskRegion,
+    'esg':               replayESG,
+}
+
+# %%
+def summariseStages(str_run):
+    # stage timings of the replay: runs, total and mean seconds per stage
+    dict_stages = pm.getSummary(str_run)['stages']
+    df_timings = pd.DataFrame([(stage, values['count'], values['seconds']) for stage, values in dict_stages.items()],
+                              columns=['stage', 'count', 'seconds'])
+    df_timings['secondsMean'] = df_timings['seconds']/df_timings['count'] if len(df_timings) > 0 else None
+    return df_timings
+
+def replayRun(path_run, dict_paths, int_repeat=1):
+    # returns the replay folder and the stage timings
+    dtts_begin = datetime.datetime.now()
+    if not os.path.exists(path_run+"/journal/journal.jsonl"):
+        raise FileNotFoundError(f"No journal in {path_run}: only runs with journaled responses can be replayed")
+    path_target, name_target = fh.createFolder(path_run, "replay", dtts_begin)
+    logger = fh.createLog(path_target, name_target, bool_isolated=True, bool_queued=True)
+    pm.setRun(name_target)
+    dict_journal = rj.openJournal(path_run)
+    logger.info(f"Replay {os.path.basename(path_run)} offline from {len(dict_journal['entries'])} journaled response(s), {int_repeat} time(s)")
+
+    dict_replay = {'path_target': path_target, 'name_target': name_target, 'dict_paths': dict_paths, 'dict_journal': dict_journal, 'logger': logger}
+    for int_loop in range(max(1, int_repeat)):
+        with pm.timeStage("total", name_target):
+            for name, func in dict_replaytasks.items():
+                try:
+                    func(dict_replay)
+                except Exception as e:
+                    # a deliverable that fails does not stop the others
+                    logger.error(f"-> Replay of {name} failed: {e!r}", exc_info=e)
+
+    df_timings = summariseStages(name_target)
+    for row in df_timings.itertuples(index=False):
+        logger.info(f"-> Stage {row.stage}: {row.count} run(s), {row.seconds:.3f} s in total, {row.secondsMean:.3f} s on average")
+    pm.writeMetrics(path_target, name_target)
+    pm.resetMetrics(name_target)
+    logger.info(f"Stage timings are saved into {path_target}/metrics.prom and metrics.json")
+    fh.closeLog(logger, dtts_begin, datetime.datetime.now())
+
+    return path_target, df_timings
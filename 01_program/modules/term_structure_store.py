@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+import pandas as pd
+
+# Store of the climate-adjusted PD term structures of every run, shared by all runs. One folder per
+# (run, scenarioCategory) under the store, holding fixed-width binary arrays that are memory-mapped on read:
+#   pd.f32    - float32 (rows x int_years), the PD of each year, NaN past the end of the curve
+#   ir.u2     - uint16 (rows x int_years), the implied rating of each year as its position in ratings of index.json,
+#               0 ('') past the end of the curve; any text fits, and a rating takes 2 bytes whatever its length
+#   curve.i2  - int16 (rows), the (RiskType, Scenario) of each row, see curves in index.json
+#   index.json- rows, years, curves, ratings and entityId -> [offset of its first row, number of rows, asOfDate, isfin]
+# The rows of an entity are contiguous. Chunks (and resumed runs) are appended; an entity already in the store
+# is not added again. The index of the appended rows is kept in memory and index.json is written once, when the
+# run flushes the store (flushTermStructures), after the arrays are written, so a reader never maps rows that are
+# not complete.
+
+int_defaultyears = 30
+
+lock_store = threading.Lock()
+dict_opened = {}
+# indexes appended to but not written yet, per folder of the store
+dict_pending = {}
+
+# %%
+def getStorePath(path_store, str_run, str_scencat):
+    return f"{path_store}/{str_run}/{str_scencat}"
+
+def readIndex(path_curves):
+    if not os.path.exists(path_curves+"/index.json"):
+        return None
+    with open(path_curves+"/index.json", 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def writeIndex(path_curves, dict_index):
+    with open(path_curves+"/index.json.tmp", 'w', encoding='utf-8') as file:
+        json.dump(dict_index, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path_curves+"/index.json.tmp", path_curves+"/index.json")
+
+def encodeRatings(dict_index, sr_ratings):
+    # the code of each implied rating (str, '' for none); ratings not seen yet are added to the index
+    list_ratings = dict_index['ratings']
+    dict_codes = {str_rating: i for i, str_rating in enumerate(list_ratings)}
+    for str_rating in pd.unique(sr_ratings):
+        if str_rating not in dict_codes:
+            dict_codes[str_rating] = len(list_ratings)
+            list_ratings.append(str_rating)
+    if len(list_ratings) > np.iinfo(np.uint16).max+1:
+        raise ValueError(f"more than {np.iinfo(np.uint16).max+1} distinct implied ratings cannot be stored")
+    return sr_ratings.map(dict_codes)
+
+def decodeRatings(dict_curves, arr_codes):
+    # the implied ratings (str, '' for none) of values read from the 'ir' array of openTermStructures
+    return dict_curves['ratings'][np.asarray(arr_codes)]
+
+# %%
+def appendTermStructures(path_store, str_run, list_ownfirmoutputs_climatepds, int_years=int_defaultyears, bool_flush=True):
+    # add the flattened climate PD outputs (extractAPIOutput_ClimatePDs) of a run; returns the number of entities added.
+    # Without bool_flush, index.json is not written: a run appending chunk by chunk calls flushTermStructures at its end
+    list_valid = [df for df in list_ownfirmoutputs_climatepds if df is not None and len(df) > 0]
+    if len(list_valid) == 0:
+        return 0
+    df_all = pd.concat(list_valid, ignore_index=True)
+    df_all['year'] = pd.to_numeric(df_all['year']).astype(int)
+    df_all = df_all[(df_all['year'] >= 1) & (df_all['year'] <= int_years)]
+
+    int_added = 0
+    with lock_store:
+        for str_scencat, df_scencat in df_all.groupby('scenarioCategory', sort=False):
+            path_curves = getStorePath(path_store, str_run, str_scencat)
+            os.makedirs(path_curves, exist_ok=True)
+            dict_index = dict_pending.get(path_curves) or readIndex(path_curves) or {'rows': 0, 'years': int_years, 'curves': [], 'ratings': [''], 'entities': {}}
+
+            df = df_scencat[~df_scencat['entityId'].astype(str).isin(dict_index['entities'])].copy()
+            df['entityId'] = df['entityId'].astype(str)
+            # an entity repeated in the outputs (e.g. one row per facility) is stored once
+            df = df.drop_duplicates(subset=['entityId', 'RiskType', 'Scenario', 'year'])
+            if len(df) == 0:
+                continue
+
+            # one row per (entity, curve), one column per year
+            list_curves = [tuple(curve) for curve in dict_index['curves']]
+            for curve in df[['RiskType', 'Scenario']].drop_duplicates().itertuples(index=False, name=None):
+                if curve not in list_curves:
+                    list_curves.append(curve)
+            dict_curveids = {curve: i for i, curve in enumerate(list_curves)}
+            df['curve'] = [dict_curveids[curve] for curve in zip(df['RiskType'], df['Scenario'])]
+            df['pd'] = pd.to_numeric(df['pd'], errors='coerce')
+            df['impliedRating'] = encodeRatings(dict_index, df['impliedRating'].where(df['impliedRating'].notna(), '').astype(str))
+
+            df_pd = df.pivot(index=['entityId', 'curve'], columns='year', values='pd').reindex(columns=range(1, int_years+1))
+            df_ir = df.pivot(index=['entityId', 'curve'], columns='year', values='impliedRating').reindex(columns=range(1, int_years+1))
+            arr_pd = df_pd.to_numpy(dtype=np.float32)
+            arr_ir = df_ir.fillna(0).to_numpy(dtype=np.uint16)
+            arr_curve = df_pd.index.get_level_values('curve').to_numpy(dtype=np.int16)
+
+            # rows of an entity are contiguous (the pivot is sorted by entityId); keep the order in which entities came
+            sr_entity = pd.Series(df_pd.index.get_level_values('entityId'))
+            list_order = pd.unique(df['entityId'])
+            arr_order = np.argsort(pd.Categorical(sr_entity, categories=list_order).codes, kind='stable')
+            arr_pd, arr_ir, arr_curve = arr_pd[arr_order], arr_ir[arr_order], arr_curve[arr_order]
+            sr_entity = sr_entity.iloc[arr_order].reset_index(drop=True)
+
+            for str_file, arr in [("pd.f32", arr_pd), ("ir.u2", arr_ir), ("curve.i2", arr_curve)]:
+                with open(f"{path_curves}/{str_file}", 'r+b' if os.path.exists(f"{path_curves}/{str_file}") else 'wb') as file:
+                    # bytes past the rows of the index (an interrupted append) are overwritten
+                    file.seek(dict_index['rows']*arr.itemsize*(arr.shape[1] if arr.ndim > 1 else 1))
+                    file.write(np.ascontiguousarray(arr).tobytes())
+                    file.truncate()
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            df_meta = df.drop_duplicates(subset=['entityId']).set_index('entityId')
+            dict_counts = sr_entity.value_counts().to_dict()
+            int_offset = dict_index['rows']
+            for str_entityid in list_order:
+                dict_index['entities'][str_entityid] = [int_offset, int(dict_counts[str_entityid]),
+                                                        str(df_meta.at[str_entityid, 'asOfDate']), bool(df_meta.at[str_entityid, 'isfin'])]
+                int_offset += int(dict_counts[str_entityid])
+            dict_index['rows'] = int_offset
+            dict_index['curves'] = [list(curve) for curve in list_curves]
+            dict_pending[path_curves] = dict_index
+            int_added += len(list_order)
+
+    if bool_flush:
+        flushTermStructures(path_store, str_run)
+    return int_added
+
+def flushTermStructures(path_store, str_run):
+    # write the index of the rows appended by the run; returns the number of (run, scenarioCategory) folders written
+    path_run = getStorePath(path_store, str_run, "")
+    with lock_store:
+        list_paths = [path_curves for path_curves in dict_pending if path_curves.startswith(path_run)]
+        for path_curves in list_paths:
+            writeIndex(path_curves, dict_pending.pop(path_curves))
+    return len(list_paths)
+
+# %%
+def openTermStructures(path_store, str_run, str_scencat):
+    # memory-mapped arrays of one (run, scenarioCategory); cached per process until the store is appended to
+    path_curves = getStorePath(path_store, str_run, str_scencat)
+    if not os.path.exists(path_curves+"/index.json"):
+        return None
+    int_mtime = os.stat(path_curves+"/index.json").st_mtime_ns
+    with lock_store:
+        if path_curves in dict_opened and dict_opened[path_curves]['mtime'] == int_mtime:
+            return dict_opened[path_curves]
+
+        dict_index = readIndex(path_curves)
+        int_rows, int_years = dict_index['rows'], dict_index['years']
+        dict_curves = {
+            'mtime': int_mtime,
+            'index': dict_index,
+            'curves': [tuple(curve) for curve in dict_index['curves']],
+            'ratings': np.array(dict_index['ratings'], dtype=str),
+            'pd': np.memmap(path_curves+"/pd.f32", dtype=np.float32, mode='r', shape=(int_rows, int_years)) if int_rows > 0 else np.empty((0, int_years), dtype=np.float32),
+            'ir': np.memmap(path_curves+"/ir.u2", dtype=np.uint16, mode='r', shape=(int_rows, int_years)) if int_rows > 0 else np.empty((0, int_years), dtype=np.uint16),
+            'curve': np.memmap(path_curves+"/curve.i2", dtype=np.int16, mode='r', shape=(int_rows,)) if int_rows > 0 else np.empty(0, dtype=np.int16),
+        }
+        dict_opened[path_curves] = dict_curves
+
+    return dict_curves
+
+def getRunOrder(str_run):
+    # sort key of a run folder <workbook>_<timestamp>[_<suffix>] (see fh.createFolder): timestamp, then suffix
+    match = re.search(r"_(\d{8}_\d{6})(?:_(\d+))?$", str_run)
+    if match is None:
+        return ("", 0, str_run)
+    return (match.group(1), int(match.group(2) or 1), str_run)
+
+def listStoredRuns(path_store, str_scencat=None):
+    # runs in the store, oldest first, optionally only those holding the given scenarioCategory
+    if not os.path.exists(path_store):
+        return []
+    return sorted((run for run in os.listdir(path_store) if os.path.isdir(f"{path_store}/{run}")
+                   and (str_scencat is None or os.path.exists(getStorePath(path_store, run, str_scencat)+"/index.json"))),
+                  key=getRunOrder)
+
+def getCurve(path_store, str_run, str_scencat, str_entityid):
+    # the curves of one entity: (curves [(RiskType, Scenario)], pd view, implied ratings), of shape (number of curves,
+    # years); the PDs are a view of the store without copying, the ratings are decoded. None if the entity is not in the store
+    dict_curves = openTermStructures(path_store, str_run, str_scencat)
+    if dict_curves is None or str(str_entityid) not in dict_curves['index']['entities']:
+        return None
+    int_offset, int_count = dict_curves['index']['entities'][str(str_entityid)][:2]
+    list_curves = [dict_curves['curves'][i] for i in dict_curves['curve'][int_offset:int_offset+int_count]]
+    return list_curves, dict_curves['pd'][int_offset:int_offset+int_count], decodeRatings(dict_curves, dict_curves['ir'][int_offset:int_offset+int_count])
+
+def compareCurves(path_store, list_runs, str_scencat, list_entityids, str_risktype, str_scenario, str_field='pd'):
+    # one curve (e.g. transitionRisk / a scenario) of many entities across runs (i.e. as-of dates):
+    # a DataFrame indexed by (run, entityId) with one column per year; only the selected rows are read
+    list_frames = []
+    for str_run in list_runs:
+        dict_curves = openTermStructures(path_store, str_run, str_scencat)
+        if dict_curves is None or (str_risktype, str_scenario) not in dict_curves['curves']:
+            continue
+        int_curveid = dict_curves['curves'].index((str_risktype, str_scenario))
+        dict_entities = dict_curves['index']['entities']
+        list_found = [str(x) for x in list_entityids if str(x) in dict_entities]
+        if len(list_found) == 0:
+            continue
+        # the rows of the selected curve within each entity's contiguous block
+        arr_offsets = np.array([dict_entities[x][0] for x in list_found])
+        arr_counts = np.array([dict_entities[x][1] for x in list_found])
+        arr_rows = np.repeat(arr_offsets, arr_counts) + np.arange(arr_counts.sum()) - np.repeat(np.cumsum(arr_counts)-arr_counts, arr_counts)
+        arr_match = np.asarray(dict_curves['curve'][arr_rows]) == int_curveid
+        arr_rows = arr_rows[arr_match]
+        arr_entity = np.repeat(np.array(list_found, dtype=object), arr_counts)[arr_match]
+
+        arr_values = dict_curves['pd' if str_field == 'pd' else 'ir'][arr_rows]
+        if str_field != 'pd':
+            arr_values = decodeRatings(dict_curves, arr_values)
+        list_frames.append(pd.DataFrame(arr_values, columns=range(1, arr_values.shape[1]+1),
+                                        index=pd.MultiIndex.from_arrays([[str_run]*len(arr_rows), arr_entity], names=['run', 'entityId'])))
+
+    if len(list_frames) == 0:
+        return None
+    return pd.concat(list_frames)
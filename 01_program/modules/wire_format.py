@@ -0,0 +1,155 @@
+import re
+import gzip
+import json
+import math
+import datetime
+import numpy as np
+# pip install orjson (optional: several times faster than the json module on large payloads)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Wire format of the API payloads: JSON without any whitespace, encoded with orjson when it is installed and
+# with the json module otherwise (both give the same compact UTF-8 bytes: numpy scalars and arrays as plain values,
+# dates as ISO 8601 strings and NaN / infinity as null), and gzip for large request bodies.
+# Responses are decompressed by requests itself, which asks for gzip / deflate in its Accept-Encoding header.
+
+# %%
+def replaceNaN(obj):
+    # obj with NaN and infinite floats replaced by None, as orjson writes them (null); the json module would
+    # write the invalid JSON tokens NaN / Infinity
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k.item() if isinstance(k, np.generic) else k: replaceNaN(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [replaceNaN(v) for v in obj]
+    return obj
+
+def defaultJSON(obj):
+    # values neither encoder handles natively (e.g. read from the workbook by pandas)
+    if isinstance(obj, np.datetime64):
+        return obj.astype('datetime64[us]').item().isoformat()
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return replaceNaN(obj.tolist())
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    return str(obj)
+
+def encodeJSON(obj):
+    # UTF-8 bytes of obj; numpy scalars (e.g. values read from the workbook) are serialised as plain numbers
+    if orjson is not None:
+        return orjson.dumps(obj, default=defaultJSON, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(replaceNaN(obj), separators=(',', ':'), ensure_ascii=False, allow_nan=False, default=defaultJSON).encode('utf-8')
+
+def decodeJSON(content):
+    # content: bytes or str of a response body
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def loadsResponse(response):
+    # the body of a requests.Response (or of one rebuilt from the journal), as response.json() would give it
+    return decodeJSON(response.content)
+
+# %%
+arr_jsonspecial = np.zeros(256, dtype=bool)
+arr_jsonspecial[[ord(c) for c in '"\\{}[]']] = True
+
+def scanBrackets(bytes_content, int_blockbytes=16*1024**2, bytes_separators=b""):
+    # offsets of the brackets (and of the bytes_separators, e.g. b",:") of a JSON document that are outside its
+    # strings, and the nesting depth after each (a '{' or '[' of the top-level value gives 1), found with numpy one
+    # block of bytes at a time, on the quotes, backslashes, brackets and separators of the block only
+    arr_special = arr_jsonspecial
+    if len(bytes_separators) > 0:
+        arr_special = arr_jsonspecial.copy()
+        arr_special[list(bytes_separators)] = True
+    arr_separators = np.frombuffer(bytes_separators, dtype=np.uint8)
+    list_pos, list_depth = [], []
+    int_backslashes, int_quotes, int_depth = 0, 0, 0
+    for int_offset in range(0, len(bytes_content), int_blockbytes):
+        arr = np.frombuffer(bytes_content, dtype=np.uint8, count=min(int_blockbytes, len(bytes_content)-int_offset), offset=int_offset)
+        arr_pos = np.flatnonzero(arr_special[arr])
+        if len(arr_pos) == 0:
+            int_backslashes = 0
+            continue
+        arr_char = arr[arr_pos]
+        bool_quote = arr_char == 34
+        bool_adjacent = np.concatenate(([arr_pos[0] == 0], np.diff(arr_pos) == 1))
+        bool_backslash = arr_char == 92
+        if int_backslashes > 0 or bool_backslash.any():
+            # runs of backslashes, continued from the end of the previous block; a quote is escaped when an odd run
+            # comes right before it
+            arr_idx = np.arange(len(arr_pos))
+            bool_continued = bool_backslash & bool_adjacent & np.concatenate(([int_backslashes > 0], bool_backslash[:-1]))
+            arr_first = np.maximum.accumulate(np.where(bool_continued, -1, arr_idx))
+            arr_run = np.where(bool_backslash, np.where(arr_first < 0, arr_idx+1+int_backslashes, arr_idx-arr_first+1), 0)
+            arr_prevrun = np.concatenate(([int_backslashes], arr_run[:-1]))*bool_adjacent
+            bool_quote &= arr_prevrun % 2 == 0
+            int_backslashes = int(arr_run[-1]) if arr_pos[-1] == len(arr)-1 else 0
+        arr_quotes = np.cumsum(bool_quote, dtype=np.int64) + int_quotes
+        bool_outside = arr_quotes % 2 == 0
+        bool_open = bool_outside & ((arr_char == 123) | (arr_char == 91))
+        bool_close = bool_outside & ((arr_char == 125) | (arr_char == 93))
+        arr_depth = int_depth + np.cumsum(bool_open.astype(np.int64) - bool_close)
+        bool_keep = bool_open | bool_close | (bool_outside & np.isin(arr_char, arr_separators))
+        list_pos.append(arr_pos[bool_keep]+int_offset)
+        list_depth.append(arr_depth[bool_keep])
+        int_quotes, int_depth = int(arr_quotes[-1] % 2), int(arr_depth[-1])
+    if len(list_pos) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(list_pos), np.concatenate(list_depth)
+
+def splitJSONArray(bytes_content, str_key, int_partbytes):
+    # bytes_content (a JSON object) split without decoding it into documents holding a run of the items of its
+    # top-level array str_key, of about int_partbytes each, and every other key as it is; None when there is no
+    # such array of objects
+    arr_pos, arr_depth = scanBrackets(bytes_content)
+    for match in re.finditer(rb'"'+re.escape(str_key.encode('utf-8'))+rb'"\s*:\s*\[', bytes_content):
+        int_open = match.end()-1
+        i = int(np.searchsorted(arr_pos, int_open))
+        if i < len(arr_pos) and arr_pos[i] == int_open and arr_depth[i] == 2:
+            break
+    else:
+        return None
+    # the brackets of the array up to its ']'; an item opens from depth 2 to 3 and closes back to 2
+    j = i+1+int(np.argmax(arr_depth[i+1:] == 1))
+    arr_starts = arr_pos[i+1:j][(arr_depth[i+1:j] == 3) & (arr_depth[i:j-1] == 2)]
+    arr_ends = arr_pos[i+1:j][arr_depth[i+1:j] == 2]
+    int_close = int(arr_pos[j])
+    if len(arr_starts) == 0:
+        return [bytes_content] if bytes_content[int_open+1:int_close].strip() == b"" else None
+    bytes_head, bytes_tail = bytes_content[:int_open+1], bytes_content[int_close:]
+
+    # runs of whole items, a new run whenever an item ends past the next multiple of int_partbytes
+    arr_part = (arr_ends-arr_starts[0]) // max(int_partbytes, 1)
+    arr_last = np.append(np.flatnonzero(np.diff(arr_part)), len(arr_ends)-1)
+    arr_first = np.append(0, arr_last[:-1]+1)
+    list_parts = [bytes_head+bytes_content[arr_starts[k]:arr_ends[m]+1]+bytes_tail for k, m in zip(arr_first, arr_last)]
+    return list_parts
+
+def getIndentedBytes(bytes_content, int_indent=4):
+    # size of a compact JSON document once encoded with json.dumps(indent=int_indent, ensure_ascii=False), as the
+    # payloads were sent before: a space after each ':', and a line break and the indent after each ',', after
+    # the '{' / '[' and before the '}' / ']' of a non-empty container
+    arr_pos, arr_depth = scanBrackets(bytes_content, bytes_separators=b",:")
+    arr_char = np.frombuffer(bytes_content, dtype=np.uint8)[arr_pos]
+    bool_colon = arr_char == 58
+    bool_open = (arr_char == 123) | (arr_char == 91)
+    bool_close = (arr_char == 125) | (arr_char == 93)
+    # '[]' and '{}' stay as they are
+    bool_emptypair = bool_open[:-1] & bool_close[1:] & (np.diff(arr_pos) == 1)
+    bool_empty = np.append(bool_emptypair, False) | np.insert(bool_emptypair, 0, False)
+    bool_break = ~bool_colon & ~bool_empty
+    return len(bytes_content) + int(bool_colon.sum()) + int(bool_break.sum()) + int_indent*int(arr_depth[bool_break].sum())
+
+# %%
+def compressBody(bytes_body, int_minbytes=1024, int_level=6):
+    # gzip the body if it is large enough to be worth it; returns the body to send and whether it is compressed
+    if len(bytes_body) < int_minbytes:
+        return bytes_body, False
+    bytes_compressed = gzip.compress(bytes_body, compresslevel=int_level)
+    if len(bytes_compressed) >= len(bytes_body):
+        return bytes_body, False
+    return bytes_compressed, True
@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+import requests
+
+# the tests import the modules package as main.py does, from the program folder (python -m pytest 01_program/tests)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# %%
+# helpers shared by the tests: from conftest import makeResponse, makeOutput, makeOutputs
+def makeResponse(int_status, obj):
+    response = requests.Response()
+    response.status_code = int_status
+    response._content = json.dumps(obj).encode('utf-8')
+    response.encoding = 'utf-8'
+    return response
+
+def makeOutput(str_entityid, float_scale=1.0, list_ratings=("Aaa", "Baa1", "Caa-C (sf)", "Ä1"), int_years=None):
+    # a flattened climate PD output (extractAPIOutput_ClimatePDs): a baseline and a transitionRisk curve of int_years
+    # (by default, as many as the ratings), with no implied rating past the ratings given
+    int_years = len(list_ratings) if int_years is None else int_years
+    list_rows = []
+    for str_risktype, str_scenario in [("baseline", "baseline"), ("transitionRisk", "Net Zero 2050")]:
+        list_rows += [("NGFS", str_entityid, "2023-06-01", False, str_risktype, str_scenario, float_scale*year/100,
+                       list_ratings[year-1] if year <= len(list_ratings) else None, year) for year in range(1, int_years+1)]
+    return pd.DataFrame(list_rows, columns=["scenarioCategory", "entityId", "asOfDate", "isfin", "RiskType", "Scenario", "pd", "impliedRating", "year"])
+
+def makeOutputs(int_entities, int_years=5, tuple_increments=(0.1, 1.0), int_seed=0):
+    # flattened climate PD outputs of int_entities entities: cumulative PDs (in %) of a baseline and a combinedRisk
+    # curve of int_years each, growing by uniform increments within tuple_increments
+    rng = np.random.default_rng(int_seed)
+    list_outputs = []
+    for i in range(int_entities):
+        list_rows = []
+        for str_risktype, str_scenario in [("baseline", "baseline"), ("combinedRisk", "NetZero2050")]:
+            arr_pd = np.cumsum(rng.uniform(*tuple_increments, int_years))
+            list_rows += [(f"E{i}", str_risktype, str_scenario, year+1, arr_pd[year]) for year in range(int_years)]
+        list_outputs.append(pd.DataFrame(list_rows, columns=['entityId', 'RiskType', 'Scenario', 'year', 'pd']))
+    return list_outputs
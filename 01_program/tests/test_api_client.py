@@ -0,0 +1,143 @@
+import threading
+import time
+import requests
+import pytest
+from modules import moodys_climate_api as mapi
+from modules import ownfirm_to_moodys_connectors as amc
+
+# %%
+@pytest.fixture
+def client(monkeypatch):
+    # a client section without config.json, and breakers / hedge pool of this test only; returns the section so a
+    # test can change it
+    dict_client = {"breakerFailures": 2, "breakerCooldown": 0.2, "maxConcurrency": 4}
+    monkeypatch.setitem(mapi.dict_config, 'config', {"client": dict_client})
+    monkeypatch.setattr(mapi, "dict_breakers", {})
+    monkeypatch.setattr(mapi, "dict_hedgestate", {})
+    return dict_client
+
+def makeResponse(int_status, bytes_content=b"{}"):
+    response = requests.Response()
+    response.status_code = int_status
+    response._content = bytes_content
+    return response
+
+def replyWith(monkeypatch, func_reply):
+    # performRequest answers with func_reply(int_call) (a response, or an exception raised); returns the calls made
+    list_calls = []
+    lock_calls = threading.Lock()
+    def performRequest(str_endpoint, method, url, **kwargs):
+        with lock_calls:
+            list_calls.append(url)
+            int_call = len(list_calls)
+        reply = func_reply(int_call)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+    monkeypatch.setattr(mapi, "performRequest", performRequest)
+    return list_calls
+
+def test_breaker_opens_then_probe_closes(client, monkeypatch):
+    replyWith(monkeypatch, lambda int_call: requests.ConnectionError("down") if int_call <= 2 else makeResponse(200))
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            mapi.sendRequest("ep", "POST", "u")
+    assert mapi.dict_breakers["ep"]['state'] == 'open'
+
+    # held until the cooldown has passed, then sent as the probe, which closes the breaker
+    float_start = time.monotonic()
+    assert mapi.sendRequest("ep", "POST", "u").status_code == 200
+    assert time.monotonic()-float_start >= 0.15
+    assert mapi.dict_breakers["ep"]['state'] == 'closed'
+
+def test_client_errors_do_not_open_the_breaker(client, monkeypatch):
+    replyWith(monkeypatch, lambda int_call: makeResponse(404 if int_call % 2 else 503))
+    mapi.sendRequest("ep", "POST", "u")
+    mapi.sendRequest("ep", "POST", "u")
+    assert mapi.dict_breakers["ep"]['state'] == 'closed' and mapi.dict_breakers["ep"]['failures'] == 1
+    mapi.sendRequest("ep", "POST", "u")
+    mapi.sendRequest("ep", "POST", "u")
+    # two 5xx, but not in a row
+    assert mapi.dict_breakers["ep"]['state'] == 'closed'
+
+def test_failed_probe_fails_held_requests(client, monkeypatch):
+    event_probing = threading.Event()
+    event_release = threading.Event()
+    def reply(int_call):
+        if int_call <= 2:
+            return makeResponse(503)
+        event_probing.set()
+        event_release.wait(5)
+        return makeResponse(503)
+    list_calls = replyWith(monkeypatch, reply)
+    mapi.sendRequest("ep", "POST", "u")
+    mapi.sendRequest("ep", "POST", "u")
+    time.sleep(0.25)
+
+    list_results = []
+    thread_probe = threading.Thread(target=lambda: list_results.append(mapi.sendRequest("ep", "POST", "u").status_code))
+    thread_probe.start()
+    assert event_probing.wait(5)
+    def sendHeld():
+        try:
+            mapi.sendRequest("ep", "POST", "u")
+        except mapi.CircuitOpenError:
+            list_results.append("circuit open")
+    thread_held = threading.Thread(target=sendHeld)
+    thread_held.start()
+    time.sleep(0.05)
+    event_release.set()
+    thread_probe.join(5)
+    thread_held.join(5)
+
+    assert sorted(map(str, list_results)) == ["503", "circuit open"]
+    # the held request was never sent
+    assert len(list_calls) == 3
+    assert mapi.dict_breakers["ep"]['state'] == 'open'
+
+def test_disabled_breakers(client, monkeypatch):
+    client["breakerFailures"] = 0
+    replyWith(monkeypatch, lambda int_call: makeResponse(503))
+    for _ in range(5):
+        assert mapi.sendRequest("ep", "POST", "u").status_code == 503
+    assert "ep" not in mapi.dict_breakers
+
+def test_hedged_get_takes_the_first_answer(client, monkeypatch):
+    client["hedgeRequests"] = {"ep": 0.05}
+    event_release = threading.Event()
+    def reply(int_call):
+        if int_call == 1:
+            event_release.wait(5)
+            return makeResponse(200, b"slow")
+        return makeResponse(200, b"hedge")
+    list_calls = replyWith(monkeypatch, reply)
+    assert mapi.sendRequest("ep", "GET", "u").content == b"hedge"
+    assert len(list_calls) == 2
+    event_release.set()
+
+    # answered within the delay: no duplicate; POSTs are never hedged
+    list_calls = replyWith(monkeypatch, lambda int_call: makeResponse(200, b"fast"))
+    assert mapi.sendRequest("ep", "GET", "u").content == b"fast"
+    assert mapi.sendRequest("ep", "POST", "u").content == b"fast"
+    assert len(list_calls) == 2
+
+def test_process_result_times_out(client, monkeypatch):
+    client["processTimeout"] = 0.1
+    list_calls = replyWith(monkeypatch, lambda int_call: makeResponse(200, b'{"status": "Running"}'))
+    with pytest.raises(requests.Timeout):
+        mapi.getProcessResult({'id_token': "t"}, "p1")
+    assert len(list_calls) >= 2
+
+def test_failed_request_keeps_other_entities(client, monkeypatch):
+    def getResponse(dict_token, info_type, json_data):
+        if b'"E2"' in json_data:
+            raise mapi.CircuitOpenError("Circuit breaker of climate_pds_TPC is open")
+        return 200, makeResponse(200, json_data)
+    monkeypatch.setattr(mapi, "getAuth", lambda: (200, {'id_token': "t"}))
+    monkeypatch.setattr(mapi, "getResponse", getResponse)
+    monkeypatch.setattr(amc.time, "sleep", lambda seconds: None)
+
+    list_apiinputs = [{"entities": [{"entityId": entityid}]} for entityid in ["E1", "E2", "E3", "E1"]]
+    list_responses = amc.obtainClimatePDs(False, list_apiinputs, None)
+    assert [response.status_code for response in list_responses] == [200, None, 200, 200]
+    assert list_responses[0] is list_responses[3]
@@ -0,0 +1,90 @@
+import json
+import pandas as pd
+from modules import ownfirm_data_formatters as adf
+from modules import wire_format as wf
+from conftest import makeResponse
+
+# %%
+def makeEntity(str_entityid):
+    if str_entityid.startswith("BAD"):
+        return {"entityId": str_entityid, "errorMessage": "not found"}
+    def curve(float_scale):
+        return {"pd": {f"pd{i}y": float_scale*i for i in range(1, 11)},
+                "impliedRating": {f"impliedRating{i}y": "A3" for i in range(1, 6)}}
+    return {"entityId": str_entityid, "asOfDate": "2023-06-01", "isfin": False, "physicalRiskScore": 30,
+            "baseline": curve(0.1), "combinedRisk": {"NetZero2050": curve(0.2), "CurrentPolicies": curve(0.3)},
+            "transitionRisk": {"NetZero2050": curve(0.4)}}
+
+def makeBody(list_entityids):
+    return {"scenarioCategory": "NGFS", "entities": [makeEntity(x) for x in list_entityids]}
+
+# %%
+def test_entity_frames():
+    list_outputs = adf.extractAPIOutput_ClimatePDs([makeResponse(200, makeBody(["E1"]))], None)
+    assert len(list_outputs) == 1
+    df = list_outputs[0]
+    assert df.columns.tolist() == adf.list_climatepdcols
+    # 4 curves of 10 years, the implied ratings past year 5 missing
+    assert len(df) == 40
+    assert df['year'].tolist()[:10] == list(range(1, 11))
+    assert df['impliedRating'].iloc[5:10].isna().all()
+    assert set(zip(df['RiskType'], df['Scenario'])) == {("baseline", "baseline"), ("combinedRisk", "NetZero2050"),
+                                                        ("combinedRisk", "CurrentPolicies"), ("transitionRisk", "NetZero2050")}
+
+def test_failed_response_and_entity():
+    list_responses = [makeResponse(200, makeBody(["E1", "BAD1", "E2"])), makeResponse(500, {"detail": "error"})]
+    list_outputs = adf.extractAPIOutput_ClimatePDs(list_responses, None)
+    assert [x is None for x in list_outputs] == [False, True, False, True]
+    assert list_outputs[2]['entityId'].unique().tolist() == ["E2"]
+
+def test_split_response_matches_whole():
+    # a large body is split into entity ranges, each task getting only its own slice
+    list_entityids = [f"E{i}" for i in range(50)]+["BAD1"]
+    response = makeResponse(200, makeBody(list_entityids))
+    list_whole = adf.extractAPIOutput_ClimatePDs([response], None, int_taskbytes=1024**3)
+    list_split = adf.extractAPIOutput_ClimatePDs([response], None, int_taskbytes=5000)
+    assert len(adf.genClimatePDTasks([response.content], 5000)) > 1
+    assert len(list_split) == len(list_whole) == 51
+    for df_whole, df_split in zip(list_whole, list_split):
+        if df_whole is None:
+            assert df_split is None
+        else:
+            pd.testing.assert_frame_equal(df_whole, df_split)
+
+def test_split_tasks_hold_bytes():
+    response = makeResponse(200, makeBody([f"E{i}" for i in range(20)]))
+    list_tasks = adf.genClimatePDTasks([response.content], 2000)
+    list_items = [item for list_task in list_tasks for item in list_task]
+    assert len(list_items) > 1
+    # about int_taskbytes each: a part ends with the entity that crosses it
+    assert all(isinstance(content, bytes) and len(content) < 2*2000 for int_response, content in list_items)
+    list_parts = [json.loads(content) for int_response, content in list_items]
+    assert [entity["entityId"] for part in list_parts for entity in part["entities"]] == [f"E{i}" for i in range(20)]
+    assert all(part["scenarioCategory"] == json.loads(response.content)["scenarioCategory"] for part in list_parts)
+
+def test_split_json_array_at_byte_offsets():
+    # brackets, quotes and backslashes inside strings are not structure
+    dict_body = {"a": "[{\\\"", "entities": [{"id": i, "s": "}]\\", "x": [[1], {"y": "\""}]} for i in range(30)], "z": {"entities": []}}
+    bytes_body = json.dumps(dict_body).encode('utf-8')
+    for int_blockbytes in [7, 1024**2]:
+        arr_pos, arr_depth = wf.scanBrackets(bytes_body, int_blockbytes)
+        assert arr_depth[-1] == 0 and arr_depth.min() == 0 and len(arr_pos) == 2+2+30*8+4
+    list_parts = wf.splitJSONArray(bytes_body, "entities", 200)
+    assert len(list_parts) > 5
+    list_entities = []
+    for bytes_part in list_parts:
+        dict_part = json.loads(bytes_part)
+        assert dict_part["a"] == dict_body["a"] and dict_part["z"] == dict_body["z"]
+        list_entities += dict_part["entities"]
+    assert list_entities == dict_body["entities"]
+    assert wf.splitJSONArray(b'{"entities": []}', "entities", 10) == [b'{"entities": []}']
+    assert wf.splitJSONArray(b'{"entities": [1, 2]}', "entities", 1) is None
+    assert wf.splitJSONArray(b'{"other": [{"entities": [{}]}]}', "entities", 1) is None
+
+def test_process_pool_matches_serial():
+    list_responses = [makeResponse(200, makeBody([f"E{i}"])) for i in range(6)]+[makeResponse(200, makeBody([f"M{i}" for i in range(10)]))]
+    list_serial = adf.extractAPIOutput_ClimatePDs(list_responses, None)
+    list_parallel = adf.extractAPIOutput_ClimatePDs(list_responses, None, int_workers=2, int_taskbytes=3000)
+    assert len(list_serial) == len(list_parallel) == 16
+    for df_serial, df_parallel in zip(list_serial, list_parallel):
+        pd.testing.assert_frame_equal(df_serial, df_parallel)
@@ -0,0 +1,73 @@
+import os
+import importlib.util
+import pandas as pd
+import pytest
+from modules import dataset_writer as dw
+
+# %%
+def makeOutput(str_entity, list_scenarios, int_years=3):
+    # a flattened climate PD output (extractAPIOutput_ClimatePDs) of one entity
+    list_rows = [("physicalAndTransition", str_risktype, str_scenario, str_entity, year, 0.01*year)
+                 for str_risktype, str_scenario in list_scenarios for year in range(int_years, 0, -1)]
+    return pd.DataFrame(list_rows, columns=['scenarioCategory', 'RiskType', 'Scenario', 'entityId', 'year', 'pd'])
+
+list_scenarios = [("baseline", "baseline"), ("combinedRisk", "Net Zero 2050/1.5C")]
+
+def readCSVDataset(path_dataset):
+    list_frames = []
+    for path_folder, _, list_files in os.walk(path_dataset):
+        for str_file in sorted(list_files):
+            df = pd.read_csv(os.path.join(path_folder, str_file))
+            df['file'] = os.path.relpath(os.path.join(path_folder, str_file), path_dataset)
+            list_frames.append(df)
+    return pd.concat(list_frames, ignore_index=True)
+
+def test_partitions_are_sorted_and_deduplicated(tmp_path):
+    dict_dataset = dw.openDataset(str(tmp_path), "csv", int_writers=2)
+    list_outputs = [makeOutput("E2", list_scenarios), makeOutput("E1", list_scenarios), makeOutput("E2", list_scenarios), None]
+    dw.submitOutputs(dict_dataset, 0, list_outputs)
+    assert dw.closeDataset(dict_dataset) == 2
+
+    df = readCSVDataset(str(tmp_path))
+    assert sorted(df['file'].unique()) == [
+        "scenarioCategory=physicalAndTransition/RiskType=baseline/Scenario=baseline/part-00000.csv",
+        "scenarioCategory=physicalAndTransition/RiskType=combinedRisk/Scenario=Net Zero 2050%2F1.5C/part-00000.csv",
+    ]
+    # the partition columns are in the folder names only; the rows are sorted by entity and year, each once
+    assert list(df.columns) == ['entityId', 'year', 'pd', 'file']
+    df_part = df[df['file'].str.contains("baseline")]
+    assert list(zip(df_part['entityId'], df_part['year'])) == [("E1", 1), ("E1", 2), ("E1", 3), ("E2", 1), ("E2", 2), ("E2", 3)]
+
+def test_streaming_parts_do_not_overwrite(tmp_path):
+    dict_dataset = dw.openDataset(str(tmp_path), "csv")
+    for int_part, str_entity in enumerate(["E1", "E2"]):
+        list_futures = dw.submitOutputs(dict_dataset, int_part, [makeOutput(str_entity, list_scenarios[:1])])
+        assert len(list_futures) == 1
+    assert dw.submitOutputs(dict_dataset, 2, []) == []
+    assert dw.closeDataset(dict_dataset) == 2
+    assert not any(str_file.endswith(".tmp") for _, _, list_files in os.walk(str(tmp_path)) for str_file in list_files)
+    assert sorted(readCSVDataset(str(tmp_path))['entityId']) == ["E1"]*3 + ["E2"]*3
+
+def test_failed_write_is_raised(tmp_path):
+    # the dataset folder is a file, so the writer threads cannot create the partition folders
+    path_file = tmp_path / "dataset"
+    path_file.write_text("")
+    dict_dataset = dw.openDataset(str(path_file), "csv")
+    dw.submitOutputs(dict_dataset, 0, [makeOutput("E1", list_scenarios)])
+    with pytest.raises(OSError):
+        dw.closeDataset(dict_dataset)
+
+@pytest.mark.skipif(importlib.util.find_spec("pyarrow") is None, reason="pyarrow is not installed")
+def test_parquet_partitions_are_filterable(tmp_path):
+    dict_dataset = dw.openDataset(str(tmp_path), "parquet")
+    dw.submitOutputs(dict_dataset, 0, [makeOutput("E1", list_scenarios), makeOutput("E2", list_scenarios)])
+    dw.closeDataset(dict_dataset)
+
+    df = pd.read_parquet(str(tmp_path), filters=[("RiskType", "=", "combinedRisk")])
+    assert len(df) == 6
+    assert set(df['Scenario'].astype(str)) == {"Net Zero 2050/1.5C"}
+
+def test_csv_fallback_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name, *args: None)
+    assert dw.getDatasetFormat("parquet") == "csv"
+    assert dw.getDatasetFormat("csv") == "csv"
@@ -0,0 +1,68 @@
+import json
+import random
+import threading
+import pytest
+from modules import ownfirm_to_moodys_connectors as amc
+from modules import run_journal as rj
+from conftest import makeResponse
+
+# %%
+@pytest.fixture
+def api(monkeypatch):
+    # the ESG endpoint answers with func_reply(list_batch) (None: scored); returns the batches sent
+    dict_api = {'reply': lambda list_batch: None, 'sent': []}
+    lock_sent = threading.Lock()
+    def getResponse(dict_token, info_type, json_data):
+        list_batch = json.loads(json_data)
+        with lock_sent:
+            dict_api['sent'].append([x["batchResponseIdentifier"] for x in list_batch])
+        int_status = dict_api['reply'](list_batch)
+        if int_status is not None:
+            return int_status, makeResponse(int_status, {"detail": "rejected"})
+        list_results = [{"inputs": {"batchResponseIdentifier": x["batchResponseIdentifier"]}, "globalScores": {"s": 1}} for x in list_batch]
+        random.shuffle(list_results)
+        return 200, makeResponse(200, list_results)
+    monkeypatch.setattr(amc.mapi, "getConfig", lambda section=None: {"esgBatchSize": 8, "esgWorkers": 2, "esgRetries": 2})
+    monkeypatch.setattr(amc.mapi, "getAuth", lambda: (200, {'id_token': "t"}))
+    monkeypatch.setattr(amc.mapi, "getResponse", getResponse)
+    monkeypatch.setattr(amc.time, "sleep", lambda seconds: None)
+    return dict_api
+
+def getScoredIds(response_esg):
+    return [result["inputs"]["batchResponseIdentifier"] for result in json.loads(response_esg.content)]
+
+list_records = [{"batchResponseIdentifier": f"E{i}", "x": i} for i in range(20)]
+
+def test_results_in_record_order(api):
+    response_esg = amc.obtainESG(list_records+[dict(list_records[0])], None)
+    assert getScoredIds(response_esg) == [f"E{i}" for i in range(20)]+["E0"]
+    # 3 batches, the repeated record not sent again
+    assert sum(len(list_batch) for list_batch in api['sent']) == 20
+
+@pytest.mark.parametrize("int_status", [400, 422])
+def test_rejected_batch_is_split_down_to_the_bad_record(api, int_status):
+    api['reply'] = lambda list_batch: int_status if any(x["batchResponseIdentifier"] == "E5" for x in list_batch) else None
+    response_esg = amc.obtainESG(list_records, None)
+    assert getScoredIds(response_esg) == [f"E{i}" for i in range(20) if i != 5]
+    assert ["E5"] in api['sent']
+
+@pytest.mark.parametrize("int_status", [401, 403, 404])
+def test_other_client_errors_fail_the_batch_at_once(api, int_status):
+    api['reply'] = lambda list_batch: int_status if any(x["batchResponseIdentifier"] == "E5" for x in list_batch) else None
+    response_esg = amc.obtainESG(list_records, None)
+    assert getScoredIds(response_esg) == [f"E{i}" for i in range(20) if i >= 8]
+    # the batch of E5 is sent once, neither split nor retried
+    assert sum("E5" in list_batch for list_batch in api['sent']) == 1
+
+def test_server_errors_are_retried_and_journaled(api, tmp_path):
+    list_statuses = [503]
+    api['reply'] = lambda list_batch: list_statuses.pop() if len(list_statuses) > 0 else None
+    dict_journal = rj.openJournal(str(tmp_path))
+    response_esg = amc.obtainESG(list_records, None, dict_journal)
+    assert getScoredIds(response_esg) == [f"E{i}" for i in range(20)]
+    assert len(api['sent']) == 4
+
+    # every batch is in the journal: nothing is sent again
+    api['sent'].clear()
+    assert getScoredIds(amc.obtainESG(list_records, None, rj.openJournal(str(tmp_path)))) == [f"E{i}" for i in range(20)]
+    assert api['sent'] == []
@@ -0,0 +1,29 @@
+import datetime
+import logging
+import pytest
+from modules import file_handlers as fh
+
+# %%
+def test_run_folders_started_in_the_same_second(tmp_path):
+    dtts = datetime.datetime(2023, 9, 14, 21, 0, 0)
+    list_folders = [fh.createFolder(str(tmp_path), "book", dtts) for _ in range(3)]
+    assert [name for path, name in list_folders] == ["book_20230914_210000", "book_20230914_210000_2", "book_20230914_210000_3"]
+    assert all((tmp_path / name).is_dir() for path, name in list_folders)
+    # the folders of a run are shared
+    assert fh.createFolder(str(tmp_path / "book_20230914_210000" / "pickles")) == str(tmp_path / "book_20230914_210000" / "pickles")
+    assert fh.createFolder(str(tmp_path / "book_20230914_210000" / "pickles")) == str(tmp_path / "book_20230914_210000" / "pickles")
+
+@pytest.mark.parametrize("bool_queued", [False, True])
+def test_isolated_log_is_closed_and_dropped(tmp_path, bool_queued):
+    dtts_begin = datetime.datetime.now()
+    logger = fh.createLog(str(tmp_path), "book_run", bool_isolated=True, bool_queued=bool_queued)
+    logger.info("request sent")
+    # the file handler, behind the queue listener in queued mode
+    list_filehandlers = list(logger.handlers[0].listener.handlers) if bool_queued else list(logger.handlers)
+    fh.closeLog(logger, dtts_begin, datetime.datetime.now())
+
+    assert "book_run" not in logging.Logger.manager.loggerDict
+    assert logger.handlers == []
+    assert all(handler.stream is None for handler in list_filehandlers)
+    str_log = (tmp_path / "book_run.log").read_text()
+    assert "request sent" in str_log and "Process is Completed" in str_log
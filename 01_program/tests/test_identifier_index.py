@@ -0,0 +1,39 @@
+import sqlite3
+import pandas as pd
+from modules import identifier_index as idx
+
+# %%
+def makeEntities(list_rows):
+    # the entities of the mapping responses (extractAPIOutput_Entity)
+    return pd.DataFrame(list_rows, columns=["entityId", "pid", "identifierIsin", "identifierLei", "internationalName"])
+
+def test_every_returned_identifier_is_indexed(tmp_path):
+    path_index = str(tmp_path / "index" / "identifiers.sqlite")
+    list_identifiers = ["US0378331005", "X1", "US0378331005"]
+    assert idx.findUnknownIdentifiers(path_index, list_identifiers) == ["US0378331005", "X1"]
+
+    df_entities = makeEntities([("N00001", "N00001", "US0378331005", "HWUPKR0MPOU8FGXBT394", "APPLE INC")])
+    assert idx.storeMappings(path_index, ["US0378331005", "X1"], df_entities) == 4
+    assert idx.findUnknownIdentifiers(path_index, list_identifiers) == []
+    # the LEI was not queried, but came back with the entity
+    assert idx.lookupIdentifiers(path_index, ["HWUPKR0MPOU8FGXBT394", "X1", "X2"]) == {"HWUPKR0MPOU8FGXBT394": "N00001", "X1": None}
+
+def test_missing_identifier_columns_are_skipped(tmp_path):
+    path_index = str(tmp_path / "identifiers.sqlite")
+    df_entities = makeEntities([("N00002", "N00002", None, float("nan"), "ACME")])
+    idx.storeMappings(path_index, ["N00002"], df_entities)
+    assert idx.lookupIdentifiers(path_index, ["N00002", "None", "nan"]) == {"N00002": "N00002"}
+    assert idx.storeMappings(path_index, ["X1"], None) == 1
+
+def test_unresolved_identifiers_are_queried_again_once_expired(tmp_path):
+    path_index = str(tmp_path / "identifiers.sqlite")
+    df_entities = makeEntities([("N00001", "N00001", "US0378331005", None, "APPLE INC")])
+    idx.storeMappings(path_index, ["US0378331005", "X1"], df_entities)
+    assert idx.findUnknownIdentifiers(path_index, ["US0378331005", "X1"]) == []
+
+    # both checked ten days ago: only the unresolved one has expired
+    with sqlite3.connect(path_index) as conn:
+        conn.execute("UPDATE identifiers SET checked = datetime('now', 'localtime', '-10 days')")
+    conn.close()
+    assert idx.findUnknownIdentifiers(path_index, ["US0378331005", "X1"]) == ["X1"]
+    assert idx.findUnknownIdentifiers(path_index, ["US0378331005", "X1"], int_negativedays=30) == []
@@ -0,0 +1,49 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import modules
+
+# seconds; the package itself only sets up the lazy submodules, the pipeline loads pandas
+float_budget_package = 0.5
+float_budget_pipeline = 3.0
+
+path_program = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# %%
+def importInSubprocess(str_module):
+    # a fresh interpreter imports str_module; returns the import time and the modules it loaded
+    str_code = (
+        "import sys, time, json\n"
+        "float_start = time.perf_counter()\n"
+        f"import {str_module}\n"
+        "print(json.dumps({'seconds': time.perf_counter()-float_start, 'modules': sorted(sys.modules)}))\n"
+    )
+    rs = subprocess.run([sys.executable, "-c", str_code], cwd=path_program, capture_output=True, text=True, check=True)
+    return json.loads(rs.stdout.strip().splitlines()[-1])
+
+def test_package_import_is_cheap():
+    dict_import = importInSubprocess("modules")
+    for str_module in ['pandas', 'openpyxl', 'requests', 'numpy']:
+        assert str_module not in dict_import['modules']
+    assert [m for m in dict_import['modules'] if m.startswith("modules.")] == []
+    assert dict_import['seconds'] < float_budget_package
+
+def test_pipeline_import_does_not_load_other_modules():
+    dict_import = importInSubprocess("modules.pipeline")
+    for str_module in ['openpyxl', 'requests', 'scipy']:
+        assert str_module not in dict_import['modules']
+    assert [m for m in dict_import['modules'] if m.startswith("modules.")] == ['modules.pipeline']
+    assert dict_import['seconds'] < float_budget_pipeline
+
+def test_lazy_module_is_imported_once_across_threads():
+    wf = modules.lazyModule(".wire_format", "modules")
+    list_functions = []
+    list_threads = [threading.Thread(target=lambda: list_functions.append(wf.encodeJSON)) for _ in range(8)]
+    for thread in list_threads:
+        thread.start()
+    for thread in list_threads:
+        thread.join()
+    assert len(list_functions) == 8
+    assert all(func is sys.modules["modules.wire_format"].encodeJSON for func in list_functions)
@@ -0,0 +1,65 @@
+import datetime
+import numpy as np
+import pandas as pd
+from modules import input_validation as iv
+from modules import pipeline as ppl
+
+# %%
+def makeInputTable(int_rows):
+    # Private firms with every EDF-X and ESG field valid
+    return pd.DataFrame({
+        'entityId': [f"E{i}" for i in range(int_rows)], 'firmStatus': "Private", 'entityName': "Firm", 'primaryCountry': "USA",
+        'countryWeight': 1, 'EDF-XIndustryClass': "NDY", 'EDF-XIndustryCode': "N01", 'EDF-XIndustryWeight': 1, 'PD': 0.01,
+        'impliedRating': "Baa1", 'financialStatementDate': "2023-01-31", 'asOfDate': datetime.date(2023, 6, 1), 'netSales': 100.0,
+        'totalAssets': 200.0, 'regionClassification': "ISO", 'regionCode': "USA", 'ESGIndustryClass': "NACE", 'ESGIndustryCode': "C10",
+        'periodYear': 2022, 'employeeCount': 50, 'assetTurnover': 0.5, 'carbonIntensity': "Low"}, index=range(10, 10+int_rows))
+
+dict_all = {flag: 'ENABLE' for flag in iv.dict_deliverables.values()}
+
+def test_a_row_is_only_left_out_of_the_deliverables_of_its_field():
+    df = makeInputTable(4)
+    df.loc[11, 'carbonIntensity'] = "Extreme"
+    df.loc[12, 'impliedRating'] = "AAA"
+    df.loc[13, 'EDF-XIndustryClass'] = "XYZ"
+    df_valid, df_rejected, dict_validrows = iv.validateInputTable(df, dict_all)
+
+    # every row is still valid for a deliverable
+    assert df_valid.index.tolist() == [10, 11, 12, 13]
+    assert dict_validrows['esg'].tolist() == [10, 12, 13]
+    assert dict_validrows['climatePDs'].tolist() == dict_validrows['reports'].tolist() == [10, 11]
+    assert dict_validrows['transRiskIndustry'].tolist() == dict_validrows['transRiskRegion'].tolist() == [10, 11, 12]
+    assert df_rejected['rowNo'].tolist() == [13, 14, 15]
+    assert df_rejected['excludedFrom'].tolist() == ["esg", "climatePDs, reports", "climatePDs, transRiskIndustry, transRiskRegion, reports"]
+    assert df_rejected['rejectReasons'].iloc[0] == "carbonIntensity is not one of High, Mixed, Low"
+
+    df_esg = ppl.selectValidRows(dict_validrows, ('esg',), df)
+    assert df_esg['entityId'].tolist() == ["E0", "E2", "E3"]
+    assert ppl.selectValidRows(dict_validrows, iv.tuple_core, df).index.tolist() == [10, 11]
+    assert ppl.selectValidRows(None, ('esg',), df) is df
+
+def test_rules_of_disabled_deliverables_are_not_checked():
+    df = makeInputTable(2)
+    df.loc[10, 'PD'] = -1
+    df.loc[11, 'impliedRating'] = None
+    df.loc[11, 'PD'] = None
+    dict_dcontrol = {'Retrieve Transition Risk Drivers for Industry (Sector)': 'ENABLE'}
+    df_valid, df_rejected, dict_validrows = iv.validateInputTable(df, dict_dcontrol)
+    assert len(df_valid) == 2 and len(df_rejected) == 0
+    assert list(dict_validrows) == ['transRiskIndustry']
+
+    df_valid, df_rejected, dict_validrows = iv.validateInputTable(df, dict(dict_dcontrol, **{'Retrieve Climate Adjusted PDs': 'ENABLE'}))
+    assert df_rejected['rejectReasons'].tolist() == ["PD is not a number in [0, inf]", "PD and impliedRating are both missing"]
+    assert dict_validrows['climatePDs'].tolist() == [] and dict_validrows['transRiskIndustry'].tolist() == [10, 11]
+
+def test_rows_invalid_for_every_deliverable_are_left_out():
+    df = makeInputTable(2)
+    df.loc[11, 'firmStatus'] = "Listed"
+    df_valid, df_rejected, dict_validrows = iv.validateInputTable(df, dict_all, int_rowoffset=100)
+    assert df_valid.index.tolist() == [10]
+    assert df_rejected['rowNo'].tolist() == [113]
+
+def test_dates():
+    sr = pd.Series(["2023-01-31", "2023-01-31T00:00:00", "31/01/2023", datetime.date(2023, 1, 31), pd.Timestamp("2023-01-31"),
+                    np.datetime64("2023-01-31"), 20230131, True], dtype=object)
+    assert iv.checkRule(sr, ('date',)).tolist() == [False, False, True, False, False, False, True, True]
+    assert not iv.checkRule(pd.Series(pd.to_datetime(["2023-01-31"])), ('date',)).any()
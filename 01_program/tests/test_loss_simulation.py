@@ -0,0 +1,63 @@
+import tracemalloc
+import numpy as np
+import pandas as pd
+from modules import ownfirm_models as amodel
+from conftest import makeOutputs
+
+# %%
+def simulate(list_outputs, **kwargs):
+    return amodel.simulatePortfolioLoss(list_outputs, list_years=(1, 5), int_seed=7, **kwargs)
+
+def test_same_losses_for_any_chunking_and_workers():
+    list_outputs = makeOutputs(20, int_years=10, tuple_increments=(0.2, 3.0))
+    int_nsims = 5*amodel.int_blocksims + 123
+    df_stats, df_dist = simulate(list_outputs, int_nsims=int_nsims)
+    # one block per chunk, serially and over two spawned processes
+    for int_workers in [1, 2]:
+        df_stats_chunked, df_dist_chunked = simulate(list_outputs, int_nsims=int_nsims, int_chunkbytes=1, int_workers=int_workers)
+        pd.testing.assert_frame_equal(df_stats_chunked, df_stats, rtol=1e-12)
+        pd.testing.assert_frame_equal(df_dist_chunked, df_dist)
+
+def test_seed_changes_the_losses():
+    list_outputs = makeOutputs(5, int_years=10, tuple_increments=(0.2, 3.0))
+    df_stats, _ = simulate(list_outputs, int_nsims=2000)
+    df_other, _ = amodel.simulatePortfolioLoss(list_outputs, list_years=(1, 5), int_seed=8, int_nsims=2000)
+    assert not np.allclose(df_stats['expectedLoss'], df_other['expectedLoss'])
+
+def test_simulated_mean_matches_analytic_mean():
+    list_exposures = list(np.linspace(1, 3, 30))
+    df_stats, df_dist = simulate(makeOutputs(30, int_years=10, tuple_increments=(0.2, 3.0), int_seed=1), int_nsims=200000, list_exposures=list_exposures)
+    arr_stderr = df_stats['lossStd']/np.sqrt(200000)
+    assert (np.abs(df_stats['expectedLoss']-df_stats['expectedLoss (analytic)']) < 4*arr_stderr).all()
+    # the tail statistics are ordered and the histogram is a distribution
+    assert (df_stats['VaR 99.00%'] <= df_stats['VaR 99.90%']).all()
+    assert (df_stats['VaR 99.90%'] <= df_stats['ES 99.90%']).all()
+    np.testing.assert_allclose(df_dist.groupby(level=[0, 1, 2])['frequency'].sum(), 1)
+
+def test_chunk_memory_stays_under_the_budget_for_a_large_book():
+    # 30000 obligors: one block of all of them alone would take 4096 x 30000 x 8 bytes (~940 MB)
+    int_obligors, int_groups, int_chunkbytes = 30000, 3, 64*1024**2
+    list_chunks = amodel.genLossChunks(2*amodel.int_blocksims, int_obligors, int_groups, int_chunkbytes)
+    assert [len(list_blocks) for list_blocks in list_chunks] == [1, 1]
+
+    rng = np.random.default_rng(0)
+    arr_thresholds = rng.uniform(-3, -1, (int_groups, int_obligors)).astype(np.float32)
+    arr_weights = rng.uniform(0, 1, int_obligors).astype(np.float32)
+    amodel.initLossWorker(arr_thresholds, arr_weights, 0.12, np.linspace(0, arr_weights.sum(), 201), 50, 7)
+    tracemalloc.start()
+    try:
+        arr_sum = amodel.simulateLossChunk(list_chunks[0])[0]
+        int_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert int_peak < int_chunkbytes
+    # every group has losses, added up over the 30 tiles
+    assert arr_sum.shape == (int_groups,) and (arr_sum > 0).all()
+
+def test_same_losses_for_any_chunking_over_several_tiles():
+    list_outputs = makeOutputs(amodel.int_tileobligors+50, int_years=10, tuple_increments=(0.2, 3.0))
+    int_nsims = 2*amodel.int_blocksims
+    df_stats, df_dist = simulate(list_outputs, int_nsims=int_nsims)
+    df_stats_chunked, df_dist_chunked = simulate(list_outputs, int_nsims=int_nsims, int_chunkbytes=1)
+    pd.testing.assert_frame_equal(df_stats_chunked, df_stats, rtol=1e-12)
+    pd.testing.assert_frame_equal(df_dist_chunked, df_dist)
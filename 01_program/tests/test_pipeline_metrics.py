@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from modules import pipeline_metrics as pm
+
+# %%
+def runJob(str_run, int_requests, barrier):
+    # a run whose requests are sent from a thread pool, as the deliverable branches and batches are
+    pm.setRun(str_run)
+    barrier.wait()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(pm.bindRun(lambda i: pm.observeRequest("climatePDs", 0.2, 200, 100)), range(int_requests)))
+    pm.countRetry("climatePDs")
+    pm.setGauge("tasks_running", int_requests)
+
+def test_concurrent_runs_count_their_own_requests(tmp_path):
+    pm.resetMetrics()
+    barrier = threading.Barrier(2)
+    list_threads = [threading.Thread(target=runJob, args=(f"run{i}", 3*i, barrier)) for i in (1, 2)]
+    for thread in list_threads:
+        thread.start()
+    for thread in list_threads:
+        thread.join()
+    pm.setGauge("jobs_queued", 5, "")
+
+    for i in (1, 2):
+        dict_summary = pm.getSummary(f"run{i}")
+        assert dict_summary['endpoints']['climatePDs']['count'] == 3*i
+        assert dict_summary['endpoints']['climatePDs']['bytes'] == 300*i
+        assert dict_summary['endpoints']['climatePDs']['retries'] == 1
+        # process-wide gauges go into every run
+        assert dict_summary['gauges'] == {'jobs_queued': 5, 'tasks_running': 3*i}
+    assert 'climateapi_requests_total{endpoint="climatePDs",status="200"} 6\n' in pm.formatPrometheus("run2")
+
+    # a finished run is dropped, the other one is kept
+    pm.writeMetrics(str(tmp_path), "run1")
+    pm.resetMetrics("run1")
+    assert pm.getSummary("run1")['endpoints'] == {}
+    assert pm.getSummary("run2")['endpoints']['climatePDs']['count'] == 6
+    pm.resetMetrics()
+
+def test_bytes_saved_include_the_compact_encoding():
+    pm.resetMetrics()
+    pm.observeRequest("ESG", 0.1, 200, 1000, 300)
+    pm.observeRequestBody("ESG", 500, 200, 800)
+    dict_endpoint = pm.getSummary("")['endpoints']['ESG']
+    assert (dict_endpoint['requestBaselineBytes'], dict_endpoint['bytesSaved']) == (800, 700+600)
+    assert 'climateapi_request_baseline_bytes_total{endpoint="ESG"} 800\n' in pm.formatPrometheus("")
+    pm.resetMetrics()
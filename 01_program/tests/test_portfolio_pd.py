@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from modules import ownfirm_models as amodel
+from modules import file_handlers as fh
+from conftest import makeOutputs
+
+# %%
+def test_streamed_medians_match_batch(tmp_path):
+    list_outputs = makeOutputs(25)
+    df_batch = amodel.calculatePortfolioPD(list_outputs)
+
+    # parts of uneven size, as a streaming run writes them
+    for int_part, (int_start, int_stop) in enumerate([(0, 7), (7, 8), (8, 25)]):
+        df_edf1 = amodel.calculateForwardPDs(list_outputs[int_start:int_stop])
+        fh.writePart(str(tmp_path), "_forward_pds", int_part, df_edf1[['entityId']+amodel.list_portfoliokeys+amodel.list_portfoliocols])
+    # a group file left by an interrupted run
+    (tmp_path / "_portfolio_groups").mkdir()
+    (tmp_path / "_portfolio_groups" / "group-00000.f64").write_bytes(np.ones(3).tobytes())
+    df_streamed = amodel.aggregatePortfolioPDParts(fh.iterParts(str(tmp_path), "_forward_pds", amodel.list_portfoliokeys+amodel.list_portfoliocols),
+                                                   str(tmp_path / "_portfolio_groups"))
+
+    pd.testing.assert_frame_equal(df_streamed, df_batch, check_dtype=False, check_index_type=False)
+    assert not (tmp_path / "_portfolio_groups").exists()
+
+def test_parts_are_read_one_at_a_time(tmp_path):
+    list_parts = []
+    def iterParts():
+        for int_start in range(0, 9, 3):
+            list_parts.append(int_start)
+            # the groups of the previous parts are on disk, not in memory
+            assert len(list(tmp_path.glob("groups/*.f64"))) == (10 if int_start > 0 else 0)
+            yield amodel.calculateForwardPDs(makeOutputs(3, int_seed=int_start))
+    assert len(amodel.aggregatePortfolioPDParts(iterParts(), str(tmp_path / "groups"))) == 10
+    assert list_parts == [0, 3, 6]
+    assert amodel.aggregatePortfolioPDParts(iter([]), str(tmp_path / "groups")) is None
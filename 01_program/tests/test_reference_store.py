@@ -0,0 +1,56 @@
+import pandas as pd
+from modules import reference_store as rs
+
+# %%
+def makePaths(list_industries, list_regions=None):
+    # flattened transition paths (extractAPIOutput_TransRiskIndustry / Region): a numeric and a text variable
+    list_rows = []
+    for i, industry in enumerate(list_industries):
+        for scenario in ["Net Zero 2050", "Current Policies"]:
+            for year in [2025, 2030]:
+                dict_row = {'scenario': scenario, 'industry': industry, 'year': str(year), 'carbonPrice': 10.0*i+year-2000, 'unit': "USD/t"}
+                if list_regions is not None:
+                    dict_row['region'] = list_regions[i]
+                list_rows.append(dict_row)
+    return pd.DataFrame(list_rows)
+
+def test_industry_paths_round_trip(tmp_path):
+    path_store = str(tmp_path / "transition_paths.sqlite")
+    dict_apiinputs = {"scenarioCategory": "NGFS", "industry": "N01,N02,N03"}
+    assert rs.filterMissingCodes(path_store, dict_apiinputs) == dict_apiinputs
+
+    # N03 has no path: it is marked as fetched all the same
+    assert rs.storeTransitionPaths(path_store, dict_apiinputs, makePaths(["N01", "N02"])) == 16
+    assert rs.filterMissingCodes(path_store, dict_apiinputs) is None
+    assert rs.filterMissingCodes(path_store, {"scenarioCategory": "NGFS", "industry": "N02,N04"}) == {"scenarioCategory": "NGFS", "industry": "N04"}
+    assert rs.filterMissingCodes(path_store, {"scenarioCategory": "NGFS2", "industry": "N01"}) == {"scenarioCategory": "NGFS2", "industry": "N01"}
+
+    df = rs.lookupTransitionPaths(path_store, {"scenarioCategory": "NGFS", "industry": "N02,N03"})
+    assert df.columns.tolist() == ['scenario', 'industry', 'year', 'carbonPrice', 'unit']
+    assert df['industry'].unique().tolist() == ["N02"]
+    assert df['year'].tolist() == [2025, 2030, 2025, 2030]
+    assert df['carbonPrice'].tolist() == [35.0, 40.0, 35.0, 40.0]
+    assert (df['unit'] == "USD/t").all()
+    assert rs.lookupTransitionPaths(path_store, {"scenarioCategory": "NGFS", "industry": "N03"}) is None
+
+def test_region_paths_are_keyed_by_pair(tmp_path):
+    path_store = str(tmp_path / "transition_paths.sqlite")
+    dict_apiinputs = {"scenarioCategory": "NGFS", "regionIndustry": "(USA,N01),(GBR,N01)"}
+    assert rs.parseCodes(dict_apiinputs) == [("N01", "USA"), ("N01", "GBR")]
+    rs.storeTransitionPaths(path_store, dict_apiinputs, makePaths(["N01", "N01"], ["USA", "GBR"]))
+    # the industry-level path of N01 is a different code than its regional ones
+    assert rs.filterMissingCodes(path_store, {"scenarioCategory": "NGFS", "industry": "N01"}) is not None
+    assert rs.filterMissingCodes(path_store, {"scenarioCategory": "NGFS", "regionIndustry": "(GBR,N01),(FRA,N01)"}) == \
+        {"scenarioCategory": "NGFS", "regionIndustry": "(FRA,N01)"}
+
+    df = rs.lookupTransitionPaths(path_store, {"scenarioCategory": "NGFS", "regionIndustry": "(GBR,N01)"})
+    assert df[['region', 'industry']].drop_duplicates().values.tolist() == [["GBR", "N01"]]
+    assert len(df) == 4
+
+def test_paths_are_replaced_when_fetched_again(tmp_path):
+    path_store = str(tmp_path / "transition_paths.sqlite")
+    dict_apiinputs = {"scenarioCategory": "NGFS", "industry": "N01"}
+    rs.storeTransitionPaths(path_store, dict_apiinputs, makePaths(["N01"]))
+    rs.storeTransitionPaths(path_store, dict_apiinputs, makePaths(["N01"]).assign(carbonPrice=1.0))
+    df = rs.lookupTransitionPaths(path_store, dict_apiinputs)
+    assert len(df) == 4 and (df['carbonPrice'] == 1.0).all()
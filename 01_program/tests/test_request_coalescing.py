@@ -0,0 +1,48 @@
+import json
+from modules import ownfirm_to_moodys_connectors as amc
+from modules import ownfirm_data_formatters as adf
+from conftest import makeResponse
+
+# %%
+def makeResult(str_entityid):
+    return {"entityId": str_entityid, "asOfDate": "2023-06-01", "isfin": False, "physicalRiskScore": 30,
+            "baseline": {"pd": [0.1, 0.2], "impliedRating": ["A1", "A2"]}}
+
+def test_coalesce_and_fan_out_payloads():
+    list_apiinputs = [{"a": 1, "b": 2}, {"b": 2, "a": 1}, {"a": 3}]
+    list_distinct, list_fanout = amc.coalesceAPIInputs(list_apiinputs)
+    assert list_distinct == [{"a": 1, "b": 2}, {"a": 3}]
+    assert amc.fanOutResponses(["r1", "r2"], list_fanout) == ["r1", "r1", "r2"]
+
+def test_consolidated_payload_sends_each_entity_once(monkeypatch):
+    list_sent = []
+    def getResponse(dict_token, info_type, json_data):
+        list_sent.append(json.loads(json_data))
+        return 200, makeResponse(200, {"processId": "p1"})
+    def getProcessResult(dict_token, str_processId):
+        # the results in another order than the payload
+        return 200, makeResponse(200, {"scenarioCategory": "NGFS", "entities": [makeResult(entity["entityId"]) for entity in reversed(list_sent[-1]["entities"])]})
+    monkeypatch.setattr(amc.mapi, "getAuth", lambda: (200, {'id_token': "t"}))
+    monkeypatch.setattr(amc.mapi, "getResponse", getResponse)
+    monkeypatch.setattr(amc.mapi, "getProcessResult", getProcessResult)
+
+    # one row per facility: E1 three times
+    list_rows = ["E1", "E2", "E1", "E3", "E1"]
+    apiinput = {"asyncResponse": True, "entities": [{"entityId": entityid} for entityid in list_rows]}
+    list_responses = amc.obtainClimatePDs(True, [apiinput], None)
+
+    assert [entity["entityId"] for entity in list_sent[0]["entities"]] == ["E1", "E2", "E3"]
+    assert [entity["entityId"] for entity in json.loads(list_responses[0].content)["entities"]] == list_rows
+    list_outputs = adf.extractAPIOutput_ClimatePDs(list_responses, None)
+    assert [df['entityId'].iloc[0] for df in list_outputs] == list_rows
+
+def test_unmatched_response_is_left_as_received():
+    apiinput, list_fanout = amc.coalesceEntities({"entities": [{"entityId": "E1"}, {"entityId": "E1"}, {"entityId": "E2"}]})
+    assert list_fanout == [0, 0, 1]
+    response = makeResponse(200, {"entities": [makeResult("E1")]})
+    assert amc.fanOutEntities(response, apiinput, list_fanout) is response
+    response_failed = amc.getFailedResponse()
+    assert amc.fanOutEntities(response_failed, apiinput, list_fanout) is response_failed
+    # nothing repeated: the payload is sent as it is
+    apiinput_solo = {"entities": [{"entityId": "E1"}]}
+    assert amc.coalesceEntities(apiinput_solo) == (apiinput_solo, None)
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+from modules import run_delta as rd
+from modules import term_structure_store as tss
+from conftest import makeOutput
+
+# %%
+def test_compare_values():
+    sr_new = pd.Series([1.0, 1.0+1e-9, "Baa1", None, None, 2.0, "3"], dtype=object)
+    sr_prev = pd.Series([1.5, 1.0, "Baa2", None, 1.0, np.nan, 3.0], dtype=object)
+    bool_changed, arr_diff = rd.compareValues(sr_new, sr_prev, 1e-6, 1e-9)
+    # within tolerance, missing on both sides and a number stored as text are no change
+    assert bool_changed.tolist() == [True, False, True, False, True, True, False]
+    np.testing.assert_allclose(arr_diff[[0, 6]], [0.5, 0.0])
+    assert np.isnan(arr_diff[[2, 3, 4, 5]]).all()
+
+def test_compare_frames():
+    df_prev = pd.DataFrame({'industry': ["N01", "N01", "N02", "N03"], 'year': [2025, 2030, 2025, 2025], 'carbonPrice': [10.0, 20.0, 5.0, 1.0]})
+    df_new = pd.DataFrame({'industry': ["N01", "N01", "N02", "N04"], 'year': [2025, 2030, 2025, 2025], 'carbonPrice': [10.0, 25.0, 5.0, 1.0]})
+    df_output, df_summary = rd.compareFrames('transitionDrivers', df_new, df_prev, ['industry', 'year'], ['industry'])
+    # the whole group of a changed value is exported
+    assert df_output['industry'].tolist() == ["N01", "N01", "N04"]
+    assert df_summary.columns.tolist() == rd.list_summarycols
+    assert sorted(df_summary[['key', 'status', 'valuesChanged']].values.tolist()) == [["N01", "changed", 1], ["N03", "removed", 1], ["N04", "new", 1]]
+    assert df_summary.set_index('key').loc["N01", 'maxAbsDiff'] == 5.0
+
+    df_output, df_summary = rd.compareFrames('transitionDrivers', df_prev, None, ['industry', 'year'], ['industry'])
+    assert len(df_output) == 4 and df_summary['status'].tolist() == ["new"]*3
+    assert len(rd.compareFrames('transitionDrivers', df_prev, df_prev, ['industry', 'year'], ['industry'])[0]) == 0
+
+def test_compare_frames_by_row_in_group():
+    # ESG: no key within an entity but the position of its rows
+    df_prev = pd.DataFrame({'entityId': ["E1", "E1", "E2"], 'score': [1.0, 2.0, 3.0]})
+    df_new = pd.DataFrame({'entityId': ["E1", "E1", "E2"], 'score': [1.0, 2.5, 3.0]})
+    df_output, df_summary = rd.compareFrames('esg', df_new, df_prev, ['entityId'], ['entityId'], bool_rowkey=True)
+    assert df_output.columns.tolist() == ['entityId', 'score']
+    assert df_output['score'].tolist() == [1.0, 2.5]
+    assert df_summary[['key', 'status', 'valuesChanged']].values.tolist() == [["E1", "changed", 1]]
+
+def test_compare_climate_pds_with_previous_run(tmp_path):
+    path_store = str(tmp_path)
+    str_prevrun = "book_20230914_210000"
+    tss.appendTermStructures(path_store, str_prevrun, [makeOutput("E1"), makeOutput("E2"), makeOutput("E3"), makeOutput("E5")])
+
+    list_outputs = [makeOutput("E1"), makeOutput("E2", 1.5), makeOutput("E3", list_ratings=("Aaa", "Baa1", "Caa-C (sf)", "A2")),
+                    makeOutput("E4"), None, makeOutput("E2", 1.5)]
+    list_changed, df_summary = rd.compareClimatePDs(path_store, str_prevrun, list_outputs)
+    assert [df['entityId'].iloc[0] if df is not None else None for df in list_changed] == [None, "E2", "E3", "E4", None, None]
+    assert df_summary[['key', 'status', 'valuesChanged']].values.tolist() == \
+        [["E2", "changed", 8], ["E3", "changed", 2], ["E4", "new", 8], ["E5", "removed", 0]]
+    assert abs(df_summary['maxAbsDiff'].iloc[0]-0.02) < 1e-6
+
+    # a curve no longer returned counts as a change
+    df_baseline = makeOutput("E1")[lambda df: df['RiskType'] == "baseline"]
+    list_changed, df_summary = rd.compareClimatePDs(path_store, str_prevrun, [df_baseline])
+    assert list_changed[0] is df_baseline and df_summary['status'].tolist()[0] == "changed"
+    # no previous run: everything is new
+    assert rd.compareClimatePDs(path_store, None, [makeOutput("E1")])[1]['status'].tolist() == ["new"]
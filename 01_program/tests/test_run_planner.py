@@ -0,0 +1,37 @@
+import os
+import pandas as pd
+from modules import pipeline_metrics as pm
+from modules import run_catalogue as rc
+from modules import run_planner as rp
+
+# %%
+def recordRunWithMetrics(path_outray, str_run, str_started, int_requests, bool_perrun=True):
+    # a catalogued run whose metrics.json has int_requests climate PD requests of 0.2 s
+    path_target = str(path_outray / str_run)
+    os.makedirs(path_target)
+    pm.resetMetrics()
+    pm.setRun(str_run)
+    for _ in range(int_requests):
+        pm.observeRequest("climate_pds_TPC", 0.2, 200, 1000)
+    pm.writeMetrics(path_target, str_run)
+    pm.resetMetrics()
+    pm.setRun("")
+    if not bool_perrun:
+        # as written when the request counters were process-wide
+        with open(path_target+"/metrics.json", 'r', encoding='utf-8') as file:
+            str_metrics = file.read().replace('"run": "'+str_run+'",', "")
+        with open(path_target+"/metrics.json", 'w', encoding='utf-8') as file:
+            file.write(str_metrics)
+    df_cpdproperties = pd.DataFrame({'Parameter': ['scenarioCategory'], 'Value': ['NGFS']})
+    rc.recordRun(str(path_outray / "_run_catalogue.sqlite"), path_target, {'workbook': "book.xlsx", 'started': str_started},
+                 df_cpdproperties, {}, {})
+
+def test_latency_history_sums_per_run_metrics_only(tmp_path):
+    recordRunWithMetrics(tmp_path, "book_20230101_000000", "2023-01-01 00:00:00", 5, bool_perrun=False)
+    recordRunWithMetrics(tmp_path, "book_20230102_000000", "2023-01-02 00:00:00", 3)
+    recordRunWithMetrics(tmp_path, "book_20230103_000000", "2023-01-03 00:00:00", 2)
+
+    dict_history = rp.loadLatencyHistory(str(tmp_path / "_run_catalogue.sqlite"))
+    assert dict_history['climate_pds_TPC']['count'] == 5
+    assert dict_history['climate_pds_TPC']['bytes'] == 5000
+    assert abs(dict_history['climate_pds_TPC']['seconds']-1.0) < 1e-9
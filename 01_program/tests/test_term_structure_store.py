@@ -0,0 +1,56 @@
+import os
+import json
+import numpy as np
+from modules import term_structure_store as tss
+from conftest import makeOutput
+
+# %%
+def test_curves_round_trip_with_any_rating(tmp_path):
+    path_store = str(tmp_path)
+    assert tss.appendTermStructures(path_store, "book_20230914_210000", [makeOutput("E1"), None, makeOutput("E2", 2.0, ("A1",), 3)], int_years=5) == 2
+
+    list_curves, arr_pd, arr_ir = tss.getCurve(path_store, "book_20230914_210000", "NGFS", "E1")
+    assert list_curves == [("baseline", "baseline"), ("transitionRisk", "Net Zero 2050")]
+    np.testing.assert_allclose(arr_pd[0], [0.01, 0.02, 0.03, 0.04, np.nan], rtol=1e-6)
+    assert arr_ir[1].tolist() == ["Aaa", "Baa1", "Caa-C (sf)", "Ä1", ""]
+    list_curves, arr_pd, arr_ir = tss.getCurve(path_store, "book_20230914_210000", "NGFS", "E2")
+    assert arr_ir[0].tolist() == ["A1", "", "", "", ""]
+    assert isinstance(tss.openTermStructures(path_store, "book_20230914_210000", "NGFS")['pd'], np.memmap)
+    assert tss.getCurve(path_store, "book_20230914_210000", "NGFS", "E3") is None
+
+def test_chunks_are_indexed_once_at_the_end(tmp_path):
+    path_store = str(tmp_path)
+    str_run = "book_20230914_210000"
+    path_index = tss.getStorePath(path_store, str_run, "NGFS")+"/index.json"
+    assert tss.appendTermStructures(path_store, str_run, [makeOutput("E1")], bool_flush=False) == 1
+    # the entity of the previous chunk (e.g. one row per facility) is not added again
+    assert tss.appendTermStructures(path_store, str_run, [makeOutput("E2"), makeOutput("E1")], bool_flush=False) == 1
+    assert not os.path.exists(path_index)
+    assert tss.openTermStructures(path_store, str_run, "NGFS") is None
+
+    assert tss.flushTermStructures(path_store, str_run) == 1
+    with open(path_index, encoding='utf-8') as file:
+        dict_index = json.load(file)
+    assert dict_index['rows'] == 4 and list(dict_index['entities']) == ["E1", "E2"]
+    assert tss.getCurve(path_store, str_run, "NGFS", "E2")[2][0, 0] == "Aaa"
+    assert tss.flushTermStructures(path_store, str_run) == 0
+
+def test_compare_curves_across_runs(tmp_path):
+    path_store = str(tmp_path)
+    tss.appendTermStructures(path_store, "book_20230914_210000", [makeOutput("E1"), makeOutput("E2")])
+    tss.appendTermStructures(path_store, "book_20231014_210000", [makeOutput("E1", 3.0)])
+    list_runs = tss.listStoredRuns(path_store, "NGFS")
+    assert list_runs == ["book_20230914_210000", "book_20231014_210000"]
+
+    df_pd = tss.compareCurves(path_store, list_runs, "NGFS", ["E1", "E2"], "transitionRisk", "Net Zero 2050")
+    assert df_pd.index.tolist() == [("book_20230914_210000", "E1"), ("book_20230914_210000", "E2"), ("book_20231014_210000", "E1")]
+    np.testing.assert_allclose(df_pd[2].to_numpy(), [0.02, 0.02, 0.06], rtol=1e-6)
+    df_ir = tss.compareCurves(path_store, list_runs, "NGFS", ["E1"], "baseline", "baseline", str_field='impliedRating')
+    assert df_ir.iloc[0].tolist()[:4] == ["Aaa", "Baa1", "Caa-C (sf)", "Ä1"]
+
+def test_stored_runs_are_ordered_by_timestamp_then_suffix(tmp_path):
+    path_store = str(tmp_path)
+    for str_run in ["book_20230914_210000_10", "other_20230914_205959", "book_20230914_210000_2", "book_20230914_210000", "a_book_20231014_210000"]:
+        tss.appendTermStructures(path_store, str_run, [makeOutput("E1")])
+    assert tss.listStoredRuns(path_store, "NGFS") == ["other_20230914_205959", "book_20230914_210000", "book_20230914_210000_2",
+                                                      "book_20230914_210000_10", "a_book_20231014_210000"]
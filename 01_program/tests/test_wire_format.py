@@ -0,0 +1,72 @@
+import json
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from modules import wire_format as wf
+
+# a payload as built from the workbook: numpy and pandas scalars, NaN, dates and non-ASCII names
+dict_payload = {
+    "entities": [
+        {"name": "Société Générale", "pid": np.int64(37833), "weight": np.float32(0.5), "listed": np.bool_(True)},
+        {"name": "台積電", "pid": 123, "weight": float("nan"), "limit": np.float64("nan"), "score": float("inf")},
+    ],
+    "asOfDate": pd.Timestamp("2023-09-14 21:00:00"),
+    "runDate": datetime.date(2023, 9, 14),
+    "maturity": np.datetime64("2030-12-31"),
+    "years": np.arange(3),
+    "curve": np.array([0.01, np.nan]),
+    "codes": (1, "A"),
+    1: "non-string key",
+}
+
+dict_expected = {
+    "entities": [
+        {"name": "Société Générale", "pid": 37833, "weight": 0.5, "listed": True},
+        {"name": "台積電", "pid": 123, "weight": None, "limit": None, "score": None},
+    ],
+    "asOfDate": "2023-09-14T21:00:00",
+    "runDate": "2023-09-14",
+    "maturity": "2030-12-31T00:00:00",
+    "years": [0, 1, 2],
+    "curve": [0.01, None],
+    "codes": [1, "A"],
+    "1": "non-string key",
+}
+
+# %%
+def encodeWithout(monkeypatch, obj):
+    monkeypatch.setattr(wf, "orjson", None)
+    return wf.encodeJSON(obj)
+
+def test_json_fallback_is_valid_json(monkeypatch):
+    bytes_json = encodeWithout(monkeypatch, dict_payload)
+    assert b"NaN" not in bytes_json and b"Infinity" not in bytes_json
+    assert b", " not in bytes_json and b": " not in bytes_json
+    assert json.loads(bytes_json) == dict_expected
+
+def test_encoders_give_the_same_bytes(monkeypatch):
+    orjson = pytest.importorskip("orjson")
+    monkeypatch.setattr(wf, "orjson", orjson)
+    bytes_orjson = wf.encodeJSON(dict_payload)
+    assert bytes_orjson == encodeWithout(monkeypatch, dict_payload)
+    assert json.loads(bytes_orjson) == dict_expected
+
+def test_decode_round_trip(monkeypatch):
+    bytes_json = encodeWithout(monkeypatch, dict_payload)
+    assert wf.decodeJSON(bytes_json) == dict_expected
+    assert wf.decodeJSON(bytes_json.decode('utf-8')) == dict_expected
+
+def test_compress_body():
+    bytes_small = b'{"a":1}'
+    assert wf.compressBody(bytes_small) == (bytes_small, False)
+    bytes_large = wf.encodeJSON({"queries": [{"pid": str(i % 10)} for i in range(500)]})
+    bytes_body, bool_compressed = wf.compressBody(bytes_large)
+    assert bool_compressed and len(bytes_body) < len(bytes_large)
+
+def test_indented_size_of_compact_json():
+    dict_body = {"entities": [{"name": "a,b:{c}[d]", "quote": "say \"x\", \\", "ids": [1, 2, [3, []]], "none": {}}, {}],
+                 "nested": {"k": {"l": [{"m": "Ä"}]}}, "empty": [], "n": 1.5}
+    for obj in [dict_body, [dict_body, []], {}, [], "text", 3]:
+        bytes_json = json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        assert wf.getIndentedBytes(bytes_json) == len(json.dumps(obj, indent=4, ensure_ascii=False).encode('utf-8'))